@@ -4,6 +4,7 @@ import android.content.Context
 import android.service.notification.NotificationListenerService
 import android.service.notification.StatusBarNotification
 import android.app.Notification
+import android.os.Build
 import android.util.Log
 import okhttp3.MediaType.Companion.toMediaType
 import okhttp3.OkHttpClient
@@ -12,9 +13,14 @@ import okhttp3.RequestBody.Companion.toRequestBody
 import okhttp3.Call
 import okhttp3.Callback
 import okhttp3.Response
+import okhttp3.WebSocket
+import okhttp3.WebSocketListener
+import org.json.JSONArray
 import org.json.JSONObject
 import java.io.IOException
+import java.util.UUID
 import java.util.concurrent.TimeUnit
+import java.util.concurrent.atomic.AtomicLong
 
 data class ServerSettings(val host: String, val port: String, val token: String, val useHttps: Boolean)
 
@@ -25,6 +31,11 @@ class MyNotificationListener : NotificationListenerService() {
         private const val CONNECT_TIMEOUT_SEC = 10L
         private const val READ_TIMEOUT_SEC = 15L
         private const val WRITE_TIMEOUT_SEC = 15L
+        private const val WEBSOCKET_PING_SEC = 30L
+        // WebSocketが使えなかった場合に再接続を試すまでの時間（その間はHTTPで送信）
+        private const val WEBSOCKET_RETRY_MS = 60_000L
+        // 送信できなかった再生情報を溜めておく件数（サーバーの /update/batch の上限と同じ）
+        private const val MAX_PENDING_EVENTS = 20
     }
 
     // 通信クライアント（タイムアウト設定付き）
@@ -37,13 +48,57 @@ class MyNotificationListener : NotificationListenerService() {
             .build()
     }
     
+    // WebSocket用クライアント（接続を開いたままにするため読み込みタイムアウトなし）
+    private val webSocketClient: OkHttpClient by lazy {
+        client.newBuilder()
+            .readTimeout(0, TimeUnit.SECONDS)
+            .pingInterval(WEBSOCKET_PING_SEC, TimeUnit.SECONDS)
+            .build()
+    }
+
     private val JSON_TYPE = "application/json; charset=utf-8".toMediaType()
 
+    // WebSocketの状態（サーバーがASGIモードの場合のみ使える。使えない間はHTTPで送信）
+    private val webSocketLock = Any()
+    private var webSocket: WebSocket? = null
+    private var webSocketSettings: ServerSettings? = null
+    private var webSocketOpen = false
+    private var webSocketRetryAt = 0L
+
+    // 送信順の番号（サーバーは古い番号のイベントを捨てる）。番号はサービスの起動ごとのストリームIDの中で数える
+    private val streamId = UUID.randomUUID().toString()
+    private val seqCounter = AtomicLong()
+
+    // この端末のID（サーバーは端末ごとに再生状態を分け、表示する端末を1台選ぶ）
+    // 機種名＋ランダムな4文字。初回に作って保存する（サーバーの SESSION_PRIORITY に書く値）
+    private val deviceId: String by lazy {
+        val prefs = getSharedPreferences("device", Context.MODE_PRIVATE)
+        prefs.getString("device_id", null) ?: run {
+            val model = Build.MODEL.replace(Regex("[^A-Za-z0-9]+"), "-").trim('-').ifEmpty { "android" }
+            "$model-${UUID.randomUUID().toString().take(4)}".also {
+                prefs.edit().putString("device_id", it).apply()
+                Log.i(TAG, "📱 端末ID: $it")
+            }
+        }
+    }
+
+    // オフライン中などで送信できなかった再生情報（次の送信時に /update/batch でまとめて送る）
+    private val pendingEvents = ArrayDeque<JSONObject>()
+
     override fun onListenerConnected() {
         super.onListenerConnected()
         Log.d(TAG, "サービスが接続されました")
     }
 
+    override fun onListenerDisconnected() {
+        super.onListenerDisconnected()
+        synchronized(webSocketLock) {
+            webSocket?.close(1000, null)
+            webSocket = null
+            webSocketOpen = false
+        }
+    }
+
     override fun onNotificationPosted(sbn: StatusBarNotification) {
         if (sbn.packageName == "com.google.android.apps.youtube.music") {
             val notification = sbn.notification
@@ -127,6 +182,8 @@ class MyNotificationListener : NotificationListenerService() {
     
     private fun sendPauseToDiscord() {
         val settings = getSettings() ?: return
+        if (sendOverWebSocket(settings, JSONObject().put("op", "pause"))) return
+
         val scheme = if (settings.useHttps) "https" else "http"
         val url = "$scheme://${settings.host}:${settings.port}/pause"
         
@@ -137,6 +194,7 @@ class MyNotificationListener : NotificationListenerService() {
         if (settings.token.isNotEmpty()) {
             builder.addHeader("Authorization", "Bearer ${settings.token}")
         }
+        builder.addHeader("X-Device-Id", deviceId)
         
         val request = builder.build()
 
@@ -156,8 +214,6 @@ class MyNotificationListener : NotificationListenerService() {
 
     private fun sendToDiscord(title: String, artist: String, isPlaying: Boolean, duration: Long, position: Long) {
         val settings = getSettings() ?: return
-        val scheme = if (settings.useHttps) "https" else "http"
-        val url = "$scheme://${settings.host}:${settings.port}/update"
 
         val jsonBody = JSONObject().apply {
             put("title", title)
@@ -165,23 +221,55 @@ class MyNotificationListener : NotificationListenerService() {
             put("is_playing", isPlaying)
             put("duration", duration / 1000)
             put("position", position / 1000)
+            put("seq", seqCounter.incrementAndGet())
+            put("ts", System.currentTimeMillis() / 1000.0)
         }
 
-        val requestBody = jsonBody.toString().toRequestBody(JSON_TYPE)
+        // 接続済みのWebSocketがあればそちらで送る（ヘッダー・認証のやり取りが不要）
+        if (sendOverWebSocket(settings, jsonBody)) {
+            // 最新の状態を送れたので、溜まっていた古い再生情報は不要
+            synchronized(pendingEvents) { pendingEvents.clear() }
+            return
+        }
+
+        // 送れなかった再生情報があれば、今回の分と一緒にまとめて送る
+        val batch = synchronized(pendingEvents) {
+            if (pendingEvents.isEmpty()) {
+                null
+            } else {
+                enqueuePending(listOf(jsonBody))
+                pendingEvents.toList().also { pendingEvents.clear() }
+            }
+        }
+
+        val scheme = if (settings.useHttps) "https" else "http"
+        val requestBody = if (batch == null) {
+            jsonBody.toString().toRequestBody(JSON_TYPE)
+        } else {
+            JSONObject().apply {
+                put("stream", streamId)
+                put("sent_at", System.currentTimeMillis() / 1000.0)
+                put("events", JSONArray(batch))
+            }.toString().toRequestBody(JSON_TYPE)
+        }
+        val path = if (batch == null) "update" else "update/batch"
         
         val builder = Request.Builder()
-            .url(url)
+            .url("$scheme://${settings.host}:${settings.port}/$path")
             .post(requestBody)
             
         if (settings.token.isNotEmpty()) {
             builder.addHeader("Authorization", "Bearer ${settings.token}")
         }
+        builder.addHeader("X-Device-Id", deviceId)
         
         val request = builder.build()
 
         client.newCall(request).enqueue(object : Callback {
             override fun onFailure(call: Call, e: IOException) {
                 Log.e(TAG, "❌ 送信失敗: ${e.message}")
+                // 次に送れたときにまとめて送る
+                synchronized(pendingEvents) { enqueuePending(batch ?: listOf(jsonBody)) }
             }
 
             override fun onResponse(call: Call, response: Response) {
@@ -196,4 +284,96 @@ class MyNotificationListener : NotificationListenerService() {
             }
         })
     }
+
+    /**
+     * 送信できなかった再生情報を溜める（pendingEventsのロック内で呼ぶ）
+     * 上限を超えたら古いものから捨てる（サーバーは最後の状態に畳み込むため）
+     */
+    private fun enqueuePending(events: List<JSONObject>) {
+        val merged = (pendingEvents + events).sortedBy { it.getLong("seq") }
+        pendingEvents.clear()
+        pendingEvents.addAll(merged.takeLast(MAX_PENDING_EVENTS))
+    }
+
+    /**
+     * WebSocketで送信（接続済みの場合のみtrueを返す）
+     * 未接続なら裏で接続を始めてfalseを返すので、呼び出し側はHTTPで送る
+     */
+    private fun sendOverWebSocket(settings: ServerSettings, payload: JSONObject): Boolean {
+        synchronized(webSocketLock) {
+            // 設定が変わったら接続し直す
+            if (settings != webSocketSettings) {
+                webSocket?.close(1000, null)
+                webSocket = null
+                webSocketOpen = false
+                webSocketRetryAt = 0L
+            }
+
+            val socket = webSocket
+            if (socket == null) {
+                if (System.currentTimeMillis() >= webSocketRetryAt) {
+                    openWebSocket(settings)
+                }
+                return false
+            }
+            if (!webSocketOpen) return false
+
+            if (!payload.has("seq")) payload.put("seq", seqCounter.incrementAndGet())
+            return socket.send(payload.toString())
+        }
+    }
+
+    private fun openWebSocket(settings: ServerSettings) {
+        val scheme = if (settings.useHttps) "wss" else "ws"
+        val builder = Request.Builder()
+            .url("$scheme://${settings.host}:${settings.port}/ws")
+
+        if (settings.token.isNotEmpty()) {
+            builder.addHeader("Authorization", "Bearer ${settings.token}")
+        }
+        builder.addHeader("X-Device-Id", deviceId)
+
+        webSocketSettings = settings
+        webSocket = webSocketClient.newWebSocket(builder.build(), object : WebSocketListener() {
+            override fun onOpen(socket: WebSocket, response: Response) {
+                synchronized(webSocketLock) {
+                    if (webSocket === socket) webSocketOpen = true
+                }
+                Log.d(TAG, "🔌 WebSocket接続")
+            }
+
+            override fun onMessage(socket: WebSocket, text: String) {
+                val code = try {
+                    JSONObject(text).optInt("code", 200)
+                } catch (e: Exception) {
+                    200
+                }
+                when {
+                    code in 200..299 -> Log.d(TAG, "✅ 送信成功")
+                    code == 429 -> Log.w(TAG, "⏳ レート制限中")
+                    else -> Log.e(TAG, "⚠️ サーバーエラー: $code")
+                }
+            }
+
+            override fun onClosing(socket: WebSocket, code: Int, reason: String) {
+                socket.close(1000, null)
+                dropWebSocket(socket, 0L)
+            }
+
+            override fun onFailure(socket: WebSocket, t: Throwable, response: Response?) {
+                // 403はトークン違い、404はWaitressモードのサーバー
+                Log.w(TAG, "⚠️ WebSocket切断: ${response?.code ?: t.message}")
+                dropWebSocket(socket, WEBSOCKET_RETRY_MS)
+            }
+        })
+    }
+
+    private fun dropWebSocket(socket: WebSocket, retryDelayMs: Long) {
+        synchronized(webSocketLock) {
+            if (webSocket !== socket) return
+            webSocket = null
+            webSocketOpen = false
+            webSocketRetryAt = System.currentTimeMillis() + retryDelayMs
+        }
+    }
 }
\ No newline at end of file
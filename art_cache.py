@@ -0,0 +1,285 @@
+"""
+アルバムアートの永続キャッシュ
+SQLiteに保存し、再起動後もキャッシュを引き継ぐ
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ArtCache:
+    """SQLiteバックエンド付きのアルバムアートキャッシュ（TTL・サイズ上限付き）
+
+    読み取りはメモリ上のOrderedDictで行い、書き込みはSQLiteにも反映する。
+    db_pathが空の場合はメモリのみで動作する。
+
+    検索に失敗した・見つからなかった曲は、画像とは別に短い期限付きの「なし」として
+    メモリだけに覚えておく（期限が切れたら検索し直す）。
+    再生キューから先読みした画像も、検索で確かめていない仮のものとして期限付きでメモリだけに覚える
+    （期限が切れるか、検索の結果を put() するとそちらで置き換わる）。
+    placeholderを指定すると、以前のバージョンが画像の代わりに保存したプレースホルダー
+    （videoIdなし）を起動時に削除し、検索し直す対象にする。
+
+    shared=Trueの場合（同じdb_pathを複数のプロセスで使う場合）、メモリにない時はSQLiteも見る
+    （他のプロセスが保存した画像を使う）。
+    """
+
+    def __init__(self, db_path: str = '', max_size: int = 100, ttl: float = 0,
+                 negative_ttl: float = 600, placeholder: str | None = None, shared: bool = False):
+        self.db_path = db_path
+        self.max_size = max(1, int(max_size))
+        self.ttl = ttl  # 秒（0以下なら無期限）
+        self.negative_ttl = negative_ttl  # 秒（0以下なら「なし」を覚えない）
+        self.placeholder = placeholder
+        self.shared = shared and bool(db_path)
+        self._entries = OrderedDict()  # key -> (image, video_id, created_at)
+        self._negative = OrderedDict()  # key -> expires_at
+        self._provisional = OrderedDict()  # key -> (image, video_id, expires_at)
+        self._lock = threading.Lock()
+        self._db = None
+        self.stats = {'evictions': 0, 'expired': 0}
+
+        if db_path:
+            self._open_db()
+            self._warm_start()
+
+    # ----------------------------------------
+    #  SQLite
+    # ----------------------------------------
+
+    def _open_db(self):
+        """データベースを開き、テーブルを用意"""
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._db = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS album_art ('
+            ' key TEXT PRIMARY KEY,'
+            ' image TEXT NOT NULL,'
+            ' video_id TEXT,'
+            ' created_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS idx_album_art_created ON album_art(created_at)')
+
+    def _warm_start(self):
+        """起動時に有効なエントリをメモリへ読み込む（新しい順に上限まで）"""
+        now = time.time()
+        if self.ttl > 0:
+            self._db.execute('DELETE FROM album_art WHERE created_at < ?', (now - self.ttl,))
+        if self.placeholder is not None:
+            self._db.execute('DELETE FROM album_art WHERE image = ? AND video_id IS NULL', (self.placeholder,))
+
+        rows = self._db.execute(
+            'SELECT key, image, video_id, created_at FROM album_art ORDER BY created_at DESC LIMIT ?',
+            (self.max_size,)
+        ).fetchall()
+
+        # 古い順に並べ直して挿入（OrderedDictの先頭が最も古い）
+        for key, image, video_id, created_at in reversed(rows):
+            self._entries[key] = (image, video_id, created_at)
+
+        # 上限を超えた分はディスクからも削除
+        self._db.execute(
+            'DELETE FROM album_art WHERE key NOT IN '
+            '(SELECT key FROM album_art ORDER BY created_at DESC LIMIT ?)',
+            (self.max_size,)
+        )
+
+    # ----------------------------------------
+    #  公開API
+    # ----------------------------------------
+
+    def get(self, key: str):
+        """キャッシュを取得（なければNone）。戻り値は {'image', 'video_id'}"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if not self.shared:
+                    return None
+                entry = self._db_get(key)
+                if entry is None:
+                    return None
+                self._promote(key, entry)
+
+            image, video_id, created_at = entry
+            if self.ttl > 0 and time.time() - created_at >= self.ttl:
+                del self._entries[key]
+                self._db_delete(key)
+                self.stats['expired'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            return {'image': image, 'video_id': video_id}
+
+    def put(self, key: str, image: str, video_id: str | None):
+        """キャッシュに保存（上限を超えたら最も古いものを削除）"""
+        created_at = time.time()
+
+        with self._lock:
+            self._negative.pop(key, None)
+            self._provisional.pop(key, None)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (image, video_id, created_at)
+
+            evicted = []
+            while len(self._entries) > self.max_size:
+                oldest_key, _ = self._entries.popitem(last=False)
+                evicted.append(oldest_key)
+            self.stats['evictions'] += len(evicted)
+
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO album_art (key, image, video_id, created_at) VALUES (?, ?, ?, ?)',
+                        (key, image, video_id, created_at)
+                    )
+                    for oldest_key in evicted:
+                        self._db.execute('DELETE FROM album_art WHERE key = ?', (oldest_key,))
+                except sqlite3.Error:
+                    # ディスク書き込みに失敗してもメモリキャッシュは有効
+                    pass
+
+    def put_negative(self, key: str):
+        """画像が見つからなかったことをnegative_ttl秒だけ覚える（メモリのみ）"""
+        if self.negative_ttl <= 0:
+            return
+        with self._lock:
+            self._negative.pop(key, None)
+            self._negative[key] = time.time() + self.negative_ttl
+            while len(self._negative) > self.max_size:
+                self._negative.popitem(last=False)
+
+    def is_negative(self, key: str) -> bool:
+        """期限内の「なし」があるか（期限切れなら削除してFalse）"""
+        if not self._negative:
+            return False
+        with self._lock:
+            expires_at = self._negative.get(key)
+            if expires_at is None:
+                return False
+            if time.time() >= expires_at:
+                del self._negative[key]
+                return False
+            return True
+
+    def put_provisional(self, key: str, image: str, video_id: str | None, ttl: float):
+        """検索で確かめていない画像をttl秒だけ覚える（メモリのみ。保存済みの画像があれば何もしない）"""
+        if ttl <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._provisional.pop(key, None)
+            self._provisional[key] = (image, video_id, time.time() + ttl)
+            while len(self._provisional) > self.max_size:
+                self._provisional.popitem(last=False)
+
+    def get_provisional(self, key: str):
+        """期限内の仮の画像を取得（なければNone）。戻り値は {'image', 'video_id'}"""
+        if not self._provisional:
+            return None
+        with self._lock:
+            entry = self._provisional.get(key)
+            if entry is None:
+                return None
+            image, video_id, expires_at = entry
+            if time.time() >= expires_at:
+                del self._provisional[key]
+                return None
+            return {'image': image, 'video_id': video_id}
+
+    def discard_negative(self, key: str):
+        """「なし」を忘れる（失敗で覚えた分を、期限を待たずに検索し直すため）"""
+        with self._lock:
+            self._negative.pop(key, None)
+
+    def negative_count(self) -> int:
+        return len(self._negative)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self):
+        """データベースを閉じる"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _db_get(self, key: str):
+        """他のプロセスが保存したエントリを読む（ロック内で呼ぶ）"""
+        if self._db is None:
+            return None
+        try:
+            return self._db.execute(
+                'SELECT image, video_id, created_at FROM album_art WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+
+    def _promote(self, key: str, entry):
+        """SQLiteから読んだエントリをメモリに載せる（あふれた分はメモリからだけ外す。ロック内で呼ぶ）"""
+        self._entries[key] = tuple(entry)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _db_delete(self, key: str):
+        if self._db is not None:
+            try:
+                self._db.execute('DELETE FROM album_art WHERE key = ?', (key,))
+            except sqlite3.Error:
+                pass
+
+
+class SingleFlight:
+    """同じキーの同時実行を1回にまとめる（後続の呼び出しは先行の結果を共有）"""
+
+    def __init__(self):
+        self._calls = {}  # key -> Future
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn, *args, recheck=None):
+        """keyごとにfnを1回だけ実行して結果を返す
+
+        recheckが指定された場合、先行役になる直前にロック内で呼び出し、
+        None以外が返ればその値をそのまま返す（直前に完了した結果の取りこぼし防止）。
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                if recheck is not None:
+                    result = recheck()
+                    if result is not None:
+                        return result
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def in_flight(self) -> int:
+        """実行中のキー数"""
+        return len(self._calls)
@@ -0,0 +1,485 @@
+"""
+ASGIサーバーモード
+Waitressの代わりにasyncio（uvicorn）でリクエストを受け付ける
+
+SERVER_MODE=asgi で有効になる。ルート・認証・レート制限・セキュリティヘッダーは
+server.py と共通の処理を使い、画像検索はタイムアウト付きのタスクとして待つため、
+遅い検索があっても他のリクエストの受け付けは止まらない。
+
+/ws ではWebSocketで再生情報を受け付ける。接続時に一度だけ認証し、
+以降は開いたままの接続に /update と同じ内容のJSONを流すだけでよい。
+"""
+
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter
+
+from event_log import KIND_BATCH, KIND_UPDATE
+from ingest import UnsupportedFormat, decode_body, decode_frame
+
+logger = logging.getLogger(__name__)
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Device-Id',
+}
+
+
+class Request:
+    """ASGIのscopeと本文をまとめたもの"""
+
+    def __init__(self, scope: dict, body: bytes):
+        self.scope = scope
+        self.body = body
+        self.method = scope.get('method', 'GET')  # WebSocketのscopeにはない
+        self.path = scope['path']
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        client = scope.get('client')
+        self.remote_addr = client[0] if client else None
+
+    def header(self, name: str, default: str = '') -> str:
+        return self.headers.get(name.lower(), default)
+
+    def arg(self, name: str, default: str = '') -> str:
+        """クエリ文字列の値"""
+        values = parse_qs(self.scope.get('query_string', b'').decode('latin-1')).get(name)
+        return values[0] if values else default
+
+
+class AsgiApp:
+    """server.py の処理をASGIで公開するアプリケーション"""
+
+    def __init__(self, core, art_timeout: float = 3.0):
+        self.core = core
+        self.art_timeout = art_timeout
+        # 複数ワーカーの場合は共有ストアで全ワーカーの回数を数える
+        self.limiter = FixedWindowRateLimiter(storage_from_string(core.RATE_LIMIT_STORAGE))
+        self.default_limit = parse(core.RATE_LIMIT_DEFAULT)
+        # 複数ワーカーの場合、レート制限・再生状態・画像キャッシュ・Presenceは共有ストア（SQLite）を読み書きし、
+        # 他のワーカーの書き込みが終わるまで待つことがあるため、イベントループではなくスレッドで実行する
+        self.offload = core.MULTI_PROCESS
+
+        # (method, path) -> (ハンドラ, レート制限, 認証が必要か)
+        self.routes = {
+            ('POST', '/update'): (self.update_status, parse(core.RATE_LIMIT_UPDATE), True),
+            ('POST', '/update/batch'): (self.update_batch, parse(core.RATE_LIMIT_UPDATE), True),
+            ('POST', '/pause'): (self.pause_status, parse('30/minute'), True),
+            ('GET', '/health'): (self.health_check, parse('10/minute'), False),
+            ('GET', '/metrics'): (self.export_metrics, self.default_limit, True),
+        }
+        if core.PROFILE_MAX_SECONDS > 0:
+            self.routes[('GET', '/debug/profile')] = (self.debug_profile, parse('2/minute'), True)
+        self.paths = {path for _, path in self.routes}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] == 'websocket':
+            await self._websocket(scope, receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        started = time.perf_counter()
+        endpoint = await self._handle_http(scope, receive, send)
+        self.core.request_seconds.labels(endpoint).observe(time.perf_counter() - started)
+
+    async def _handle_http(self, scope, receive, send) -> str:
+        """HTTPリクエストを処理し、メトリクス用のエンドポイント名を返す"""
+        body, too_large = await self._read_body(receive)
+        request = Request(scope, body)
+
+        route = self.routes.get((request.method, request.path))
+        # Flask版のエンドポイント名（関数名）に合わせる
+        endpoint = route[0].__name__ if route else 'other'
+
+        if too_large:
+            await self._respond(send, request, {"error": "Request too large"}, 413)
+            return endpoint
+
+        # CORSのプリフライト
+        if request.method == 'OPTIONS':
+            await self._respond(send, request, None, 200)
+            return endpoint
+
+        limit = route[1] if route else self.default_limit
+
+        # レート制限（Flask-Limiterと同じく接続元アドレス単位）
+        remote = request.remote_addr or '127.0.0.1'
+        if not await self._blocking(self.limiter.hit, limit, request.path, remote):
+            self.core.rate_limited_total.labels(endpoint).inc()
+            await self._respond(send, request, {"error": "Rate limit exceeded"}, 429)
+            return endpoint
+
+        client_ip = self.core.resolve_client_ip(request.remote_addr, request.header('X-Forwarded-For'))
+        denied = await self._blocking(
+            self.core.check_access,
+            client_ip,
+            request.header('Authorization'),
+            route[2] if route else True
+        )
+        if denied:
+            await self._respond(send, request, *denied)
+            return endpoint
+
+        if route is None:
+            if request.path in self.paths:
+                await self._respond(send, request, {"error": "Method Not Allowed"}, 405)
+            else:
+                await self._respond(send, request, {"error": "Not Found"}, 404)
+            return endpoint
+
+        try:
+            result, status = await route[0](request)
+        except Exception as e:
+            logger.exception("❌ エラー: %s", e)
+            result, status = {"error": "Internal server error"}, 500
+
+        await self._respond(send, request, result, status)
+        return endpoint
+
+    # ----------------------------------------
+    #  エンドポイント
+    # ----------------------------------------
+
+    async def update_status(self, request: Request) -> tuple[dict, int]:
+        """再生情報を受け取りDiscord Presenceを更新"""
+        profiler = self.core.profiler
+        profiler.begin('update')
+        data, error = self._decode_body(request)
+        profiler.mark('read')
+        try:
+            if error:
+                return error
+            return await self.handle_update(data, request.header('X-Device-Id'))
+        finally:
+            profiler.end()
+
+    async def handle_update(self, data, device: str | None = None) -> tuple[dict, int]:
+        """再生情報を処理（HTTPとWebSocketで共通）"""
+        started = time.perf_counter()
+        core = self.core
+        fields = core.parse_update(data)
+        core.profiler.mark('parse')
+        if fields is None:
+            return {"error": "Invalid JSON"}, 400
+
+        decision, action = await self._blocking(self._apply_update, fields, device)
+        core.profiler.mark('state')
+        if action != 'publish':
+            if action == 'skip':
+                core.reset_idle_timer()
+            core.log_event(KIND_UPDATE, fields, decision, started)
+            core.profiler.mark('log')
+            return {"status": "skipped" if action == 'skip' else "standby"}, 200
+
+        return await self._publish(fields, decision, KIND_UPDATE, started)
+
+    def _apply_update(self, fields: dict, device: str | None) -> tuple[dict, str]:
+        """端末の再生状態を更新し、(判定結果, 表示の扱い) を返す"""
+        core = self.core
+        session = core.get_session(device)
+        with core.sessions.exclusive():
+            decision = core.apply_playback_state(session, fields)
+            return decision, core.arbitrate(session, decision)
+
+    async def update_batch(self, request: Request) -> tuple[dict, int]:
+        """オフライン中に溜まった再生情報をまとめて受け取る"""
+        core = self.core
+        core.profiler.begin('batch')
+        data, error = self._decode_body(request)
+        core.profiler.mark('read')
+        try:
+            if error:
+                return error
+            return await self._update_batch(data, request.header('X-Device-Id'))
+        finally:
+            core.profiler.end()
+
+    async def _update_batch(self, data, device: str | None) -> tuple[dict, int]:
+        started = time.perf_counter()
+        core = self.core
+        outcome = await self._blocking(self._apply_batch, data, device)
+        if outcome is None:
+            return {"error": "Invalid JSON"}, 400
+        batch, decision, fields, applied, action = outcome
+        logger.info("📨 一括受信: %d件反映 / %d件破棄", applied, batch['stale'])
+        result = {"applied": applied, "stale": batch['stale']}
+        if action != 'publish':
+            if action == 'skip':
+                core.reset_idle_timer()
+            if fields is not None:
+                core.log_event(KIND_BATCH, fields, decision, started)
+            core.profiler.mark('log')
+            return dict(result, status="skipped" if action == 'skip' else "standby"), 200
+
+        body, status = await self._publish(fields, decision, KIND_BATCH, started)
+        return dict(body, **result), status
+
+    def _apply_batch(self, data, device: str | None) -> tuple | None:
+        """まとめて届いた再生情報を畳み込み、(batch, 判定結果, 最後の状態, 反映数, 表示の扱い) を返す（不正ならNone）"""
+        core = self.core
+        session = core.get_session(device)
+        batch = core.parse_update_batch(data, session)
+        core.profiler.mark('parse')
+        if batch is None:
+            return None
+
+        with core.sessions.exclusive():
+            decision, fields, applied = core.apply_playback_batch(session, batch)
+            action = core.arbitrate(session, decision) if fields is not None else 'skip'
+        core.profiler.mark('state')
+        return batch, decision, fields, applied, action
+
+    async def _publish(self, fields: dict, decision: dict, kind: int, started: float) -> tuple[dict, int]:
+        """画像を検索してPresenceを更新（検索はタイムアウト付き）"""
+        core = self.core
+        image_url, video_id = "youtube_music_icon", None
+        lookup_pending = False
+        # キャッシュ・曲目インデックスを見るだけでもSQLiteに書くことがある（期限切れの削除・インデックスからの保存）ので、
+        # ワーカー数に関係なくスレッドで実行する（反映する更新だけなので回数は少ない）
+        cache_hit, found = await asyncio.to_thread(self._cached_art, fields)
+
+        if found is not None:
+            # キャッシュヒット（曲目インデックス・最近見つからなかった曲を含む）はその場で返す
+            image_url, video_id = found
+        elif core.ASYNC_ART_LOOKUP:
+            lookup_pending = True
+        else:
+            # 画像検索はスレッドで実行し、時間がかかりすぎたら先にプレースホルダーで表示する
+            # （検索はそのまま続き、終わったら同じ曲のままなら画像を反映）
+            loop = asyncio.get_running_loop()
+            lookup = loop.run_in_executor(
+                None, core.search_album_art, fields['title'], fields['artist'], fields['duration']
+            )
+            try:
+                image_url, video_id = await asyncio.wait_for(asyncio.shield(lookup), self.art_timeout)
+            except asyncio.TimeoutError:
+                logger.info("⏳ 画像検索が%s秒を超えたため後で反映します: %s", self.art_timeout, fields['title'])
+                lookup_pending = True
+        core.profiler.mark('art')
+
+        result = await self._blocking(core.publish_playback, fields, decision, image_url, video_id, lookup_pending)
+        core.profiler.mark('publish')
+        core.log_event(kind, fields, decision, started, cache_hit, lookup_pending)
+        core.profiler.mark('log')
+        return result
+
+    def _cached_art(self, fields: dict) -> tuple[bool, tuple[str, str | None] | None]:
+        """検索せずに決まる画像（キャッシュヒットか, (画像URL, videoId) またはNone）"""
+        core = self.core
+        cache_key = core.get_cache_key(fields['title'], fields['artist'])
+        cache_hit = (core.image_cache.get(cache_key) is not None
+                     or core.image_cache.get_provisional(cache_key) is not None)
+        if cache_hit or core.resolves_without_search(cache_key, fields['title'], fields['artist'], fields['duration']):
+            return cache_hit, core.search_album_art(fields['title'], fields['artist'], fields['duration'])
+        return cache_hit, None
+
+    async def pause_status(self, request: Request) -> tuple[dict, int]:
+        """一時停止時にPresenceをクリア"""
+        return await self._blocking(self.core.process_pause, request.header('X-Device-Id'))
+
+    async def health_check(self, request: Request) -> tuple[dict, int]:
+        """ヘルスチェック用エンドポイント"""
+        return await self._blocking(self.core.build_health), 200
+
+    async def export_metrics(self, request: Request) -> tuple[str, int]:
+        """Prometheus形式のメトリクス"""
+        return await self._blocking(self.core.render_metrics), 200
+
+    async def debug_profile(self, request: Request) -> tuple[dict | str, int]:
+        """全スレッドのサンプリングプロファイルと、/update の処理段階ごとの時間（計測はスレッドで行う）"""
+        return await asyncio.to_thread(
+            self.core.run_profile, request.arg('seconds', '5'), request.arg('format', 'json')
+        )
+
+    # ----------------------------------------
+    #  WebSocket（/ws）
+    # ----------------------------------------
+
+    async def _websocket(self, scope, receive, send):
+        """接続時に一度だけ認証し、以降は届いたイベントを順に処理して結果を返す
+
+        イベントは /update と同じ項目のJSONで、"op" に update（省略時）/ pause / ping を指定する。
+        "seq" を付けると返信にそのまま入れて返す。端末IDは接続時の X-Device-Id ヘッダーを使う。
+        """
+        request = Request(scope, b'')
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+
+        remote = request.remote_addr or '127.0.0.1'
+        device = request.header('X-Device-Id')
+        client_ip = self.core.resolve_client_ip(request.remote_addr, request.header('X-Forwarded-For'))
+
+        # 接続前に拒否すると、クライアントにはハンドシェイクの403が返る
+        if request.path != '/ws' or not await self._blocking(self.limiter.hit, self.default_limit, request.path, remote):
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        if await self._blocking(self.core.check_access, client_ip, request.header('Authorization')):
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+
+        await send({'type': 'websocket.accept'})
+        logger.info("🔌 WebSocket接続: %s", client_ip)
+
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+
+            frame = message.get('text')
+            if frame is None:
+                frame = message.get('bytes') or b''
+
+            started = time.perf_counter()
+            reply = await self._handle_event(frame, remote, device)
+            self.core.request_seconds.labels('websocket').observe(time.perf_counter() - started)
+            await send({'type': 'websocket.send', 'text': json.dumps(reply)})
+
+        logger.info("🔌 WebSocket切断: %s", client_ip)
+
+    async def _handle_event(self, frame: str | bytes, remote: str, device: str | None = None) -> dict:
+        """WebSocketのイベント1件（JSONのテキスト、またはMessagePackのバイナリ）を処理し、返信を作る"""
+        data = None
+        try:
+            if len(frame) > self.core.MAX_CONTENT_LENGTH:
+                result, status = {"error": "Request too large"}, 413
+            else:
+                data = decode_frame(frame)
+                result, status = await self._dispatch_event(data, remote, device)
+        except UnsupportedFormat:
+            result, status = {"error": "Unsupported Media Type"}, 415
+        except ValueError:
+            result, status = {"error": "Bad Request"}, 400
+        except Exception as e:
+            logger.exception("❌ エラー: %s", e)
+            result, status = {"error": "Internal server error"}, 500
+
+        reply = dict(result, code=status)
+        if isinstance(data, dict) and data.get('seq') is not None:
+            reply['seq'] = data['seq']
+        return reply
+
+    async def _dispatch_event(self, data, remote: str, device: str | None = None) -> tuple[dict, int]:
+        if not isinstance(data, dict):
+            return {"error": "Invalid JSON"}, 400
+
+        op = data.get('op', 'update')
+        if op == 'ping':
+            return {"status": "pong"}, 200
+        if op not in ('update', 'pause'):
+            return {"error": "Unknown op"}, 400
+
+        # レート制限はHTTPの同じエンドポイントと共有する
+        path = f'/{op}'
+        handler, limit, _ = self.routes[('POST', path)]
+        if not await self._blocking(self.limiter.hit, limit, path, remote):
+            self.core.rate_limited_total.labels(handler.__name__).inc()
+            return {"error": "Rate limit exceeded"}, 429
+
+        if op == 'update':
+            profiler = self.core.profiler
+            profiler.begin('ws_update')
+            try:
+                return await self.handle_update(data, device)
+            finally:
+                profiler.end()
+        return await self._blocking(self.core.process_pause, device)
+
+    # ----------------------------------------
+    #  ASGIの入出力
+    # ----------------------------------------
+
+    async def _blocking(self, fn, *args):
+        """共有ストアを読み書きする処理を実行（複数ワーカーの場合はスレッドで実行し、イベントループを止めない）"""
+        if self.offload:
+            # to_thread はコンテキストを引き継ぐので、処理段階の記録（profiler）もそのまま続く
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def _decode_body(self, request: Request) -> tuple[object, tuple[dict, int] | None]:
+        """本文をデコードし、(データ, エラーのレスポンス) を返す"""
+        try:
+            return decode_body(request.body, request.header('Content-Type')), None
+        except UnsupportedFormat:
+            return None, ({"error": "Unsupported Media Type"}, 415)
+        except ValueError:
+            return None, ({"error": "Bad Request"}, 400)
+
+    async def _read_body(self, receive) -> tuple[bytes, bool]:
+        """本文を読み込む（MAX_CONTENT_LENGTHを超えたら打ち切る）"""
+        chunks = []
+        size = 0
+        too_large = False
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.core.MAX_CONTENT_LENGTH:
+                too_large = True
+            elif chunk:
+                chunks.append(chunk)
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks), too_large
+
+    async def _respond(self, send, request: Request, body: dict | str | None, status: int):
+        headers = dict(self.core.SECURITY_HEADERS)
+        if isinstance(body, str):
+            payload = body.encode('utf-8')
+            headers['Content-Type'] = self.core.METRICS_CONTENT_TYPE
+        else:
+            payload = b'' if body is None else json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(len(payload))
+        if request.header('Origin'):
+            headers.update(CORS_HEADERS)
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # uvicornはこの直後にポートを開く
+                self.core.mark_startup('http')
+                print(f"⏱️  起動時間: {self.core.format_startup_timings()}")
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def serve_asgi(core, host: str, port: int, art_timeout: float = 3.0, sock=None):
+    """uvicornでASGIサーバーを起動（sockを渡した場合はそのソケットで受け付ける）"""
+    try:
+        import uvicorn
+    except ImportError:
+        print("❌ SERVER_MODE=asgi には uvicorn が必要です: pip install uvicorn")
+        raise SystemExit(1)
+
+    config = uvicorn.Config(
+        AsgiApp(core, art_timeout=art_timeout),
+        host=host,
+        port=port,
+        log_level='warning',
+        server_header=False,
+        ws_max_size=core.MAX_CONTENT_LENGTH
+    )
+    uvicorn.Server(config).run(sockets=[sock] if sock is not None else None)
@@ -0,0 +1,159 @@
+"""
+認証失敗の追跡（ブルートフォース対策）
+IPごとの直近の失敗時刻だけを保持し、判定・記録・追い出しをO(1)で行う
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class AuthFailureTracker:
+    """IPごとの認証失敗を記録し、window秒以内にthreshold回失敗したIPをブロックする
+
+    各IPは直近threshold回分の失敗時刻だけをdequeに持つため、
+    「最も古い記録がwindow秒以内か」を見るだけでブロック判定できる。
+    IPは最後に失敗した順にOrderedDictへ並べ、上限を超えたら先頭（最も古い）から追い出す。
+
+    sharedに共有ストア（shared_state.SharedStore）を渡すと、失敗回数を全ワーカーで数え、
+    どのワーカーでブロックしたIPも、他のワーカーが1秒以内に読み込んでブロックする。
+    """
+
+    SHARED_REFRESH = 1.0  # 共有ストアのブロック一覧を読み直す間隔（秒）
+
+    def __init__(self, threshold: int = 10, window: float = 300, max_entries: int = 1000,
+                 store_path: str = '', shared=None):
+        self.threshold = max(1, threshold)
+        self.window = window
+        self.max_entries = max(1, max_entries)
+        self.store_path = store_path
+        self.shared = shared
+        self._failures = OrderedDict()  # ip -> deque(失敗時刻)
+        self._lock = threading.Lock()
+        self.dirty = False  # 保存していない変更があるか
+        self._shared_blocks = {}  # ip -> 解除時刻（共有ストアから読んだもの）
+        self._shared_read_at = 0.0
+
+        if store_path:
+            self.load()
+
+    def is_blocked(self, ip: str) -> bool:
+        """IPがブロックされているか"""
+        failures = self._failures.get(ip)
+        if failures is not None:
+            with self._lock:
+                if len(failures) >= self.threshold and time.time() - failures[0] < self.window:
+                    return True
+
+        if self.shared is None:
+            return False
+        return self._shared_blocked(ip)
+
+    def _shared_blocked(self, ip: str) -> bool:
+        """他のワーカーでブロックされたか（一覧はSHARED_REFRESH秒ごとに読み直す）"""
+        now = time.time()
+        if now - self._shared_read_at >= self.SHARED_REFRESH:
+            self._shared_read_at = now
+            self._shared_blocks = self.shared.blocks()
+        return self._shared_blocks.get(ip, 0) > now
+
+    def record_failure(self, ip: str) -> bool:
+        """認証失敗を記録（このIPがブロック状態になったらTrueを返す）"""
+        now = time.time()
+
+        with self._lock:
+            failures = self._failures.get(ip)
+            if failures is None:
+                self._expire(now)
+                if len(self._failures) >= self.max_entries:
+                    # メモリ保護: 最後の失敗が最も古いIPを追い出す
+                    self._failures.popitem(last=False)
+                failures = deque(maxlen=self.threshold)
+                self._failures[ip] = failures
+            else:
+                self._failures.move_to_end(ip)
+
+            failures.append(now)
+            blocked = len(failures) >= self.threshold and now - failures[0] < self.window
+            if blocked:
+                self.dirty = True
+
+        if self.shared is not None and not blocked:
+            # 他のワーカーでの失敗と合わせて数える
+            if self.shared.record_auth_failure(ip, self.window) >= self.threshold:
+                blocked = True
+        if self.shared is not None and blocked:
+            self.shared.block(ip, now + self.window)
+            self._shared_blocks[ip] = now + self.window
+        return blocked
+
+    def _expire(self, now: float):
+        """最後の失敗がwindow秒より前のIPを先頭から削除（ロック内で呼ぶ）"""
+        while self._failures:
+            failures = next(iter(self._failures.values()))
+            if now - failures[-1] < self.window:
+                break
+            self._failures.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._failures)
+
+    def blocked_count(self) -> int:
+        """現在ブロック中のIP数"""
+        now = time.time()
+        with self._lock:
+            return sum(
+                1 for failures in self._failures.values()
+                if len(failures) >= self.threshold and now - failures[0] < self.window
+            )
+
+    # ----------------------------------------
+    #  永続化（再起動後もブロックを維持する）
+    # ----------------------------------------
+
+    def save(self):
+        """有効な記録をファイルに保存"""
+        if not self.store_path:
+            return
+
+        with self._lock:
+            self._expire(time.time())
+            data = {ip: list(failures) for ip, failures in self._failures.items()}
+            self.dirty = False
+
+        tmp_path = f"{self.store_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.store_path)
+        except OSError as e:
+            logger.warning("⚠️ 認証失敗記録の保存失敗: %s", e)
+
+    def load(self):
+        """保存した記録を読み込む（期限切れのものは捨てる）"""
+        try:
+            with open(self.store_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("⚠️ 認証失敗記録の読み込み失敗: %s", e)
+            return
+
+        now = time.time()
+        entries = []
+        for ip, timestamps in data.items():
+            timestamps = sorted(float(t) for t in timestamps if now - float(t) < self.window)
+            if timestamps:
+                entries.append((timestamps[-1], ip, timestamps))
+
+        # 最後の失敗が古い順に並べる
+        entries.sort()
+        with self._lock:
+            for _, ip, timestamps in entries[-self.max_entries:]:
+                self._failures[ip] = deque(timestamps, maxlen=self.threshold)
@@ -0,0 +1,115 @@
+"""
+認証失敗トラッカーの負荷テスト
+数千の異なるIPから認証失敗が続く状況（クレデンシャルスタッフィング）を再現し、
+旧実装（リストの作り直し・min()による追い出し）と AuthFailureTracker を比較する
+
+使い方: python benchmarks/bench_auth_tracker.py [--ips 5000] [--threads 8]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth_tracker import AuthFailureTracker  # noqa: E402
+
+THRESHOLD = 10
+WINDOW = 300
+MAX_ENTRIES = 1000
+
+
+class LegacyTracker:
+    """旧実装（server.py の is_ip_blocked / record_auth_failure）"""
+
+    def __init__(self):
+        self.auth_failures = {}
+
+    def is_blocked(self, ip):
+        if ip not in self.auth_failures:
+            return False
+        current_time = time.time()
+        failures = [t for t in self.auth_failures[ip] if current_time - t < WINDOW]
+        self.auth_failures[ip] = failures
+        return len(failures) >= THRESHOLD
+
+    def record_failure(self, ip):
+        auth_failures = self.auth_failures
+        if ip not in auth_failures:
+            if len(auth_failures) >= MAX_ENTRIES:
+                oldest_ip = min(auth_failures.keys(), key=lambda k: min(auth_failures[k]) if auth_failures[k] else float('inf'))
+                del auth_failures[oldest_ip]
+            auth_failures[ip] = []
+        auth_failures[ip].append(time.time())
+
+
+def make_trace(ip_count: int, rng: random.Random) -> list:
+    """攻撃トレース: 大半は1〜3回だけ失敗するIP、一部は閾値を超えるまで連続で失敗するIP"""
+    bursts = []
+    for i in range(ip_count):
+        ip = f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+        attempts = THRESHOLD + 2 if rng.random() < 0.05 else rng.randint(1, 3)
+        bursts.append([ip] * attempts)
+    rng.shuffle(bursts)
+    return [ip for burst in bursts for ip in burst]
+
+
+def run(tracker, trace):
+    """before_request と同じ順序（判定→失敗記録）で処理し、1件あたりの時間を返す"""
+    start = time.perf_counter()
+    for ip in trace:
+        if not tracker.is_blocked(ip):
+            tracker.record_failure(ip)
+    return (time.perf_counter() - start) / len(trace) * 1e6
+
+
+def run_threaded(tracker, trace, threads):
+    chunks = [trace[i::threads] for i in range(threads)]
+    workers = [threading.Thread(target=run, args=(tracker, chunk)) for chunk in chunks]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return (time.perf_counter() - start) / len(trace) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ips', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    trace = make_trace(args.ips, random.Random(42))
+
+    print("=" * 60)
+    print(f"🔐 {args.ips} IPs / {len(trace)} 件の認証失敗")
+    legacy_us = run(LegacyTracker(), trace)
+    print(f"  legacy                 {legacy_us:8.2f} µs/件")
+
+    tracker = AuthFailureTracker(THRESHOLD, WINDOW, MAX_ENTRIES)
+    tracker_us = run(tracker, trace)
+    print(f"  AuthFailureTracker     {tracker_us:8.2f} µs/件  (追跡中 {len(tracker)} IP, ブロック中 {tracker.blocked_count()} IP)")
+
+    threaded = AuthFailureTracker(THRESHOLD, WINDOW, MAX_ENTRIES)
+    threaded_us = run_threaded(threaded, trace, args.threads)
+    print(f"  {args.threads} threads              {threaded_us:8.2f} µs/件  (追跡中 {len(threaded)} IP)")
+
+    # 永続化の往復
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'auth_failures.json')
+        tracker.store_path = path
+        start = time.perf_counter()
+        tracker.save()
+        save_ms = (time.perf_counter() - start) * 1000
+        restored = AuthFailureTracker(THRESHOLD, WINDOW, MAX_ENTRIES, store_path=path)
+        print(f"  save {save_ms:.1f} ms / 復元後のブロック中 {restored.blocked_count()} IP")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+/update の受け付けのCPU時間
+1. 本文のデコードと検証だけ: 旧実装（json + sanitize_string / validate_number）と ingest.py を
+   本文の形式（JSON・orjson・MessagePack）別に比較する
+2. /update 全体（WSGIアプリを直接呼ぶ。画像はキャッシュ済み、Discordは代役）:
+   旧実装の読み込み（request.json）・検証に差し替えた場合と今の実装を、スキップ・反映別に比較する
+
+使い方: python benchmarks/bench_ingest.py [--requests 20000]
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.test import EnvironBuilder  # noqa: E402
+
+import ingest  # noqa: E402
+from harness import import_server, install_fakes  # noqa: E402
+
+BODY = {
+    'title': 'Blinding Lights',
+    'artist': 'The Weeknd',
+    'is_playing': True,
+    'duration': 200,
+    'position': 42,
+}
+
+
+# ----------------------------------------
+#  旧実装（server.py の parse_update_payload）
+# ----------------------------------------
+
+def legacy_sanitize_string(s, max_length=200):
+    if not isinstance(s, str):
+        s = str(s)
+    s = s[:max_length]
+    s = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]', '', s)
+    return s.strip()
+
+
+def legacy_validate_number(value, default=0, min_val=0, max_val=float('inf')):
+    try:
+        num = float(value)
+        if num < min_val:
+            return min_val
+        if num > max_val:
+            return max_val
+        return num
+    except (ValueError, TypeError):
+        return default
+
+
+def legacy_parse(data):
+    if not data or not isinstance(data, dict):
+        return None
+    title = legacy_sanitize_string(data.get('title', 'Unknown Title'), max_length=100)
+    artist = legacy_sanitize_string(data.get('artist', 'Unknown Artist'), max_length=100)
+    is_playing = bool(data.get('is_playing', True))
+    duration = legacy_validate_number(data.get('duration', 0), min_val=0, max_val=86400)
+    position = legacy_validate_number(data.get('position', 0), min_val=0, max_val=86400)
+    if not title.strip():
+        title = "Unknown Title"
+    if not artist.strip():
+        artist = "Unknown Artist"
+    if len(title) < 2:
+        title += " "
+    if len(artist) < 2:
+        artist += " "
+    return {'title': title, 'artist': artist, 'is_playing': is_playing, 'duration': duration, 'position': position}
+
+
+# ----------------------------------------
+#  計測
+# ----------------------------------------
+
+def cpu_us(fn, count: int) -> float:
+    """1回あたりのCPU時間（マイクロ秒）"""
+    start = time.process_time()
+    for _ in range(count):
+        fn()
+    return (time.process_time() - start) / count * 1e6
+
+
+def bench_decode(count: int):
+    raw = json.dumps(BODY).encode()
+    cases = [
+        ('legacy (json + re.sub)', lambda: legacy_parse(json.loads(raw))),
+        ('ingest (json)', lambda: ingest.parse_update(json.loads(raw))),
+    ]
+    if ingest.orjson is not None:
+        cases.append(('ingest (orjson)', lambda: ingest.parse_update(ingest.decode_body(raw, 'application/json'))))
+    if ingest.msgpack is not None:
+        packed = ingest.msgpack.packb(BODY)
+        cases.append(('ingest (msgpack)', lambda: ingest.parse_update(ingest.decode_body(packed, 'application/msgpack'))))
+
+    print(f"{'decode + validate':<28} {'CPU/req':>10}")
+    baseline = None
+    for name, fn in cases:
+        us = cpu_us(fn, count)
+        baseline = baseline or us
+        print(f"{name:<28} {us:>8.2f}µs  (x{baseline / us:.2f})")
+    if ingest.msgpack is None:
+        print("   (msgpack 未インストールのためMessagePackは省略)")
+
+
+def wsgi_caller(server, body: dict):
+    """テストクライアントを通さず、WSGIアプリを直接呼ぶ関数（環境変数の辞書は先に作っておく）"""
+    raw = json.dumps(body).encode()
+    headers = {'Authorization': f'Bearer {server.AUTH_TOKEN}'} if server.AUTH_TOKEN else {}
+    environ = EnvironBuilder(path='/update', method='POST', data=raw, content_type='application/json',
+                             headers=headers).get_environ()
+
+    def call():
+        env = dict(environ, **{'wsgi.input': io.BytesIO(raw)})
+        for _ in server.app(env, lambda status, headers, exc_info=None: None):
+            pass
+    return call
+
+
+def bench_endpoint(server, count: int, rounds: int = 3):
+    songs = [dict(BODY, title=f'Song {n}') for n in range(2)]
+    for song in songs:
+        server.image_cache.put(server.get_cache_key(song['title'], song['artist']), 'https://example.com/a.jpg', 'vid')
+    calls = [wsgi_caller(server, song) for song in songs]
+    flip = [0]
+
+    def applied():
+        flip[0] ^= 1
+        calls[flip[0]]()
+
+    current = (server.read_body, server.parse_update)
+    variants = {
+        'legacy (request.json)': (lambda: server.request.get_json(), legacy_parse),
+        'ingest': current,
+    }
+    # 順番による揺れを避けるため、交互に数回計測して最小値を取る
+    best = {name: [float('inf'), float('inf')] for name in variants}
+    for _ in range(rounds):
+        for name, (read_body, parse) in variants.items():
+            server.read_body, server.parse_update = read_body, parse
+            calls[0]()
+            row = best[name]
+            row[0] = min(row[0], cpu_us(calls[0], count))
+            row[1] = min(row[1], cpu_us(applied, count // 4))
+    server.read_body, server.parse_update = current
+
+    print(f"{'/update (WSGI, server only)':<28} {'skipped':>10} {'applied':>10}")
+    for name, (skipped_us, applied_us) in best.items():
+        print(f"{name:<28} {skipped_us:>8.1f}µs {applied_us:>8.1f}µs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    server = import_server(PRESENCE_MAX_UPDATES='1000000')
+    install_fakes(server)
+
+    print("=" * 60)
+    bench_decode(args.requests * 10)
+    print("-" * 60)
+    bench_endpoint(server, args.requests)
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+IP許可リストのベンチマーク
+許可ブロック数を増やしながら before_request 1回あたりの処理時間を測る
+
+使い方: python benchmarks/bench_ip_filter.py [--iterations 20000]
+"""
+
+import argparse
+import ipaddress
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import import_server  # noqa: E402
+from ip_filter import IPAllowList  # noqa: E402
+
+
+def random_networks(count: int, rng: random.Random) -> list:
+    """ランダムなIPv4/IPv6のCIDRブロックを作る（携帯キャリア・VPNの範囲を想定）"""
+    networks = []
+    for i in range(count):
+        if i % 4 == 3:
+            plen = rng.choice((32, 40, 48, 56, 64))
+            addr = ipaddress.IPv6Address(rng.getrandbits(128))
+            networks.append(ipaddress.ip_network(f"{addr}/{plen}", strict=False))
+        else:
+            plen = rng.choice((12, 16, 20, 22, 24, 28, 32))
+            addr = ipaddress.IPv4Address(rng.getrandbits(32))
+            networks.append(ipaddress.ip_network(f"{addr}/{plen}", strict=False))
+    return networks
+
+
+def bench_lookup(allow_list, ips, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        ips[i % len(ips)] in allow_list
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def bench_before_request(server, ips, iterations):
+    """Flaskのリクエストコンテキスト内で before_request を直接呼ぶ"""
+    contexts = [
+        server.app.test_request_context('/health', environ_base={'REMOTE_ADDR': ip})
+        for ip in ips
+    ]
+    start = time.perf_counter()
+    for i in range(iterations):
+        with contexts[i % len(contexts)]:
+            server.before_request()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def bench_lookup_cold(networks, ips, iterations):
+    """判定結果の再利用なし（毎回違うIPから来た場合）"""
+    allow_list = IPAllowList(networks)
+    start = time.perf_counter()
+    for i in range(iterations):
+        allow_list._lookup(ips[i % len(ips)])
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    # 拒否時のログ（WARNING）は計測から除く
+    server = import_server(LOG_LEVEL='ERROR')
+
+    rng = random.Random(42)
+    probe_ips = [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(64)]
+    probe_ips += [str(ipaddress.IPv6Address(rng.getrandbits(128))) for _ in range(16)]
+
+    print("=" * 60)
+    # before_request は許可（そのまま通す）と拒否（403のレスポンスを作る）を分けて計測する
+    print(f"{'blocks':>8} {'legacy list µs':>16} {'lookup µs':>12} {'cold lookup µs':>16}"
+          f" {'allowed req µs':>16} {'denied req µs':>15}")
+    for count in (0, 10, 1000, 5000, 20000):
+        networks = random_networks(count, rng)
+        # 判定が両方の分岐を通るように、一部のプローブを許可範囲に入れる
+        probe = probe_ips + [str(n.network_address) for n in networks[:16]]
+        allow_list = IPAllowList(networks)
+
+        # 旧実装（完全一致のリスト検索）
+        legacy = [str(n.network_address) for n in networks]
+        legacy_us = bench_lookup(legacy, probe, args.iterations) if legacy else 0.0
+
+        server.ALLOWED_IP_LIST = allow_list
+        lookup_us = bench_lookup(allow_list, probe, args.iterations)
+        cold_us = bench_lookup_cold(networks, probe, args.iterations)
+        allowed = [ip for ip in probe if ip in allow_list] if networks else probe
+        denied = [ip for ip in probe if ip not in allow_list]
+        allowed_us = bench_before_request(server, allowed, args.iterations)
+        denied_us = bench_before_request(server, denied, args.iterations) if networks else 0.0
+        print(f"{count:>8} {legacy_us:>16.2f} {lookup_us:>12.2f} {cold_us:>16.2f}"
+              f" {allowed_us:>16.2f} {denied_us:>15.2f}")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
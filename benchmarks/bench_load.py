@@ -0,0 +1,283 @@
+"""
+通知トレースの再生による負荷テスト（ネットワーク不要）
+YTMusic・Discordを代役に差し替え、実際の再生に近い通知の流れ
+（同じ通知の繰り返し・シーク・一時停止・曲の切り替え・通知の削除）を /update と /pause に送り、
+スループットと p50/p95/p99 をキャッシュのヒット・ミス、反映・スキップ別に集計する
+
+使い方:
+  python benchmarks/bench_load.py [--target flask|waitress|asgi] [--songs 60] [--search-latency 0.2]
+  python benchmarks/bench_load.py --save baseline.json
+  python benchmarks/bench_load.py --baseline baseline.json --tolerance 0.2   # p95が20%以上悪化したら終了コード1
+  python benchmarks/bench_load.py --same-artist 0.6 --song-gap 0.2 --catalogue   # 曲目インデックスを有効にする（検索回数を比較）
+  python benchmarks/bench_load.py --clients 3 --devices   # 端末ごとにX-Device-Idを付ける（表示しない端末の更新はstandby）
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from harness import SERVER_STARTERS, Catalogue, FakePresence, FakeYTMusic, free_port, import_server, install_fakes
+
+GROUPS = ('all', 'applied', 'skipped', 'standby', 'hit', 'miss', 'pause')
+
+
+# ----------------------------------------
+#  トレース
+# ----------------------------------------
+
+def make_trace(catalogue: Catalogue, songs: int, rng: random.Random, same_artist: float = 0.0) -> list:
+    """再生セッションの操作列を作る
+
+    お気に入りの曲ほど繰り返し再生され（キャッシュヒット）、
+    1曲の間にYouTube Musicの通知が何度も届く（大半はスキップ対象）。
+    same_artistの割合で、次の曲を直前と同じアーティストの曲にする（アルバム再生など）。
+    """
+    # 人気の偏り（Zipf風）: 上位の曲ほど選ばれやすい
+    weights = [1 / (rank + 1) for rank in range(len(catalogue.songs))]
+    trace = []
+    song = None
+    for _ in range(songs):
+        if song is not None and rng.random() < same_artist:
+            song = rng.choice(catalogue.by_artist[song['artist']])
+        else:
+            song = rng.choices(catalogue.songs, weights)[0]
+        trace.append(('play', song))
+        trace.extend(('repeat', None) for _ in range(rng.randint(1, 4)))
+        if rng.random() < 0.2:
+            trace.append(('seek', rng.randint(10, 90)))
+            trace.append(('repeat', None))
+        if rng.random() < 0.15:
+            trace.append(('pause', None))
+            trace.append(('repeat', None))
+            trace.append(('resume', None))
+        if rng.random() < 0.05:
+            trace.append(('clear', None))
+    return trace
+
+
+class Player:
+    """トレースを再生し、送信する内容（再生位置は実際の経過時間から計算）を作る"""
+
+    def __init__(self):
+        self.song = None
+        self.started = 0.0
+        self.paused_at = None
+
+    def position(self) -> float:
+        if self.paused_at is not None:
+            return self.paused_at
+        return time.time() - self.started
+
+    def step(self, action: str, arg) -> dict | None:
+        """操作を反映し、/update のボディを返す（/pause の場合はNone）"""
+        if action == 'play':
+            self.song = arg
+            self.started = time.time()
+            self.paused_at = None
+        elif action == 'seek':
+            self.started -= arg
+        elif action == 'pause':
+            self.paused_at = self.position()
+        elif action == 'resume':
+            self.started = time.time() - self.paused_at
+            self.paused_at = None
+        elif action == 'clear':
+            return None
+
+        return {
+            'title': self.song['title'],
+            'artist': self.song['artist'],
+            'is_playing': self.paused_at is None,
+            'duration': self.song['duration'],
+            'position': int(self.position()),
+        }
+
+
+# ----------------------------------------
+#  送信先
+# ----------------------------------------
+
+class InProcessTarget:
+    """Flaskのテストクライアントで直接呼ぶ（ソケットを使わない）"""
+
+    def __init__(self, server, device: str | None = None):
+        self.client = server.app.test_client()
+        self.headers = {'X-Device-Id': device} if device else {}
+
+    def post(self, path: str, body: dict | None) -> dict:
+        res = self.client.post(path, json=body if body is not None else {}, headers=self.headers)
+        return res.get_json(silent=True) or {}
+
+
+class HttpTarget:
+    """ローカルで起動したサーバーにHTTPで送る"""
+
+    def __init__(self, port: int, device: str | None = None):
+        self.base = f'http://127.0.0.1:{port}'
+        self.headers = {'Content-Type': 'application/json'}
+        if device:
+            self.headers['X-Device-Id'] = device
+
+    def post(self, path: str, body: dict | None) -> dict:
+        data = json.dumps(body if body is not None else {}).encode()
+        req = urllib.request.Request(self.base + path, data=data, headers=self.headers)
+        try:
+            with urllib.request.urlopen(req, timeout=30) as res:
+                return json.loads(res.read() or b'{}')
+        except urllib.error.HTTPError as e:
+            return json.loads(e.read() or b'{}')
+
+
+# ----------------------------------------
+#  計測
+# ----------------------------------------
+
+def replay(server, target, trace: list, results: dict, lock: threading.Lock, song_gap: float = 0.0):
+    player = Player()
+    for action, arg in trace:
+        if action == 'play' and song_gap:
+            time.sleep(song_gap)
+        body = player.step(action, arg)
+        if body is None:
+            start = time.perf_counter()
+            target.post('/pause', None)
+            groups = ('pause',)
+        else:
+            cached = server.get_cache_key(body['title'], body['artist']) in server.image_cache
+            start = time.perf_counter()
+            response = target.post('/update', body)
+            if response.get('status') in ('skipped', 'standby'):
+                groups = (response['status'],)
+            else:
+                groups = ('applied', 'hit' if cached else 'miss')
+        elapsed = time.perf_counter() - start
+
+        with lock:
+            for group in ('all',) + groups:
+                results[group].append(elapsed)
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(results: dict, wall: float) -> dict:
+    summary = {'throughput': len(results['all']) / wall}
+    for group in GROUPS:
+        values = results[group]
+        if values:
+            summary[group] = {
+                'count': len(values),
+                'p50_ms': statistics.median(values) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+            }
+    return summary
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    """ベースラインよりp95が悪化したグループ"""
+    regressions = []
+    for group in GROUPS:
+        if group in summary and group in baseline:
+            before, after = baseline[group]['p95_ms'], summary[group]['p95_ms']
+            # 1ms未満の差は計測の揺れとみなす
+            if after > before * (1 + tolerance) and after - before > 1:
+                regressions.append((group, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=['flask', 'waitress', 'asgi'], default='flask')
+    parser.add_argument('--songs', type=int, default=60, help='1クライアントあたりの再生曲数')
+    parser.add_argument('--clients', type=int, default=1,
+                        help='同時に送る端末数（2以上は1つのPresenceを取り合う状況になる）')
+    parser.add_argument('--devices', action='store_true',
+                        help='クライアントごとに別の端末ID（X-Device-Id）で送る（省略時は全員が同じ端末として送る）')
+    parser.add_argument('--search-latency', type=float, default=0.2)
+    parser.add_argument('--search-failure-rate', type=float, default=0.0)
+    parser.add_argument('--rpc-latency', type=float, default=0.0)
+    parser.add_argument('--rpc-failure-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--catalogue', action='store_true', help='曲目インデックスを有効にする（CATALOGUE_ENABLED）')
+    parser.add_argument('--same-artist', type=float, default=0.0, help='次の曲が同じアーティストになる割合')
+    parser.add_argument('--song-gap', type=float, default=0.0,
+                        help='曲の切り替え前に待つ秒数（裏で行う先読み・曲目の取得が間に合う状況の再現）')
+    parser.add_argument('--save', help='結果をJSONで保存')
+    parser.add_argument('--baseline', help='比較するJSON（--saveで保存したもの）')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    catalogue = Catalogue()
+    server = import_server(ART_LOOKUP_TIMEOUT='10', CATALOGUE_ENABLED=str(args.catalogue).lower())
+    yt = FakeYTMusic(catalogue, latency=args.search_latency, failure_rate=args.search_failure_rate)
+    install_fakes(server, yt, FakePresence.configure(latency=args.rpc_latency, failure_rate=args.rpc_failure_rate))
+
+    stop = None
+    if args.target == 'flask':
+        make_target = lambda device: InProcessTarget(server, device)  # noqa: E731
+    else:
+        port = free_port()
+        stop = SERVER_STARTERS[args.target](server, port)
+        make_target = lambda device: HttpTarget(port, device)  # noqa: E731
+
+    rng = random.Random(args.seed)
+    traces = [make_trace(catalogue, args.songs, rng, args.same_artist) for _ in range(args.clients)]
+    results = {group: [] for group in GROUPS}
+    lock = threading.Lock()
+
+    workers = [
+        threading.Thread(target=replay, args=(server, make_target(f'device-{n}' if args.devices else None), trace,
+                                              results, lock, args.song_gap))
+        for n, trace in enumerate(traces)
+    ]
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        wall = time.perf_counter() - start
+        if stop:
+            stop()
+
+    summary = summarize(results, wall)
+    print("=" * 72)
+    print(f"🎧 {args.target}: {len(results['all'])} events from {args.clients} client(s), "
+          f"search {args.search_latency}s, {wall:.1f}s wall, {summary['throughput']:.1f} events/s")
+    print(f"{'group':<10} {'count':>7} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for group in GROUPS:
+        if group in summary:
+            row = summary[group]
+            print(f"{group:<10} {row['count']:>7} {row['p50_ms']:>8.2f}ms {row['p95_ms']:>8.2f}ms {row['p99_ms']:>8.2f}ms")
+    print("🔍 YTMusic calls: " + ", ".join(f"{name} {count}" for name, count in yt.calls.items()))
+    print(f"📱 sessions: {len(server.sessions)}, handovers {server.sessions.stats['handovers']}")
+    print("=" * 72)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        print(f"💾 保存: {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for group, before, after in regressions:
+            print(f"❌ {group}: p95 {before:.2f}ms → {after:.2f}ms")
+        if regressions:
+            sys.exit(1)
+        print("✅ ベースラインからの悪化なし")
+
+
+if __name__ == '__main__':
+    main()
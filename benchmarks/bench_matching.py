@@ -0,0 +1,123 @@
+"""
+マッチング処理のマイクロベンチマーク
+旧実装（SequenceMatcherを候補ごとに2回）と matching.best_match を比較する
+
+使い方: python benchmarks/bench_matching.py [--iterations 2000]
+"""
+
+import argparse
+import os
+import sys
+import time
+from difflib import SequenceMatcher
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matching import best_match, normalize  # noqa: E402
+
+
+def legacy_best_match(title: str, artist: str, results: list):
+    """旧実装のスコアリング（server.py から移動前のもの）"""
+    def similar(a, b):
+        return SequenceMatcher(None, a.lower(), b.lower()).ratio()
+
+    best = None
+    highest_score = 0
+    for item in results:
+        res_title = item.get('title', "")
+        res_artists = item.get('artists', [])
+        res_artist_name = res_artists[0]['name'] if res_artists else ""
+
+        total_score = (similar(title, res_title) + similar(artist, res_artist_name)) / 2
+        if total_score > 0.5 and total_score > highest_score:
+            highest_score = total_score
+            best = item
+    return best, highest_score
+
+
+def song(title, artist, video_id, duration):
+    return {
+        'title': title,
+        'artists': [{'name': artist}],
+        'videoId': video_id,
+        'duration_seconds': duration,
+        'thumbnails': [{'url': f'https://img.example/{video_id}'}],
+    }
+
+
+# (クエリ曲名, クエリアーティスト, 再生時間, 検索結果, 正解videoId)
+CASES = [
+    ('Lemon', '米津玄師', 255, [
+        song('Lemon', '米津玄師', 'lemon', 255),
+        song('Flamingo', '米津玄師', 'flamingo', 235),
+        song('Lemon (Cover)', 'Someone', 'cover', 250),
+    ], 'lemon'),
+    ('夜に駆ける', 'YOASOBI', 261, [
+        song('夜に駆ける (Official Music Video)', 'YOASOBI', 'mv', 275),
+        song('夜に駆ける', 'YOASOBI', 'yoru', 261),
+        song('群青', 'YOASOBI', 'gunjo', 248),
+        song('アイドル', 'YOASOBI', 'idol', 213),
+    ], 'yoru'),
+    ('ｱｲﾄﾞﾙ', 'ＹＯＡＳＯＢＩ', 213, [
+        song('祝福', 'YOASOBI', 'shukufuku', 200),
+        song('アイドル', 'YOASOBI', 'idol', 213),
+        song('アイドル (English Ver.)', 'YOASOBI', 'idol_en', 213),
+    ], 'idol'),
+    ('Blinding Lights', 'The Weeknd', 200, [
+        song('Blinding Lights', 'The Weeknd', 'bl_single', 200),
+        song('Blinding Lights', 'The Weeknd', 'bl_extended', 262),
+        song('Save Your Tears', 'The Weeknd', 'syt', 215),
+    ], 'bl_single'),
+    ('Stay (feat. Justin Bieber)', 'The Kid LAROI', 141, [
+        song('STAY', 'The Kid LAROI', 'stay', 141),
+        song('Without You', 'The Kid LAROI', 'without', 161),
+    ], 'stay'),
+    ('Unravel', 'TK from 凛として時雨', 238, [
+        song('unravel', 'TK from Ling tosite sigure', 'unravel', 238),
+        song('Fantastic Magic', 'TK from Ling tosite sigure', 'fm', 280),
+        song('Unravel (Acoustic)', 'Cover Band', 'unravel_cover', 230),
+    ], 'unravel'),
+]
+
+
+def bench(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for title, artist, duration, results, _ in CASES:
+            fn(title, artist, duration, results)
+    elapsed = time.perf_counter() - start
+    return elapsed / (iterations * len(CASES)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    def run_legacy(title, artist, duration, results):
+        return legacy_best_match(title, artist, results)
+
+    def run_new(title, artist, duration, results):
+        return best_match(title, artist, results, duration=duration)
+
+    def run_new_cold(title, artist, duration, results):
+        normalize.cache_clear()
+        return best_match(title, artist, results, duration=duration)
+
+    print("=" * 60)
+    print("🎯 正解率")
+    for name, fn in (('legacy', run_legacy), ('matching', run_new)):
+        correct = 0
+        for title, artist, duration, results, expected in CASES:
+            item, _ = fn(title, artist, duration, results)
+            correct += bool(item and item['videoId'] == expected)
+        print(f"  {name:<16} {correct}/{len(CASES)}")
+
+    print("⏱️  1回あたりの処理時間")
+    for name, fn in (('legacy', run_legacy), ('matching', run_new), ('matching (cold)', run_new_cold)):
+        print(f"  {name:<16} {bench(fn, args.iterations):8.2f} µs")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
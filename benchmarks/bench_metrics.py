@@ -0,0 +1,104 @@
+"""
+メトリクス記録のコスト
+metrics.py のスレッド別カウンター・ヒストグラムと、ロックで守る素朴な実装を比較する
+（複数スレッドから同時に記録した場合の1件あたりの時間）
+
+使い方: python benchmarks/bench_metrics.py [--events 200000] [--threads 1,4,8]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import DEFAULT_BUCKETS, MetricsRegistry  # noqa: E402
+
+
+class LockedCounter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class LockedHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(DEFAULT_BUCKETS) + 1)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(DEFAULT_BUCKETS, value)] += 1
+            self.total += value
+
+
+def run(fn, events: int, threads: int) -> float:
+    """1件あたりのナノ秒"""
+    per_thread = events // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        barrier.wait()
+        for i in range(per_thread):
+            fn(0.003)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    return (time.perf_counter() - start) / (per_thread * threads) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--threads', default='1,4,8')
+    args = parser.parse_args()
+
+    registry = MetricsRegistry()
+    counter = registry.counter('bench_total', 'bench')
+    histogram = registry.histogram('bench_seconds', 'bench')
+    labelled = registry.counter('bench_labelled_total', 'bench', ('endpoint',))
+    locked_counter = LockedCounter()
+    locked_histogram = LockedHistogram()
+
+    cases = [
+        ('Counter.inc', lambda v: counter.inc()),
+        ('Counter.labels().inc', lambda v: labelled.labels('update').inc()),
+        ('Histogram.observe', histogram.observe),
+        ('locked counter', lambda v: locked_counter.inc()),
+        ('locked histogram', locked_histogram.observe),
+        ('(empty call)', lambda v: None),
+    ]
+
+    thread_counts = [int(t) for t in args.threads.split(',')]
+    print("=" * 72)
+    print(f"📈 {args.events} events (ns per event)")
+    print(f"{'case':<24}" + "".join(f"{f'{t} thr':>12}" for t in thread_counts))
+    for name, fn in cases:
+        row = [run(fn, args.events, t) for t in thread_counts]
+        print(f"{name:<24}" + "".join(f"{ns:>10.0f}ns" for ns in row))
+    print("(empty call) はループと関数呼び出しだけのコスト")
+    print("=" * 72)
+
+    # 記録漏れがないことの確認
+    expected = args.events // min(thread_counts) * min(thread_counts)
+    assert counter.value >= expected, counter.value
+    start = time.perf_counter()
+    registry.render()
+    print(f"🧾 render: {(time.perf_counter() - start) * 1e6:.0f}µs")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+サーバーモードの比較ベンチマーク（Waitress / ASGI）
+遅い画像検索を再現した状態で同時接続のクライアントから /update を送り、
+スループットと応答時間、負荷中の /health の応答時間を比較する
+
+使い方: python benchmarks/bench_server_modes.py [--clients 16] [--requests 20] [--search-latency 0.5]
+ASGIモードには uvicorn が必要（pip install uvicorn）
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from harness import SERVER_STARTERS, FakePresence, FakeYTMusic, free_port, import_server, install_fakes
+
+
+def request(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=30) as res:
+            res.read()
+    except urllib.error.HTTPError:
+        pass
+    return time.perf_counter() - start
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_load(port, clients, requests_per_client, tag):
+    base = f'http://127.0.0.1:{port}'
+    update_times = []
+    health_times = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def client(n):
+        for i in range(requests_per_client):
+            # モードごとに別の曲にする（前のモードで保存されたキャッシュに当たらないように）
+            elapsed = request(f'{base}/update', {
+                'title': f'Song {tag} {n}-{i}', 'artist': 'Artist',
+                'is_playing': True, 'duration': 200, 'position': 0
+            })
+            with lock:
+                update_times.append(elapsed)
+
+    def prober():
+        while not done.is_set():
+            elapsed = request(f'{base}/health')
+            with lock:
+                health_times.append(elapsed)
+            time.sleep(0.05)
+
+    probe = threading.Thread(target=prober)
+    probe.start()
+    workers = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    wall = time.perf_counter() - start
+    done.set()
+    probe.join()
+    return wall, update_times, health_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--search-latency', type=float, default=0.5)
+    parser.add_argument('--modes', default='waitress,asgi')
+    args = parser.parse_args()
+
+    server = import_server(ART_LOOKUP_TIMEOUT='0.2')
+    install_fakes(server, FakeYTMusic(latency=args.search_latency, decoys=0), FakePresence)
+    # /health のレート制限（10/minute）を超えた分は429が返るが、応答時間の計測にはそのまま使う
+
+    results = []
+    for mode in args.modes.split(','):
+        port = free_port()
+        stop = SERVER_STARTERS[mode](server, port)
+        with contextlib.redirect_stdout(io.StringIO()):
+            wall, updates, health = run_load(port, args.clients, args.requests, mode)
+        stop()
+        results.append((mode, wall, updates, health))
+
+    total = args.clients * args.requests
+    print("=" * 72)
+    print(f"👥 {args.clients} clients × {args.requests} requests, search latency {args.search_latency}s")
+    print(f"{'mode':<10} {'req/s':>8} {'update p50':>11} {'update p95':>11} {'health p50':>11} {'health p95':>11}")
+    for mode, wall, updates, health in results:
+        print(f"{mode:<10} {total / wall:>8.1f} "
+              f"{statistics.median(updates) * 1000:>9.1f}ms {percentile(updates, 95) * 1000:>9.1f}ms "
+              f"{statistics.median(health) * 1000:>9.1f}ms {percentile(health, 95) * 1000:>9.1f}ms")
+    print("=" * 72)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+複数ワーカー（WORKERS > 1）で共有する状態の負荷テスト
+同じ共有ストアを使うプロセスを増やしながら、1リクエストで行う共有ストアの操作
+（レート制限のカウント・端末の状態の読み書き・画像キャッシュの読み取り）の処理時間を計測する
+
+使い方: python benchmarks/bench_shared_state.py [--procs 1,2,4] [--ops 2000]
+"""
+
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from art_cache import ArtCache  # noqa: E402
+from sessions import SessionArbiter  # noqa: E402
+from shared_state import open_store  # noqa: E402
+
+SONGS = 200
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def worker(directory: str, worker_id: int, ops: int, start, results):
+    store = open_store(os.path.join(directory, 'shared.db'))
+    cache = ArtCache(os.path.join(directory, 'cache.db'), max_size=SONGS // 4, shared=True)
+    arbiter = SessionArbiter(store=store)
+    device = f'device-{worker_id}'
+    start.wait()
+
+    timings = []
+    for n in range(ops):
+        began = time.perf_counter()
+        store.incr(f'update/{device}', 60)
+        cache.get(f'song {n % SONGS}')
+        with arbiter.exclusive():
+            session = arbiter.session(device, time.time())
+            session.fields = {'title': f'song {n % SONGS}', 'position': n}
+            session.last_seen = time.time()
+            session.version = arbiter.next_version()
+            arbiter.elect(time.time())
+        timings.append(time.perf_counter() - began)
+    cache.close()
+    results.put(timings)
+
+
+def run(procs: int, ops: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ArtCache(os.path.join(directory, 'cache.db'), max_size=SONGS)
+        for n in range(SONGS):
+            cache.put(f'song {n}', f'https://example.com/{n}.jpg', f'video{n}')
+        cache.close()
+        open_store(os.path.join(directory, 'shared.db'))
+
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        children = [multiprocessing.Process(target=worker, args=(directory, n, ops, start, results))
+                    for n in range(procs)]
+        for child in children:
+            child.start()
+        time.sleep(0.5)
+        began = time.perf_counter()
+        start.set()
+        timings = [t for _ in children for t in results.get()]
+        wall = time.perf_counter() - began
+        for child in children:
+            child.join()
+
+    return {
+        'throughput': len(timings) / wall,
+        'p50_ms': statistics.median(timings) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--procs', default='1,2,4', help='プロセス数（カンマ区切り）')
+    parser.add_argument('--ops', type=int, default=2000, help='1プロセスあたりのリクエスト数')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"{'procs':>6} {'req/s':>10} {'p50':>10} {'p99':>10}")
+    for procs in (int(p) for p in args.procs.split(',')):
+        row = run(procs, args.ops)
+        print(f"{procs:>6} {row['throughput']:>10.0f} {row['p50_ms']:>8.3f}ms {row['p99_ms']:>8.3f}ms")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
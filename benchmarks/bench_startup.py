@@ -0,0 +1,109 @@
+"""
+起動時間の計測
+server.py を別プロセスで起動し、ポートが開くまでの時間と /health の startup_ms を表示する。
+あわせて python -X importtime で server.py が直接読み込むモジュールの読み込み時間を集計する
+
+使い方: python benchmarks/bench_startup.py [--runs 3] [--budget-ms 1500]
+  --budget-ms を指定すると、ポートが開くまでの時間（中央値）が超えた場合に終了コード1
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from harness import REPO_ROOT, free_port, wait_ready
+
+SERVER = os.path.join(REPO_ROOT, 'server.py')
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def server_env(port: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        'SERVER_HOST': '127.0.0.1',
+        'SERVER_PORT': str(port),
+        'CACHE_DB_PATH': '',
+        'PYTHONPATH': REPO_ROOT,
+    })
+    return env
+
+
+def measure_port_open(workdir: str) -> tuple[float, dict]:
+    """起動してからポートが開くまでの秒数と、/health の startup_ms"""
+    port = free_port()
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, SERVER], cwd=workdir, env=server_env(port),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port)
+        elapsed = time.perf_counter() - started
+        # YTMusicの用意（バックグラウンド）が終わるのを少し待ってから読む
+        time.sleep(0.5)
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=5) as res:
+            health = json.loads(res.read())
+        return elapsed, health.get('startup_ms', {})
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+def import_breakdown(workdir: str, top: int) -> list:
+    """server.py が直接読み込むモジュールを、読み込み時間（累積）の大きい順に"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import server'],
+        cwd=workdir, env=server_env(0), capture_output=True, text=True
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        # server の1段下（字下げ3文字）= server から直接読み込んだモジュール
+        if match and len(match.group(3)) == 3:
+            entries.append((int(match.group(2)) / 1000, match.group(4)))
+    return sorted(entries, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ytm-startup-')
+
+    samples = []
+    milestones = {}
+    for _ in range(args.runs):
+        elapsed, startup_ms = measure_port_open(workdir)
+        samples.append(elapsed * 1000)
+        for name, ms in startup_ms.items():
+            milestones.setdefault(name, []).append(ms)
+
+    port_open = statistics.median(samples)
+    print("=" * 72)
+    print(f"🚀 ポートが開くまで（プロセス起動から、{args.runs}回の中央値）: {port_open:.0f}ms")
+    print("⏱️  /health の startup_ms（server.py の読み込み開始から、中央値）:")
+    for name, values in sorted(milestones.items(), key=lambda item: statistics.median(item[1])):
+        print(f"   {name:<10} {statistics.median(values):>8.0f}ms")
+
+    print(f"📦 server.py が直接読み込むモジュール（上位{args.top}件、累積）:")
+    for ms, module in import_breakdown(workdir, args.top):
+        print(f"   {module:<28} {ms:>8.1f}ms")
+    print("=" * 72)
+
+    if args.budget_ms:
+        if port_open > args.budget_ms:
+            print(f"❌ 目標 {args.budget_ms:.0f}ms を超えています")
+            sys.exit(1)
+        print(f"✅ 目標 {args.budget_ms:.0f}ms 以内")
+
+
+if __name__ == '__main__':
+    main()
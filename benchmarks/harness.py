@@ -0,0 +1,246 @@
+"""
+ベンチマーク用の共通部品（ネットワーク不要）
+YTMusic と Discord RPC（pypresence.Presence）の代役と、ローカルでのサーバー起動
+"""
+
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+class Catalogue:
+    """決まった曲目のリスト（同じseedなら同じ曲・同じ長さ）"""
+
+    def __init__(self, size: int = 500, artists: int = 60, seed: int = 1):
+        rng = random.Random(seed)
+        self.songs = []
+        for i in range(size):
+            self.songs.append({
+                'title': f"Song {i:04d}",
+                'artist': f"Artist {i % artists:02d}",
+                'duration': rng.randint(120, 360),
+                'video_id': f"vid{i:08d}",
+            })
+        self._by_query = {f"{s['title']} {s['artist']}": s for s in self.songs}
+        self.by_artist = {}
+        for song in self.songs:
+            self.by_artist.setdefault(song['artist'], []).append(song)
+
+    def lookup(self, query: str):
+        return self._by_query.get(query)
+
+    def albums(self, artist: str, per_album: int = 4) -> list:
+        """アーティストの曲を per_album 曲ずつのアルバムに分けたもの"""
+        songs = self.by_artist.get(artist, [])
+        return [songs[i:i + per_album] for i in range(0, len(songs), per_album)]
+
+
+class FakeYTMusic:
+    """YTMusicの代役（search・get_watch_playlist・get_artist・get_album だけ）
+
+    latency秒（±jitter）待ってから、正解の曲と紛らわしい候補を返す。
+    failure_rateの割合で例外を投げる。
+    """
+
+    def __init__(self, catalogue: Catalogue | None = None, latency: float = 0.3, jitter: float = 0.0,
+                 failure_rate: float = 0.0, decoys: int = 4, seed: int = 2):
+        self.catalogue = catalogue or Catalogue()
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.decoys = decoys
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {'search': 0, 'get_watch_playlist': 0, 'get_artist': 0, 'get_album': 0, 'failures': 0}
+
+    def _wait_or_fail(self, call: str):
+        with self._lock:
+            self.calls[call] += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            fail = self._rng.random() < self.failure_rate
+            if fail:
+                self.calls['failures'] += 1
+        time.sleep(delay)
+        if fail:
+            raise ConnectionError(f"fake {call} failure")
+
+    def search(self, query, filter=None):
+        self._wait_or_fail('search')
+        song = self.catalogue.lookup(query)
+        title, artist = (song['title'], song['artist']) if song else query.rsplit(' ', 1)
+        duration = song['duration'] if song else 200
+
+        # 紛らわしい候補（カバー・ライブ版など）を先に並べる
+        results = [
+            self._item(f"{title} ({kind})", artist if n % 2 else f"{artist} Tribute", duration + 15 * (n + 1),
+                       f"decoy{n}")
+            for n, kind in zip(range(self.decoys), ('Live', 'Cover', 'Remix', 'Karaoke', 'Acoustic', 'Demo'))
+        ]
+        results.insert(len(results) // 2, self._item(title, artist, duration, song['video_id'] if song else 'video'))
+        return results
+
+    def get_watch_playlist(self, videoId=None, limit=25):
+        self._wait_or_fail('get_watch_playlist')
+        songs = self.catalogue.songs
+        start = next((i for i, s in enumerate(songs) if s['video_id'] == videoId), 0)
+        tracks = []
+        for s in songs[start:start + limit]:
+            track = self._item(s['title'], s['artist'], s['duration'], s['video_id'])
+            track['thumbnail'] = track.pop('thumbnails')
+            tracks.append(track)
+        return {'tracks': tracks}
+
+    def get_artist(self, channelId):
+        self._wait_or_fail('get_artist')
+        artist = channelId.removeprefix('UC-')
+        albums = [
+            {'title': f"Album {n}", 'browseId': f"MPRE-{n}-{artist}",
+             'thumbnails': [{'url': f"https://img.example/album/{artist}/{n}"}]}
+            for n in range(len(self.catalogue.albums(artist)))
+        ]
+        return {'name': artist, 'albums': {'results': albums}, 'singles': {'results': []}, 'songs': {'results': []}}
+
+    def get_album(self, browseId):
+        self._wait_or_fail('get_album')
+        _, n, artist = browseId.split('-', 2)
+        songs = self.catalogue.albums(artist)[int(n)]
+        tracks = []
+        for s in songs:
+            track = self._item(s['title'], s['artist'], s['duration'], s['video_id'])
+            track['thumbnails'] = None  # アルバムの曲にはサムネイルが付かない
+            tracks.append(track)
+        return {'title': f"Album {n}", 'thumbnails': [{'url': f"https://img.example/album/{artist}/{n}"}],
+                'tracks': tracks}
+
+    @staticmethod
+    def _item(title, artist, duration, video_id):
+        return {
+            'title': title,
+            'artists': [{'name': artist, 'id': f"UC-{artist}"}],
+            'duration_seconds': duration,
+            'thumbnails': [{'url': f"https://img.example/{video_id}/60"},
+                           {'url': f"https://img.example/{video_id}/544"}],
+            'videoId': video_id,
+        }
+
+
+class FakePresence:
+    """pypresence.Presence の代役（遅延と失敗を指定できる）"""
+
+    latency = 0.0
+    failure_rate = 0.0
+    updates = 0
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self._rng = random.Random(3)
+
+    @classmethod
+    def configure(cls, latency: float = 0.0, failure_rate: float = 0.0):
+        """設定を変えたクラスを作る（presence_factoryとして渡す）"""
+        return type('FakePresence', (cls,), {'latency': latency, 'failure_rate': failure_rate})
+
+    def connect(self):
+        pass
+
+    def update(self, **kwargs):
+        time.sleep(self.latency)
+        if self._rng.random() < self.failure_rate:
+            raise ConnectionError("fake RPC failure")
+        type(self).updates += 1
+
+    def clear(self):
+        time.sleep(self.latency)
+
+    def close(self):
+        pass
+
+
+def import_server(**env):
+    """代役を使う前提の設定で server.py を読み込む
+
+    キャッシュはメモリのみ、レート制限・YouTube Musicの問い合わせ予算は実質なし、ログは警告以上をコンソールだけに出す（envで上書き可）。
+    """
+    defaults = {
+        'CACHE_DB_PATH': '',
+        'YTMUSIC_RATE': '0',
+        'LOG_LEVEL': 'WARNING',
+        'LOG_FILE': '',
+        'RATE_LIMIT_UPDATE': '1000000/minute',
+        'RATE_LIMIT_DEFAULT': '1000000/minute',
+    }
+    defaults.update(env)
+    for key, value in defaults.items():
+        os.environ.setdefault(key, str(value))
+
+    import server
+    return server
+
+
+def install_fakes(server, yt=None, presence_factory=None):
+    """server の YTMusic と Discord RPC を代役に差し替え、送信スレッドを起動"""
+    server.yt = yt or FakeYTMusic()
+    server.presence_writer._presence_factory = presence_factory or FakePresence
+    server.presence_writer.start()
+    # 初回接続が終わるまで待つ
+    for _ in range(100):
+        if server.presence_writer.connected:
+            break
+        time.sleep(0.01)
+    return server
+
+
+# ----------------------------------------
+#  ローカルでのサーバー起動
+# ----------------------------------------
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port: int):
+    for _ in range(100):
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("サーバーが起動しませんでした")
+
+
+def start_waitress(server, port: int):
+    """Waitressを別スレッドで起動し、停止用の関数を返す"""
+    from waitress.server import create_server
+    srv = create_server(server.app, host='127.0.0.1', port=port)
+    thread = threading.Thread(target=srv.run, daemon=True)
+    thread.start()
+    wait_ready(port)
+    return srv.close
+
+
+def start_asgi(server, port: int):
+    """ASGIモード（uvicorn）を別スレッドで起動し、停止用の関数を返す"""
+    import uvicorn
+    from asgi_server import AsgiApp
+    config = uvicorn.Config(AsgiApp(server, art_timeout=server.ART_LOOKUP_TIMEOUT),
+                            host='127.0.0.1', port=port, log_level='error', server_header=False)
+    srv = uvicorn.Server(config)
+    thread = threading.Thread(target=srv.run, daemon=True)
+    thread.start()
+    wait_ready(port)
+
+    def stop():
+        srv.should_exit = True
+        thread.join(5)
+    return stop
+
+
+SERVER_STARTERS = {'waitress': start_waitress, 'asgi': start_asgi}
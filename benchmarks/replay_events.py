@@ -0,0 +1,187 @@
+"""
+イベントログの再生（EVENT_LOG_PATH で記録したログを使う）
+記録されたイベントを代役のYTMusic・Discordで本物の処理（/update・/pause）に流し直し、
+判定結果（スキップ・シーク・新しい曲・キャッシュヒット・待機）と処理時間を記録時と比較する
+イベントは記録された端末ID（X-Device-Id）で送る（端末IDのない古い形式のログは1台として再生する）
+/update/batch は記録された中身（seq・発生時刻）のまま /update/batch に送る
+（中身のない古い形式のログは、畳み込んだ最後の状態を /update として送る）
+
+server.py の time.time() は記録された受信時刻を返すように差し替えるため、
+再生速度に関係なく、シーク検知などの判定は記録時と同じ時刻の流れで行われる。
+
+使い方:
+  python benchmarks/replay_events.py events.log [--speed 1|10|0] [--out replay.log] [--cache-db album_art_cache.db]
+  python benchmarks/replay_events.py --compare before.log after.log   # 2つのログ（別ビルドでの再生結果など）を比較
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time as _time
+
+from harness import FakePresence, FakeYTMusic, import_server, install_fakes
+
+from event_log import (  # noqa: E402  (harness がリポジトリのルートを sys.path に追加する)
+    FLAG_CACHE_HIT, FLAG_NEW_SONG, FLAG_PLAYING, FLAG_SEEKED, FLAG_SKIPPED, FLAG_STANDBY,
+    KIND_BATCH, KIND_BATCH_EVENT, KIND_NAMES, KIND_PAUSE, describe_flags, read_events
+)
+
+COMPARED_FLAGS = {
+    'skipped': FLAG_SKIPPED, 'seeked': FLAG_SEEKED, 'new_song': FLAG_NEW_SONG, 'cache_hit': FLAG_CACHE_HIT,
+    'standby': FLAG_STANDBY,
+}
+
+
+class VirtualClock:
+    """time モジュールの代わり（time() だけ指定した時刻を返す）"""
+
+    def __init__(self):
+        self.now = None
+
+    def time(self) -> float:
+        return self.now if self.now is not None else _time.time()
+
+    def __getattr__(self, name):
+        return getattr(_time, name)
+
+
+def replay(events: list, out_path: str, speed: float, search_latency: float, cache_db: str):
+    """イベントを順に流し、再生結果のログを out_path に書く"""
+    env = {'EVENT_LOG_PATH': out_path}
+    if cache_db:
+        # 記録時のキャッシュを再現（元のファイルは変更しない）
+        copy = os.path.join(os.path.dirname(out_path), 'replay_cache.db')
+        shutil.copyfile(cache_db, copy)
+        env['CACHE_DB_PATH'] = copy
+
+    server = import_server(**env)
+    install_fakes(server, FakeYTMusic(latency=search_latency), FakePresence)
+    clock = VirtualClock()
+    server.time = clock
+    client = server.app.test_client()
+
+    started = _time.perf_counter()
+    first_arrival = events[0]['arrival'] if events else 0
+    batch_events = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for event in events:
+            if event['kind'] == KIND_BATCH_EVENT:
+                batch_events.append(event)  # 続く KIND_BATCH でまとめて送る
+                continue
+
+            # 記録時の間隔を speed 倍速で再現（0なら待たない）
+            if speed > 0:
+                due = (event['arrival'] - first_arrival) / speed
+                wait = due - (_time.perf_counter() - started)
+                if wait > 0:
+                    _time.sleep(wait)
+
+            clock.now = event['arrival']
+            headers = {'X-Device-Id': event['device']} if event['device'] else {}
+            if event['kind'] == KIND_PAUSE:
+                client.post('/pause', json={}, headers=headers)
+            elif event['kind'] == KIND_BATCH and batch_events:
+                # 発生時刻は送信時刻（記録時の受信時刻）との差として届く
+                client.post('/update/batch', json={
+                    'stream': event['stream'],
+                    'sent_at': event['arrival'],
+                    'events': [payload(e, seq=e['seq'], ts=e['arrival']) for e in batch_events],
+                }, headers=headers)
+                batch_events = []
+            else:
+                # 中身のない古い形式のログの /update/batch は、畳み込んだ最後の状態を /update として流す
+                client.post('/update', json=payload(event), headers=headers)
+
+    wall = _time.perf_counter() - started
+    server.event_log.flush()
+    return wall
+
+
+def payload(event: dict, **extra) -> dict:
+    """記録されたイベントの再生情報（/update・/update/batch の1件）"""
+    return dict(extra, **{
+        'title': event['title'],
+        'artist': event['artist'],
+        'is_playing': bool(event['flags'] & FLAG_PLAYING),
+        'duration': event['duration'],
+        'position': event['position'],
+    })
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def compare(before: list, after: list, show: int = 10):
+    """2つのログの判定結果と処理時間を比較して表示"""
+    pairs = list(zip(before, after))
+    mismatches = {name: 0 for name in COMPARED_FLAGS}
+    examples = []
+    for i, (a, b) in enumerate(pairs):
+        differs = False
+        for name, bit in COMPARED_FLAGS.items():
+            if (a['flags'] & bit) != (b['flags'] & bit):
+                mismatches[name] += 1
+                differs = True
+        if differs and len(examples) < show:
+            examples.append((i, a, b))
+
+    print("=" * 72)
+    print(f"🔁 {len(before)} → {len(after)} events, {len(pairs)} compared")
+    for name, count in mismatches.items():
+        mark = '✅' if count == 0 else '❌'
+        print(f"{mark} {name:<10} {count} mismatches")
+    for i, a, b in examples:
+        print(f"   #{i} {KIND_NAMES.get(a['kind'], a['kind'])} {a['title']} - {a['artist']}: "
+              f"{describe_flags(a['flags'])} → {describe_flags(b['flags'])}")
+
+    print(f"{'log':<8} {'p50':>10} {'p95':>10} {'p99':>10}")
+    for label, events in (('before', before), ('after', after)):
+        elapsed = [e['elapsed'] for e in events if e['kind'] != KIND_BATCH_EVENT]  # 一括の中身は処理時間なし
+        if elapsed:
+            print(f"{label:<8} {statistics.median(elapsed) * 1000:>8.2f}ms "
+                  f"{percentile(elapsed, 95) * 1000:>8.2f}ms {percentile(elapsed, 99) * 1000:>8.2f}ms")
+    print("=" * 72)
+    return sum(mismatches.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', nargs='?', help='再生するイベントログ')
+    parser.add_argument('--speed', type=float, default=0, help='再生速度（1で記録時と同じ間隔、0で待たない）')
+    parser.add_argument('--out', help='再生結果のログの保存先（省略時は一時ファイル）')
+    parser.add_argument('--search-latency', type=float, default=0.0)
+    parser.add_argument('--cache-db', help='記録時のキャッシュDB（キャッシュヒットを再現する場合）')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='2つのログを比較するだけ')
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = (list(read_events(path)) for path in args.compare)
+        sys.exit(1 if compare(before, after) else 0)
+
+    if not args.log:
+        parser.error("再生するイベントログを指定してください")
+
+    events = list(read_events(args.log))
+    if not events:
+        print("イベントがありません")
+        return
+
+    workdir = tempfile.mkdtemp(prefix='ytm-replay-')
+    out_path = os.path.abspath(args.out) if args.out else os.path.join(workdir, 'replay.log')
+    if os.path.exists(out_path):
+        os.remove(out_path)
+
+    wall = replay(events, out_path, args.speed, args.search_latency, args.cache_db)
+    print(f"▶️ {len(events)} events replayed in {wall:.2f}s (speed {args.speed or 'max'}) → {out_path}")
+    compare(events, list(read_events(out_path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+アーティスト単位の曲目インデックス
+一度画像が見つかったアーティストのアルバム・シングルの曲目をまとめて取得しておき、
+同じアーティストの別の曲は検索せずにメモリ上で画像を引く
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from matching import DURATION_TOLERANCE, normalize
+
+
+class ArtistCatalogue:
+    """アーティストごとの「正規化した曲名 → (画像URL, videoId, 再生時間)」の索引
+
+    アーティストは最後に使った順に並べ、max_artistsを超えたら古いものから捨てる。
+    取得からttl秒を過ぎたアーティストは引き続き使いながら、取得し直しの対象にする。
+    """
+
+    def __init__(self, max_artists: int = 100, ttl: float = 7 * 24 * 3600, max_tracks: int = 2000):
+        self.max_artists = max(1, max_artists)
+        self.ttl = ttl
+        self.max_tracks = max_tracks
+        self._artists = OrderedDict()  # artist_key -> (tracks, fetched_at, channel_id)
+        self._filling = set()  # 取得中のartist_key
+        self._lock = threading.Lock()
+        self.stats = {'fills': 0, 'fill_errors': 0, 'evictions': 0}
+
+    @staticmethod
+    def artist_key(artist: str) -> str:
+        return normalize(artist)
+
+    def lookup(self, title: str, artist: str, duration: float = 0) -> tuple[str, str] | None:
+        """索引から曲を引く（なければNone）。再生時間が分かっていれば大きく違う版は除く"""
+        if not self._artists:
+            return None
+        key = self.artist_key(artist)
+        with self._lock:
+            entry = self._artists.get(key)
+            if entry is None:
+                return None
+            self._artists.move_to_end(key)
+            candidates = entry[0].get(normalize(title))
+
+        for image, video_id, track_duration in candidates or ():
+            if not duration or not track_duration or abs(track_duration - duration) <= DURATION_TOLERANCE:
+                return image, video_id
+        return None
+
+    def _stale(self, entry) -> bool:
+        return self.ttl > 0 and time.time() - entry[1] >= self.ttl
+
+    def begin_fill(self, artist: str) -> bool:
+        """取得が必要なら取得中として印を付けてTrue（未取得・期限切れで、取得中でない場合）"""
+        key = self.artist_key(artist)
+        if not key:
+            return False
+        with self._lock:
+            if key in self._filling:
+                return False
+            entry = self._artists.get(key)
+            if entry is not None and not self._stale(entry):
+                return False
+            self._filling.add(key)
+            return True
+
+    def begin_refresh(self, artist: str) -> str | None:
+        """索引済みで期限切れなら取得中の印を付け、取得に使うチャンネルIDを返す"""
+        key = self.artist_key(artist)
+        with self._lock:
+            entry = self._artists.get(key)
+            if entry is None or key in self._filling or not self._stale(entry):
+                return None
+            self._filling.add(key)
+            return entry[2]
+
+    def store(self, artist: str, tracks: list, channel_id: str):
+        """取得した曲目（(曲名, 画像URL, videoId, 再生時間) のリスト）で置き換える"""
+        key = self.artist_key(artist)
+        index = {}
+        for title, image, video_id, duration in tracks[:self.max_tracks]:
+            index.setdefault(normalize(title), []).append((image, video_id, duration or 0))
+
+        with self._lock:
+            self._filling.discard(key)
+            self._artists[key] = (index, time.time(), channel_id)
+            self._artists.move_to_end(key)
+            while len(self._artists) > self.max_artists:
+                self._artists.popitem(last=False)
+                self.stats['evictions'] += 1
+            self.stats['fills'] += 1
+
+    def fail_fill(self, artist: str):
+        """取得に失敗した（次に同じアーティストが見つかった時に取得し直す）"""
+        with self._lock:
+            self._filling.discard(self.artist_key(artist))
+            self.stats['fill_errors'] += 1
+
+    def __len__(self) -> int:
+        return len(self._artists)
+
+    def track_count(self) -> int:
+        with self._lock:
+            return sum(len(entry[0]) for entry in self._artists.values())
+
+    def health(self) -> dict:
+        return dict(self.stats, artists=len(self._artists), tracks=self.track_count(),
+                    filling=len(self._filling))
@@ -0,0 +1,160 @@
+"""
+受信イベントの記録（追記のみのバイナリログ）
+受け付けた /update・/update/batch（中身の各イベントも）・/pause と送った端末、
+その判定結果（スキップ・シーク・新しい曲・キャッシュヒット・待機）を残し、
+benchmarks/replay_events.py で同じ流れを再生できるようにする
+"""
+
+import os
+import struct
+import threading
+
+MAGIC = b'YTMEVLG3'
+
+# 種類
+KIND_UPDATE = 1
+KIND_PAUSE = 2
+KIND_BATCH = 3  # /update/batch（畳み込んだ最後の状態。直前に中身のイベントを KIND_BATCH_EVENT で記録）
+KIND_BATCH_EVENT = 4  # /update/batch の中の1件（受信時刻は発生時刻をサーバーの時刻に直したもの）
+KIND_NAMES = {KIND_UPDATE: 'update', KIND_PAUSE: 'pause', KIND_BATCH: 'batch', KIND_BATCH_EVENT: 'batch_event'}
+
+# 判定結果のビット
+FLAG_SKIPPED = 1
+FLAG_SEEKED = 2
+FLAG_NEW_SONG = 4
+FLAG_CACHE_HIT = 8
+FLAG_PLAYING = 16
+FLAG_LOOKUP_PENDING = 32
+FLAG_STANDBY = 64  # 別の端末が表示中で、この端末の状態は覚えておくだけ
+FLAG_NAMES = {
+    FLAG_SKIPPED: 'skipped', FLAG_SEEKED: 'seeked', FLAG_NEW_SONG: 'new_song',
+    FLAG_CACHE_HIT: 'cache_hit', FLAG_PLAYING: 'is_playing', FLAG_LOOKUP_PENDING: 'lookup_pending',
+    FLAG_STANDBY: 'standby',
+}
+
+# レコード: 長さ(I) 受信時刻(d) 種類(B) 判定(B) 曲の長さ(f) 再生位置(f) 処理時間µs(I) シーケンス番号(q)
+#           曲名長(H) アーティスト長(H) 端末ID長(H) ストリーム長(H) + 文字列
+_LENGTH = struct.Struct('<I')
+_RECORD = struct.Struct('<dBBffIqHHHH')
+# 古い形式（読むだけ。シーケンス番号・ストリームがなく、v1は端末IDもない）
+_OLD_RECORDS = {b'YTMEVLG1': struct.Struct('<dBBffIHH'), b'YTMEVLG2': struct.Struct('<dBBffIHHH')}
+
+
+class EventLogWriter:
+    """イベントを追記する（書き込みはバッファに溜め、flush()でディスクへ）
+
+    既存のファイルが古い形式なら <path>.old に移して新しく始める。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    os.replace(path, path + '.old')
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab', buffering=64 * 1024)
+        if new_file:
+            self._file.write(MAGIC)
+        self.records = 0
+        self.dirty = False
+
+    def append(self, arrival: float, kind: int, flags: int, title: str = '', artist: str = '',
+               duration: float = 0, position: float = 0, elapsed: float = 0, device: str = '',
+               seq: int = 0, stream: str = ''):
+        texts = [text.encode('utf-8')[:0xFFFF] for text in (title, artist, device, stream)]
+        body = _RECORD.pack(
+            arrival, kind, flags, duration, position,
+            min(int(elapsed * 1_000_000), 0xFFFFFFFF),
+            max(-2 ** 63, min(seq, 2 ** 63 - 1)),
+            *map(len, texts)
+        ) + b''.join(texts)
+
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(_LENGTH.pack(len(body)) + body)
+            self.records += 1
+            self.dirty = True
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None and self.dirty:
+                self._file.flush()
+                self.dirty = False
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_events(path: str):
+    """ログを先頭から読み、イベントの辞書を順に返す（途中で切れた最後のレコードは無視）
+
+    古い形式のログは、ない項目を空（端末IDは既定の1台、シーケンス番号は0）として読む。
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        record = _RECORD if magic == MAGIC else _OLD_RECORDS.get(magic)
+        if record is None:
+            raise ValueError(f"イベントログではありません: {path}")
+
+        while True:
+            header = f.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                return
+            (length,) = _LENGTH.unpack(header)
+            body = f.read(length)
+            if len(body) < length or length < record.size:
+                return
+
+            arrival, kind, flags, duration, position, elapsed_us, *rest = record.unpack_from(body)
+            seq, *lengths = rest if record is _RECORD else (0, *rest)
+            offset = record.size
+            texts = []
+            for text_len in lengths:
+                texts.append(body[offset:offset + text_len].decode('utf-8', errors='replace'))
+                offset += text_len
+            title, artist, device, stream = (texts + [''] * 4)[:4]
+
+            yield {
+                'arrival': arrival,
+                'kind': kind,
+                'flags': flags,
+                'title': title,
+                'artist': artist,
+                'duration': duration,
+                'position': position,
+                'elapsed': elapsed_us / 1_000_000,
+                'device': device,
+                'seq': seq,
+                'stream': stream,
+            }
+
+
+def decision_flags(decision: dict, is_playing: bool = True, cache_hit: bool = False,
+                   lookup_pending: bool = False, standby: bool = False) -> int:
+    """判定結果をビットにまとめる"""
+    flags = 0
+    if decision.get('skipped'):
+        flags |= FLAG_SKIPPED
+    if decision.get('seeked'):
+        flags |= FLAG_SEEKED
+    if decision.get('new_song'):
+        flags |= FLAG_NEW_SONG
+    if cache_hit:
+        flags |= FLAG_CACHE_HIT
+    if is_playing:
+        flags |= FLAG_PLAYING
+    if lookup_pending:
+        flags |= FLAG_LOOKUP_PENDING
+    if standby:
+        flags |= FLAG_STANDBY
+    return flags
+
+
+def describe_flags(flags: int) -> str:
+    return ','.join(name for bit, name in FLAG_NAMES.items() if flags & bit) or '-'
@@ -0,0 +1,128 @@
+"""
+/update のボディの読み込みと検証
+本文のデコード（JSON、Content-Type が MessagePack ならMessagePack）と、
+再生情報の検証・サニタイズを1回の走査で行う（正規表現は読み込み時にコンパイルし、制御文字のない文字列は通さない）
+
+orjson があればJSONのデコードに使い、MessagePackは msgpack がある場合だけ受け付ける（どちらも任意）
+"""
+
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_TYPES = frozenset({'application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack'})
+
+MAX_TEXT_LENGTH = 100  # 曲名・アーティスト名の最大文字数
+MAX_SECONDS = 86400  # 再生時間・再生位置の上限（24時間）
+DEFAULT_TITLE = "Unknown Title"
+DEFAULT_ARTIST = "Unknown Artist"
+
+# 制御文字（改行・タブは許容）
+_CONTROL_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+
+class UnsupportedFormat(ValueError):
+    """受け付けない本文の形式（MessagePackを送られたが msgpack がないなど）"""
+
+
+def body_formats() -> list:
+    """受け付ける本文の形式"""
+    names = ['json+orjson' if orjson is not None else 'json']
+    if msgpack is not None:
+        names.append('msgpack')
+    return names
+
+
+def decode_json(body: bytes | str):
+    """JSONをデコード（不正ならValueError）"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def decode_body(body: bytes, content_type: str | None = None):
+    """リクエストの本文をデコード（Content-Type が MessagePack ならMessagePack、それ以外はJSON）
+
+    不正な本文は ValueError、受け付けない形式は UnsupportedFormat。
+    """
+    if content_type:
+        media_type = content_type.split(';', 1)[0].strip().lower()
+        if media_type in MSGPACK_TYPES:
+            return decode_msgpack(body)
+    return decode_json(body)
+
+
+def decode_frame(frame: bytes | str):
+    """WebSocketのメッセージをデコード（テキストはJSON、バイナリは先頭がMessagePackのマップならMessagePack）"""
+    if type(frame) is str:
+        return decode_json(frame)
+    if frame and (0x80 <= frame[0] <= 0x8f or frame[0] in (0xde, 0xdf)):
+        return decode_msgpack(frame)
+    return decode_json(frame)
+
+
+def decode_msgpack(body: bytes):
+    if msgpack is None:
+        raise UnsupportedFormat("msgpack is not installed")
+    try:
+        return msgpack.unpackb(body, raw=False)
+    except Exception as e:
+        raise ValueError(f"invalid msgpack: {e}") from None
+
+
+def clean_text(value, max_length: int = 200) -> str:
+    """文字列をサニタイズ（長さ制限、制御文字の除去、前後の空白の除去）"""
+    if type(value) is not str:
+        value = str(value)
+    value = value[:max_length]
+    # 表示できる文字だけなら正規表現を通さない（isprintable() は制御文字・改行・タブでFalse）
+    if not value.isprintable():
+        value = _CONTROL_CHARS.sub('', value)
+    return value.strip()
+
+
+def clamp_number(value, default: float = 0, min_val: float = 0, max_val: float = float('inf')) -> float:
+    """数値を範囲内に収める（数値でない・NaNならdefault）"""
+    try:
+        num = float(value)
+    except (ValueError, TypeError):
+        return default
+    if num != num:
+        return default
+    if num < min_val:
+        return min_val
+    if num > max_val:
+        return max_val
+    return num
+
+
+def parse_update(data) -> dict | None:
+    """/update のボディ（デコード済み）を検証・サニタイズ（不正ならNone）"""
+    if not data or type(data) is not dict:
+        return None
+
+    get = data.get
+    title = clean_text(get('title', DEFAULT_TITLE), MAX_TEXT_LENGTH)
+    artist = clean_text(get('artist', DEFAULT_ARTIST), MAX_TEXT_LENGTH)
+    # 空なら既定の名前、1文字なら空白を足して2文字にする（Discordは2文字未満を受け付けない）
+    if len(title) < 2:
+        title = title + " " if title else DEFAULT_TITLE
+    if len(artist) < 2:
+        artist = artist + " " if artist else DEFAULT_ARTIST
+
+    return {
+        'title': title,
+        'artist': artist,
+        'is_playing': bool(get('is_playing', True)),
+        'duration': clamp_number(get('duration', 0), max_val=MAX_SECONDS),
+        'position': clamp_number(get('position', 0), max_val=MAX_SECONDS),
+    }
@@ -0,0 +1,89 @@
+"""
+IPアドレス許可リスト
+CIDR表記（IPv4/IPv6）に対応し、登録数に関係なく一定時間で判定する
+"""
+
+import ipaddress
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class IPAllowList:
+    """CIDRブロックの許可リスト
+
+    起動時にネットワークをプレフィックス長ごとの集合へ変換しておき、
+    判定時はプレフィックス長ごとに上位ビットを取り出して集合を引くだけにする。
+    プレフィックス長の種類はIPv4で最大33、IPv6で最大129なので、
+    判定コストは登録したブロック数に依存しない。
+    """
+
+    RECENT_MAX = 4096  # 判定結果を覚えておくIP数
+
+    def __init__(self, networks=()):
+        self._recent = {}  # ip -> 判定結果
+        self._v4 = {}  # prefixlen -> {上位ビット}
+        self._v6 = {}
+        self._count = 0
+
+        v4 = [n for n in networks if n.version == 4]
+        v6 = [n for n in networks if n.version == 6]
+        for table, nets, bits in ((self._v4, v4, 32), (self._v6, v6, 128)):
+            # 重複・包含関係にあるブロックはまとめる
+            for net in ipaddress.collapse_addresses(nets):
+                shift = bits - net.prefixlen
+                table.setdefault(net.prefixlen, set()).add(int(net.network_address) >> shift)
+                self._count += 1
+
+        # 短いプレフィックス（広い範囲）から順に調べる
+        self._v4_lookup = [(32 - plen, table) for plen, table in sorted(self._v4.items())]
+        self._v6_lookup = [(128 - plen, table) for plen, table in sorted(self._v6.items())]
+
+    @classmethod
+    def parse(cls, text: str) -> 'IPAllowList':
+        """カンマ区切りのIP・CIDR文字列から作成（不正な値は警告して無視）"""
+        networks = []
+        for entry in text.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            try:
+                networks.append(ipaddress.ip_network(entry, strict=False))
+            except ValueError:
+                logger.warning("⚠️ ALLOWED_IPS の不正な値を無視します: %s", entry)
+        return cls(networks)
+
+    def __contains__(self, ip: str) -> bool:
+        result = self._recent.get(ip)
+        if result is None:
+            result = self._lookup(ip)
+            # 同じクライアントからの連続アクセスは結果を使い回す
+            if len(self._recent) >= self.RECENT_MAX:
+                self._recent.clear()
+            self._recent[ip] = result
+        return result
+
+    def _lookup(self, ip: str) -> bool:
+        try:
+            addr = ipaddress.IPv6Address(ip) if ':' in ip else ipaddress.IPv4Address(ip)
+        except ValueError:
+            return False
+
+        if addr.version == 6:
+            value = int(addr)
+            if any((value >> shift) in table for shift, table in self._v6_lookup):
+                return True
+            # IPv4射影アドレス（::ffff:192.0.2.1）はIPv4としても判定
+            # （::ffff:192.168.0.0/120 のようにIPv6で書いた範囲は上のIPv6の表で判定済み）
+            addr = addr.ipv4_mapped
+            if addr is None:
+                return False
+
+        value = int(addr)
+        return any((value >> shift) in table for shift, table in self._v4_lookup)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __bool__(self) -> bool:
+        return self._count > 0
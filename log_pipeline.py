@@ -0,0 +1,83 @@
+"""
+ログの非同期出力
+ログはキューに積むだけにして、コンソール・ファイルへの書き込みは専用スレッドで行う（リクエスト処理でI/Oを待たない）。
+ファイルはJSON Lines（1行1レコード）で、サイズか経過時間のどちらかが上限を超えたらローテーションする
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# LogRecordが元から持つ属性（これ以外は extra= で渡された項目としてJSONに含める）
+_STANDARD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+def parse_level(name: str) -> int:
+    """LOG_LEVEL の値（DEBUG / INFO / WARNING / ERROR）をレベルに変換（不正ならINFO）"""
+    level = logging.getLevelName(name.strip().upper())
+    return level if isinstance(level, int) else logging.INFO
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする（extra= で渡した計測値などもそのまま含める）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RotatingLogFile(logging.handlers.RotatingFileHandler):
+    """サイズ（max_bytes）か経過時間（interval秒）のどちらかが上限を超えたらローテーションする
+
+    古いファイルは path.1, path.2, ... の順に backup_count 個まで残す。
+    """
+
+    def __init__(self, path: str, max_bytes: int = 0, interval: float = 0, backup_count: int = 5):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval > 0 else float('inf')
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval > 0:
+            self.rollover_at = time.time() + self.interval
+
+
+def start_logging(level: int, path: str = '', max_bytes: int = 0, interval: float = 0,
+                  backup_count: int = 5) -> logging.handlers.QueueListener:
+    """ルートロガーをキュー経由にして書き込みスレッドを開始する（終了時に stop() を呼ぶ）"""
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    handlers = [console]
+    if path:
+        log_file = RotatingLogFile(path, max_bytes, interval, backup_count)
+        log_file.setFormatter(JsonFormatter())
+        handlers.append(log_file)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
@@ -0,0 +1,150 @@
+"""
+検索結果のマッチング
+曲名・アーティスト名を正規化し、YouTube Musicの検索結果から最適な候補を選ぶ
+"""
+
+import re
+import unicodedata
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+# 採用する最低スコア
+MATCH_THRESHOLD = 0.5
+# 曲名の類似度がこれ未満の候補は（アーティストが一致していても）別の曲とみなす
+MIN_TITLE_SCORE = 0.4
+# このスコア差以内の候補は同点とみなし、再生時間の近さで選ぶ
+TIE_MARGIN = 0.05
+# 再生時間がこの秒数以内なら一致とみなす
+DURATION_TOLERANCE = 5
+
+# 括弧内の不要な表記（(Official Video) 【MV】 など）
+_NOISE_WORDS = (
+    r'official|video|audio|music\s*video|lyrics?|visuali[sz]er|mv|pv|hd|hq|4k|'
+    r'full\s*ver(?:sion|\.)?|公式|歌詞|フル'
+)
+_BRACKET_NOISE = re.compile(
+    r'[\(\[【（［〔「『]\s*(?:(?:' + _NOISE_WORDS + r')[\s\-/・]*)+[\)\]】）］〕」』]',
+    re.IGNORECASE
+)
+# feat. クレジット（括弧付き・括弧なし）
+_FEAT = re.compile(
+    r'[\(\[（［]\s*(?:feat\.?|ft\.?|featuring|with)\s[^\)\]）］]*[\)\]）］]'
+    r'|\s(?:feat\.?|ft\.?|featuring)\s.*$',
+    re.IGNORECASE
+)
+# 記号は空白に置き換える
+_PUNCT = re.compile(r'[^\w\s]+')
+_SPACES = re.compile(r'\s+')
+# 日本語・中国語・韓国語の文字（空白で区切られないため2文字単位でも比較する）
+_CJK = re.compile(r'[぀-ヿ㐀-鿿가-힯]')
+
+
+@lru_cache(maxsize=4096)
+def normalize(s: str) -> str:
+    """比較用に文字列を正規化（全角→半角、小文字化、不要表記の除去）"""
+    s = unicodedata.normalize('NFKC', s).casefold()
+    s = _BRACKET_NOISE.sub(' ', s)
+    s = _FEAT.sub(' ', s)
+    s = _PUNCT.sub(' ', s)
+    return _SPACES.sub(' ', s).strip()
+
+
+def tokens(s: str) -> frozenset:
+    """正規化済み文字列のトークン集合（CJKは2文字単位も含める）"""
+    words = s.split()
+    result = set(words)
+    if _CJK.search(s):
+        for word in words:
+            result.update(word[i:i + 2] for i in range(len(word) - 1))
+    return frozenset(result)
+
+
+def _artist_names(item: dict) -> tuple[str, str]:
+    """検索結果のアーティスト名（先頭・全員）を返す"""
+    artists = item.get('artists') or []
+    names = [a.get('name', '') for a in artists if a.get('name')]
+    if not names:
+        return '', ''
+    return names[0], ' '.join(names)
+
+
+class _Scorer:
+    """1回の検索で使い回す比較器（クエリ側は一度だけ前処理する）"""
+
+    def __init__(self, text: str):
+        self.text = normalize(text)
+        self.tokens = tokens(self.text)
+        self._matcher = SequenceMatcher(None, autojunk=False)
+        self._matcher.set_seq2(self.text)
+
+    def upper_bound(self, other: str) -> float:
+        """類似度の上限（文字の出現回数だけで計算する安価な見積もり）"""
+        self._matcher.set_seq1(other)
+        return self._matcher.quick_ratio()
+
+    def ratio(self) -> float:
+        """直前にupper_boundへ渡した文字列との類似度"""
+        return self._matcher.ratio()
+
+    def score(self, other: str) -> float:
+        """類似度（完全一致は比較を省略）"""
+        if other == self.text:
+            return 1.0
+        self._matcher.set_seq1(other)
+        return self._matcher.ratio()
+
+
+def best_match(title: str, artist: str, results: list, duration: float = 0,
+               threshold: float = MATCH_THRESHOLD) -> tuple[dict | None, float]:
+    """検索結果から最も一致する候補とそのスコアを返す（見つからなければNone）"""
+    title_scorer = _Scorer(title)
+    artist_scorer = _Scorer(artist)
+
+    scored = []
+    best_score = 0.0
+
+    for item in results:
+        res_title = normalize(item.get('title') or '')
+        first_artist, all_artists = _artist_names(item)
+        res_artist = normalize(first_artist)
+        res_duration = item.get('duration_seconds') or 0
+
+        # 正規化後に完全一致（再生時間も矛盾しない）なら即決定
+        if res_title == title_scorer.text and res_artist == artist_scorer.text:
+            if not duration or not res_duration or abs(res_duration - duration) <= DURATION_TOLERANCE:
+                return item, 1.0
+
+        # 安価な事前判定: 文字構成から見た類似度の上限で、明らかに別の曲・勝ち目のない候補を除外
+        title_bound = title_scorer.upper_bound(res_title)
+        if title_bound < MIN_TITLE_SCORE or (title_bound + 1.0) / 2 < best_score - TIE_MARGIN:
+            continue
+        # トークンが1つも重ならない候補は、上限が十分高い場合だけ詳しく比較する
+        if not (tokens(res_title) & title_scorer.tokens) and title_bound < 0.8:
+            continue
+
+        title_score = 1.0 if res_title == title_scorer.text else title_scorer.ratio()
+        if title_score < MIN_TITLE_SCORE:
+            continue
+        artist_score = artist_scorer.score(res_artist)
+        if all_artists != first_artist:
+            artist_score = max(artist_score, artist_scorer.score(normalize(all_artists)))
+
+        total_score = (title_score + artist_score) / 2
+        if total_score <= threshold:
+            continue
+
+        scored.append((total_score, res_duration, item))
+        best_score = max(best_score, total_score)
+
+    if not scored:
+        return None, best_score
+
+    # 同点圏内の候補は再生時間が近いものを優先
+    contenders = [c for c in scored if c[0] >= best_score - TIE_MARGIN]
+    if duration and len(contenders) > 1:
+        contenders.sort(key=lambda c: (abs(c[1] - duration) if c[1] else float('inf'), -c[0]))
+    else:
+        contenders.sort(key=lambda c: -c[0])
+
+    total_score, _, item = contenders[0]
+    return item, total_score
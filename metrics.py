@@ -0,0 +1,252 @@
+"""
+メトリクス（Prometheusのテキスト形式で出力）
+記録はスレッドごとの領域への加算だけで行い、リクエスト処理にロックを持ち込まない
+"""
+
+import threading
+from bisect import bisect_left
+
+# 既定のヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Shards:
+    """スレッドごとの加算領域
+
+    各スレッドは自分のリストにだけ書き込むので、加算にロックは不要。
+    ロックを取るのはスレッドが初めて記録するときの登録だけで、
+    読み出し側は全スレッドの値を合計する（記録中の値が少しずれて見えることはある）。
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def get(self) -> list:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = [0] * self.size
+            with self._lock:
+                self._all.append(shard)
+            self.local.shard = shard
+            return shard
+
+    def total(self) -> list:
+        with self._lock:
+            shards = list(self._all)
+        result = [0] * self.size
+        for shard in shards:
+            for i, value in enumerate(shard):
+                result[i] += value
+        return result
+
+
+class Counter:
+    """増えるだけの値（スレッドごとの整数に加算し、読み出し時に合計する）"""
+
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount: int = 1):
+        try:
+            shard = self._shards.local.shard
+        except AttributeError:
+            shard = self._shards.get()
+        shard[0] += amount
+
+    @property
+    def value(self) -> int:
+        return self._shards.total()[0]
+
+
+class Histogram:
+    """値の分布（区切りごとの件数と合計）"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # 区切りごとの件数 + 上限超え + 合計
+        self._shards = _Shards(len(self.buckets) + 2)
+
+    def observe(self, value: float):
+        try:
+            shard = self._shards.local.shard
+        except AttributeError:
+            shard = self._shards.get()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self) -> tuple[list, int, float]:
+        """(累積件数のリスト, 総件数, 合計)"""
+        return self.cumulate(self._shards.total())
+
+    @staticmethod
+    def cumulate(total: list) -> tuple[list, int, float]:
+        """区切りごとの件数 + 上限超え + 合計 を (累積件数のリスト, 総件数, 合計) にする"""
+        cumulative = []
+        running = 0
+        for count in total[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, running, total[-1]
+
+
+class _Family:
+    """ラベルごとの子メトリクスをまとめたもの"""
+
+    def __init__(self, kind: str, name: str, doc: str, labelnames: tuple, factory, buckets: tuple | None = None):
+        self.kind = kind
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.buckets = buckets  # ヒストグラムの区切り
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def items(self):
+        return list(self._children.items())
+
+
+class MetricsRegistry:
+    """メトリクスを登録し、/metrics 用のテキストを作る"""
+
+    def __init__(self, prefix: str = ''):
+        self.prefix = prefix
+        self._families = []
+
+    def _add(self, kind: str, name: str, doc: str, labelnames, factory, buckets: tuple | None = None):
+        family = _Family(kind, self.prefix + name, doc, tuple(labelnames), factory, buckets)
+        self._families.append(family)
+        return family if labelnames else family.labels()
+
+    def counter(self, name: str, doc: str, labelnames=()):
+        """カウンター（ラベルを指定した場合は .labels(...) で子を取り出す）"""
+        return self._add('counter', name, doc, labelnames, Counter)
+
+    def histogram(self, name: str, doc: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """ヒストグラム（ラベルを指定した場合は .labels(...) で子を取り出す）"""
+        buckets = tuple(sorted(buckets))
+        return self._add('histogram', name, doc, labelnames, lambda: Histogram(buckets), buckets)
+
+    def counter_func(self, name: str, doc: str, fn):
+        """出力時にfn()を読むカウンター（既存の統計値をそのまま公開する用）"""
+        self._add('counter', name, doc, (), lambda: _Callback(fn))
+
+    def gauge(self, name: str, doc: str, fn):
+        """出力時にfn()を読むゲージ"""
+        self._add('gauge', name, doc, (), lambda: _Callback(fn))
+
+    def snapshot(self) -> dict:
+        """記録した値（カウンター・ヒストグラムのみ、JSONにできる形）。他のプロセスの render(others=...) に渡す
+
+        {メトリクス名: [[ラベルの値, [値...]], ...]}（カウンターは [値]、ヒストグラムは区切りごとの件数 + 上限超え + 合計）
+        """
+        result = {}
+        for family in self._families:
+            rows = [[list(values), _totals(child)] for values, child in family.items()
+                    if not isinstance(child, _Callback)]
+            if rows:
+                result[family.name] = rows
+        return result
+
+    def render(self, others=()) -> str:
+        """Prometheusのテキスト形式（version 0.0.4）
+
+        othersに他のプロセスの snapshot() を渡すと、カウンター・ヒストグラムはそれらとの合計を出力する
+        （出力時に読む値・ゲージはこのプロセスの値）。
+        """
+        lines = []
+        for family in self._families:
+            lines.append(f"# HELP {family.name} {family.doc}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            children = family.items()
+            if others and not any(isinstance(child, _Callback) for _, child in children):
+                children = self._merge(family, children, others)
+            for values, child in children:
+                labels = dict(zip(family.labelnames, values))
+                if isinstance(child, Histogram):
+                    self._render_histogram(lines, family.name, labels, child.buckets, child.snapshot())
+                elif isinstance(child, _Merged):
+                    if child.buckets is None:
+                        lines.append(f"{family.name}{_format_labels(labels)} {_format_value(child.totals[0])}")
+                    else:
+                        self._render_histogram(lines, family.name, labels, child.buckets,
+                                               Histogram.cumulate(child.totals))
+                else:
+                    lines.append(f"{family.name}{_format_labels(labels)} {_format_value(child.value)}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _merge(family: _Family, children: list, others) -> list:
+        """このプロセスの値と他のプロセスの値をラベルごとに足し合わせる"""
+        merged = {values: _Merged(family.buckets, _totals(child)) for values, child in children}
+        for snapshot in others:
+            for values, totals in snapshot.get(family.name, ()):
+                values = tuple(values)
+                current = merged.get(values)
+                if current is None:
+                    merged[values] = _Merged(family.buckets, list(totals))
+                elif len(current.totals) == len(totals):
+                    current.totals = [a + b for a, b in zip(current.totals, totals)]
+        return list(merged.items())
+
+    @staticmethod
+    def _render_histogram(lines: list, name: str, labels: dict, buckets: tuple, snapshot: tuple[list, int, float]):
+        cumulative, count, total = snapshot
+        for bound, value in zip(buckets, cumulative):
+            lines.append(f"{name}_bucket{_format_labels(dict(labels, le=_format_value(bound)))} {value}")
+        lines.append(f"{name}_bucket{_format_labels(dict(labels, le='+Inf'))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+
+class _Merged:
+    """複数のプロセスの値を合計したもの（render の中だけで使う）"""
+
+    def __init__(self, buckets: tuple | None, totals: list):
+        self.buckets = buckets
+        self.totals = totals
+
+
+def _totals(child) -> list:
+    if isinstance(child, Histogram):
+        return child._shards.total()
+    return [child.value]
+
+
+class _Callback:
+    def __init__(self, fn):
+        self._fn = fn
+
+    @property
+    def value(self) -> float:
+        try:
+            return self._fn()
+        except Exception:
+            return float('nan')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
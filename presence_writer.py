@@ -0,0 +1,277 @@
+"""
+Discord Presence送信スレッド
+Presenceオブジェクトを専用スレッドだけが扱い、最新の状態だけをDiscordへ送る
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from pypresence import Presence
+
+logger = logging.getLogger(__name__)
+
+# 未送信を表す印（Noneは「クリア済み」を意味するため区別する）
+_UNSENT = object()
+# 送信スレッドの動作
+_CONNECT = object()
+_CLOSE = object()
+
+
+class ReconnectBackoff:
+    """再接続の待ち時間を指数バックオフ＋ジッターで決める"""
+
+    def __init__(self, base: float = 1.0, maximum: float = 60.0):
+        self.base = base
+        self.maximum = maximum
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        """次の再接続までの秒数（上限の半分〜上限の間でランダム）"""
+        delay = min(self.maximum, self.base * (2 ** self.attempt))
+        self.attempt += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        self.attempt = 0
+
+
+class PresenceWriter:
+    """最新の状態だけを保持する受け皿（latest-wins）と、送信頻度の制御を持つ送信スレッド
+
+    リクエスト処理側は post() / post_clear() で「表示したい状態」を置くだけで、
+    Discordとの通信（接続・更新・クリア）はすべてこのスレッドが行う。
+    連続して置かれた状態はまとめられ、最後のものだけが送信される。
+    切断中はバックオフしながら再接続を続け、接続できたら最後の状態を送り直す。
+    """
+
+    def __init__(self, client_id: str, max_updates: int = 5, per_seconds: float = 20.0,
+                 backoff: ReconnectBackoff | None = None, presence_factory=Presence,
+                 observe_send=None, on_connect=None):
+        self.client_id = client_id
+        self.per_seconds = per_seconds
+        self.backoff = backoff or ReconnectBackoff()
+        self._presence_factory = presence_factory
+        self._observe_send = observe_send  # 送信にかかった秒数を受け取る関数（メトリクス用）
+        self._on_connect = on_connect  # 接続できたときに呼ぶ関数
+
+        self._cond = threading.Condition(threading.RLock())
+        self._desired = None  # 表示したいPresence（Noneはクリア）
+        self._generation = 0  # 曲ごとの世代番号（patch用）
+        self._version = 0  # 置かれた状態の順序（古い状態の後着防止）
+        self._dirty = False
+        self._closing = False
+        self._sent = _UNSENT
+        self._send_times = deque(maxlen=max(1, max_updates))
+        self._retry_at = 0.0
+        self._connect_tried = False  # 2回目以降の接続は再接続として数える
+        self._thread = None
+
+        self.rpc = None
+        self.connected = False
+        self.last_connected_at = None  # 最後に接続に成功した時刻（time.time()）
+        self.stats = {
+            'posted': 0, 'coalesced': 0, 'sent': 0, 'failed': 0,
+            'reconnect_attempts': 0, 'replays': 0
+        }
+
+    # ----------------------------------------
+    #  リクエスト処理側から呼ぶAPI
+    # ----------------------------------------
+
+    def post(self, update_args: dict, generation: int = 0, version: int | None = None) -> bool:
+        """表示したいPresenceを置く（未送信の古い状態は上書きされる）
+
+        versionを指定した場合、それより新しい状態が既に置かれていれば破棄する。
+        """
+        with self._cond:
+            if version is not None:
+                if version < self._version:
+                    return False
+                self._version = version
+            self._put(dict(update_args), generation)
+            return True
+
+    def post_clear(self):
+        """Presenceのクリアを要求"""
+        self._put(None, None)
+
+    def patch(self, generation: int, fields: dict) -> bool:
+        """同じ曲（世代）のままなら、表示中の状態に項目を追加して送り直す"""
+        with self._cond:
+            if generation != self._generation or self._desired is None:
+                return False
+            desired = dict(self._desired)
+            desired.update(fields)
+            self._desired = desired
+            self._mark_dirty()
+            return True
+
+    def desired(self) -> dict | None:
+        """現在表示したい状態（Noneはクリア）"""
+        with self._cond:
+            return self._desired
+
+    def _put(self, desired, generation: int | None):
+        with self._cond:  # post()からは再入する
+            self._desired = desired
+            if generation is not None:
+                self._generation = generation
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        self.stats['posted'] += 1
+        if self._dirty:
+            self.stats['coalesced'] += 1
+        self._dirty = True
+        self._cond.notify()
+
+    # ----------------------------------------
+    #  スレッド制御
+    # ----------------------------------------
+
+    def start(self):
+        """送信スレッドを開始（初回接続もこのスレッドで行う）"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='presence-writer', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: float = 5.0):
+        """Presenceをクリアして接続を閉じる"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # ----------------------------------------
+    #  送信スレッド
+    # ----------------------------------------
+
+    def _run(self):
+        while True:
+            with self._cond:
+                action = self._next_action()
+
+            if action is _CLOSE:
+                break
+            if action is _CONNECT:
+                self._connect()
+                continue
+
+            self._send(action)
+
+        self._shutdown()
+
+    def _next_action(self):
+        """次にやること（接続・送信する状態・終了）が決まるまで待つ"""
+        while not self._closing:
+            now = time.monotonic()
+
+            # 切断中はバックオフ時間が過ぎたら再接続
+            if not self.connected:
+                if now < self._retry_at:
+                    self._cond.wait(self._retry_at - now)
+                    continue
+                return _CONNECT
+
+            if not self._dirty:
+                self._cond.wait()
+                continue
+
+            # 送信頻度の制御（per_seconds秒あたりmax_updates回まで）
+            if len(self._send_times) == self._send_times.maxlen:
+                wait = self._send_times[0] + self.per_seconds - now
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+            self._dirty = False
+            return self._desired
+
+        return _CLOSE
+
+    def _connect(self) -> bool:
+        """Discord RPCに接続を試みる（失敗したら次の再接続時刻を決める）"""
+        reconnect = self._connect_tried
+        self._connect_tried = True
+        if reconnect:
+            self.stats['reconnect_attempts'] += 1
+            logger.info("🔄 Discord再接続を試みます...")
+
+        try:
+            if self.rpc is None:
+                self.rpc = self._presence_factory(self.client_id)
+            self.rpc.connect()
+        except Exception as e:
+            self._retry_at = time.monotonic() + self.backoff.next_delay()
+            logger.warning("⚠️ Discord接続失敗: %s", e)
+            return False
+
+        self.backoff.reset()
+        self.last_connected_at = time.time()
+        logger.info("✅ Discordに接続しました！")
+        if self._on_connect is not None:
+            self._on_connect()
+
+        with self._cond:
+            self.connected = True
+            self._sent = _UNSENT
+            # 切断中に置かれていた（または切断前に表示していた）状態を送り直す
+            if self._desired is not None:
+                if reconnect:
+                    self.stats['replays'] += 1
+                self._dirty = True
+        return True
+
+    def _send(self, desired):
+        """Discordへ送信（直前と同じ内容なら省略）"""
+        if desired == self._sent:
+            return
+
+        try:
+            started = time.perf_counter()
+            if desired is None:
+                self.rpc.clear()
+                logger.info("🧹 Presenceをクリアしました")
+            else:
+                self.rpc.update(**desired)
+                if self._observe_send is not None:
+                    self._observe_send(time.perf_counter() - started)
+                logger.info("🎵 Presence更新: %s - %s", desired['details'], desired['state'])
+            self._sent = desired
+            self._send_times.append(time.monotonic())
+            self.stats['sent'] += 1
+        except Exception as rpc_error:
+            self.stats['failed'] += 1
+            logger.warning("⚠️ Presence更新失敗: %s", rpc_error)
+            with self._cond:
+                # すぐに1回目の再接続を行い、つながったら送り直す
+                self.connected = False
+                self._retry_at = time.monotonic()
+                self._dirty = True
+
+    def _shutdown(self):
+        if self.rpc is None:
+            return
+        if self.connected:
+            try:
+                self.rpc.clear()
+                logger.info("🧹 Presenceをクリアしました")
+            except Exception:
+                pass
+        try:
+            self.rpc.close()
+        except Exception:
+            pass
+        self.connected = False
+
+    def health(self) -> dict:
+        """/health 用の接続状況"""
+        since = None
+        if self.last_connected_at is not None:
+            since = round(time.time() - self.last_connected_at, 1)
+        return dict(self.stats, seconds_since_connect=since)
@@ -0,0 +1,376 @@
+"""
+キャッシュの事前読み込み（プリウォーム）
+再生履歴のエクスポート（CSV・JSON）やYouTube Musicのプレイリストから曲を読み、
+サーバーと同じ画像検索（search_album_art）で画像とvideoIdを調べて、サーバーのキャッシュ（CACHE_DB_PATH）に保存する
+
+使い方:
+  python prewarm.py history.csv [--workers 2] [--rate 1] [--limit 3000]
+  python prewarm.py watch-history.json            # Google Takeout の再生履歴（YouTube Musicの分だけ）
+  python prewarm.py --playlist PLxxxxxxxxxxxx     # プレイリストの曲（検索せず、プレイリストの画像をそのまま保存）
+  python prewarm.py history.csv --retry-missing   # 前回見つからなかった曲も検索し直す
+
+CSVは title・artist（任意で duration）の列。見出し行がなければ1・2・3列目をその順に読む。
+JSONは {"title", "artist", "duration"} の配列、または Takeout の watch-history.json。
+再生回数の多い曲から順に検索し、問い合わせは YTMUSIC_RATE / YTMUSIC_BURST（--rate で上書き）の予算内で行う。
+
+中断しても、もう一度同じコマンドを実行すれば続きから行う（保存した曲はキャッシュに、見つからなかった曲は --state のファイルに残る）。
+サーバーの起動中に実行した場合、保存した画像はサーバーの再起動後（WORKERS > 1 なら直後）から使われる。
+"""
+
+import argparse
+import atexit
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from ingest import parse_update
+
+RETRIES = 3  # 検索の失敗・予算切れ・ブレーカーで画像が決まらなかった曲を試し直す回数
+DEFAULT_TIMEOUT = 30  # 1回の問い合わせの締め切りの既定値（秒、サーバーの既定より長い）
+# Takeout の再生履歴（watch-history.json）のYouTube Musicの分と、タイトルに付く文言（英語・日本語）
+TAKEOUT_HEADER = 'YouTube Music'
+TAKEOUT_PREFIXES = ('Watched ',)
+TAKEOUT_SUFFIXES = (' を視聴しました',)
+TOPIC_SUFFIX = ' - Topic'  # 自動生成のアーティストチャンネル名
+
+
+# ----------------------------------------
+#  入力の読み込み
+# ----------------------------------------
+
+def parse_duration(value) -> float:
+    """再生時間（秒、または "m:ss" / "h:mm:ss"）を秒にする（読めなければ0）"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value or '').strip()
+    try:
+        seconds = 0.0
+        for part in text.split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except ValueError:
+        return 0.0
+
+
+def read_csv(path: str) -> list:
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = [row for row in csv.reader(f) if row]
+    if not rows:
+        return []
+
+    header = [cell.strip().lower() for cell in rows[0]]
+    columns = {}
+    for name, aliases in (('title', ('title', 'track', 'song', 'name')),
+                          ('artist', ('artist', 'artists', 'artist name')),
+                          ('duration', ('duration', 'length'))):
+        columns[name] = next((header.index(a) for a in aliases if a in header), None)
+
+    if columns['title'] is not None and columns['artist'] is not None:
+        rows = rows[1:]
+    else:
+        columns = {'title': 0, 'artist': 1, 'duration': 2}
+
+    songs = []
+    for row in rows:
+        def cell(name):
+            index = columns[name]
+            return row[index] if index is not None and index < len(row) else ''
+        songs.append((cell('title'), cell('artist'), parse_duration(cell('duration'))))
+    return songs
+
+
+def takeout_song(item: dict) -> tuple | None:
+    """Takeout の再生履歴の1件を (曲名, アーティスト, 0) にする（YouTube Music以外・読めなければNone）"""
+    if item.get('header') != TAKEOUT_HEADER:
+        return None
+    title = item.get('title') or ''
+    for prefix in TAKEOUT_PREFIXES:
+        if title.startswith(prefix):
+            title = title[len(prefix):]
+    for suffix in TAKEOUT_SUFFIXES:
+        if title.endswith(suffix):
+            title = title[:-len(suffix)]
+    subtitles = item.get('subtitles') or []
+    artist = subtitles[0].get('name', '') if subtitles else ''
+    if artist.endswith(TOPIC_SUFFIX):
+        artist = artist[:-len(TOPIC_SUFFIX)]
+    if not title or not artist:
+        return None
+    return title, artist, 0.0
+
+
+def read_json(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get('tracks') or data.get('songs') or []
+
+    songs = []
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        if 'header' in item:
+            song = takeout_song(item)
+        elif item.get('title') and item.get('artist'):
+            song = (item['title'], item['artist'], parse_duration(item.get('duration', 0)))
+        else:
+            song = None
+        if song is not None:
+            songs.append(song)
+    return songs
+
+
+def read_songs(path: str) -> list:
+    """ファイルから (曲名, アーティスト, 再生時間) を読む"""
+    if path.lower().endswith('.json'):
+        return read_json(path)
+    return read_csv(path)
+
+
+def rank_songs(songs: list, get_cache_key) -> list:
+    """サーバーと同じサニタイズをかけて重複をまとめ、再生回数の多い順に並べる"""
+    plays = Counter()
+    first = {}
+    for title, artist, duration in songs:
+        fields = parse_update({'title': title, 'artist': artist, 'duration': duration})
+        if fields is None:
+            continue
+        key = get_cache_key(fields['title'], fields['artist'])
+        plays[key] += 1
+        first.setdefault(key, (fields['title'], fields['artist'], fields['duration']))
+    return [first[key] for key, _ in plays.most_common()]
+
+
+# ----------------------------------------
+#  進み具合と再開
+# ----------------------------------------
+
+class Progress:
+    """結果を数え、定期的に表示し、見つかった・見つからなかった曲を状態ファイルに追記する"""
+
+    RESULTS = ('found', 'cached', 'missing', 'skipped')
+
+    def __init__(self, total: int, state_path: str, interval: float = 1.0):
+        self.total = total
+        self.counts = dict.fromkeys(self.RESULTS, 0)
+        self.interval = interval
+        self.started = time.monotonic()
+        self._printed_at = 0.0
+        self._lock = threading.Lock()
+        self._state = open(state_path, 'a', encoding='utf-8')
+        self._tty = sys.stderr.isatty()
+
+    @staticmethod
+    def load(state_path: str) -> dict:
+        """前回までの結果（cache_key -> found / missing）"""
+        done = {}
+        if os.path.exists(state_path):
+            with open(state_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        done[record['key']] = record['result']
+                    except (ValueError, KeyError):
+                        continue  # 中断で途中まで書かれた行
+        return done
+
+    def record(self, key: str, result: str):
+        with self._lock:
+            self.counts[result] += 1
+            if result in ('found', 'missing'):
+                self._state.write(json.dumps({'key': key, 'result': result}, ensure_ascii=False) + '\n')
+                self._state.flush()
+            now = time.monotonic()
+            if now - self._printed_at >= self.interval:
+                self._printed_at = now
+                self._print(now)
+
+    def _print(self, now: float):
+        done = sum(self.counts.values())
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = (self.total - done) / rate if rate > 0 else 0
+        line = (f"🔥 {done}/{self.total} 保存 {self.counts['found']} / キャッシュ済み {self.counts['cached']} / "
+                f"見つからず {self.counts['missing']} / 未処理 {self.counts['skipped']} "
+                f"({rate:.1f}曲/秒, 残り約{eta / 60:.0f}分)")
+        print(('\r' + line) if self._tty else line, end='' if self._tty else '\n', file=sys.stderr, flush=True)
+
+    def close(self):
+        with self._lock:
+            self._print(time.monotonic())
+            if self._tty:
+                print(file=sys.stderr)
+            self._state.close()
+
+
+# ----------------------------------------
+#  検索
+# ----------------------------------------
+
+def wait_for_budget(server, stop: threading.Event):
+    """問い合わせ予算が1回分たまるまで待つ（予算切れで断られる検索を減らす）"""
+    bucket = server.ytmusic_upstream.bucket
+    while not stop.is_set() and bucket.rate > 0 and bucket.tokens < 1:
+        stop.wait(1 / bucket.rate)
+
+
+def warm(server, song: tuple, stop: threading.Event) -> str:
+    """1曲の画像を検索してキャッシュに保存し、結果（found / cached / missing / skipped）を返す
+
+    missing は検索して合う曲がなかった場合だけ。失敗・予算切れ・ブレーカーで検索できなかった場合は
+    待って試し直し、それでもだめなら skipped（次の実行で検索し直す）。
+    """
+    title, artist, duration = song
+    cache_key = server.get_cache_key(title, artist)
+    if server.get_cached_album_art(cache_key) is not None:
+        return 'cached'
+
+    breaker = server.ytmusic_upstream.breaker
+    for _ in range(RETRIES):
+        wait_for_budget(server, stop)
+        if stop.is_set():
+            break
+        _, _, outcome = server.find_album_art(title, artist, duration)
+        if outcome in ('found', 'cached'):
+            return 'found'
+        if outcome == 'no_match':
+            return 'missing'
+        # 失敗して「なし」として覚えた分は忘れて、待ってから試し直す
+        server.image_cache.discard_negative(cache_key)
+        stop.wait(breaker.reset_timeout if breaker.state != breaker.CLOSED else 1.0)
+    return 'skipped'
+
+
+def warm_songs(server, songs: list, workers: int, limit: int, progress: Progress):
+    """曲を workers 本のスレッドで順に検索する（新しく保存した曲が limit に達したら止める）"""
+    stop = threading.Event()
+
+    def task(song):
+        if stop.is_set():
+            progress.record(server.get_cache_key(song[0], song[1]), 'skipped')
+            return
+        result = warm(server, song, stop)
+        progress.record(server.get_cache_key(song[0], song[1]), result)
+        if progress.counts['found'] >= limit:
+            stop.set()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='prewarm')
+    futures = [executor.submit(task, song) for song in songs]
+    try:
+        wait(futures)
+    except KeyboardInterrupt:
+        print("\n⏸️ 中断しています（検索中の曲が終わるまで待ちます）...", file=sys.stderr)
+        stop.set()
+    executor.shutdown(wait=True, cancel_futures=True)
+    for song, future in zip(songs, futures):
+        if future.cancelled():
+            progress.record(server.get_cache_key(song[0], song[1]), 'skipped')
+
+
+def warm_playlist(server, playlist_id: str, limit: int, progress_factory):
+    """プレイリストの曲をそのままキャッシュに保存（曲ごとの検索はしない）"""
+    playlist = server.call_ytmusic('playlist', server.get_ytmusic().get_playlist, playlist_id, limit=None)
+    entries = [entry for entry in map(server.track_cache_entry, playlist.get('tracks') or []) if entry is not None]
+    progress = progress_factory(len(entries))
+    for cache_key, image_url, video_id in entries:
+        if server.get_cached_album_art(cache_key) is not None:
+            progress.record(cache_key, 'cached')
+        elif progress.counts['found'] >= limit:
+            progress.record(cache_key, 'skipped')
+        else:
+            server.image_cache.put(cache_key, image_url, video_id)
+            progress.record(cache_key, 'found')
+    return progress
+
+
+# ----------------------------------------
+#  メイン
+# ----------------------------------------
+
+def load_server(args):
+    """server.py をCLI向けの設定で読み込む（.env のキャッシュ・予算の設定はそのまま使う）"""
+    os.environ['WORKERS'] = '1'
+    os.environ['LOG_FILE'] = ''  # サーバーのログファイルには書かない
+    os.environ['EVENT_LOG_PATH'] = ''
+    os.environ.setdefault('LOG_LEVEL', 'INFO' if args.verbose else 'WARNING')
+    if args.rate is not None:
+        os.environ['YTMUSIC_RATE'] = str(args.rate)
+    # 待っている人はいないので、予算待ちを含めて長めに待つ（--timeout があれば環境変数より優先）
+    if args.timeout is not None:
+        os.environ['YTMUSIC_TIMEOUT'] = str(args.timeout)
+    else:
+        os.environ.setdefault('YTMUSIC_TIMEOUT', str(DEFAULT_TIMEOUT))
+
+    import server
+    # サーバーとしての終了処理（Presenceのクリアなど）は行わない
+    atexit.unregister(server.cleanup)
+    return server
+
+
+def close_server(server):
+    server.catalogue_executor.shutdown(wait=False, cancel_futures=True)
+    server.ytmusic_upstream.shutdown()
+    server.image_cache.close()
+    server.log_listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', help='曲の一覧（CSV・JSON）')
+    parser.add_argument('--playlist', help='YouTube MusicのプレイリストID')
+    parser.add_argument('--workers', type=int, default=2, help='同時に検索するスレッド数')
+    parser.add_argument('--rate', type=float, help='1秒あたりの問い合わせ回数（省略時は YTMUSIC_RATE）')
+    parser.add_argument('--timeout', type=float,
+                        help=f'1回の問い合わせの締め切り（秒、予算待ちを含む。省略時は YTMUSIC_TIMEOUT、未設定なら{DEFAULT_TIMEOUT}）')
+    parser.add_argument('--limit', type=int,
+                        help='新しく保存する最大曲数（省略時はキャッシュの空き = CACHE_MAX_SIZE - 現在の件数）')
+    parser.add_argument('--state', help='再開用の記録ファイル（省略時はキャッシュのファイル名 + .prewarm.jsonl）')
+    parser.add_argument('--retry-missing', action='store_true', help='前回見つからなかった曲も検索し直す')
+    parser.add_argument('--verbose', action='store_true', help='サーバーのログ（INFO）も表示する')
+    args = parser.parse_args()
+    if not args.path and not args.playlist:
+        parser.error('曲の一覧のファイルか --playlist を指定してください')
+
+    server = load_server(args)
+    if not server.CACHE_DB_PATH:
+        print("❌ CACHE_DB_PATH が空（メモリのみ）のため、保存先がありません", file=sys.stderr)
+        sys.exit(1)
+
+    state_path = args.state or os.path.splitext(server.CACHE_DB_PATH)[0] + '.prewarm.jsonl'
+    limit = args.limit if args.limit is not None else max(0, server.CACHE_MAX_SIZE - len(server.image_cache))
+    print(f"📦 キャッシュ: {server.CACHE_DB_PATH} ({len(server.image_cache)}/{server.CACHE_MAX_SIZE} 件)、"
+          f"新しく保存するのは最大 {limit} 曲", file=sys.stderr)
+
+    try:
+        if args.playlist:
+            progress = warm_playlist(server, args.playlist, limit, lambda total: Progress(total, state_path))
+        else:
+            done = Progress.load(state_path)
+            songs = rank_songs(read_songs(args.path), server.get_cache_key)
+            # 保存済みの曲はキャッシュを見るだけで済む（押し出されていれば検索し直す）。見つからなかった曲は飛ばす
+            pending = [song for song in songs
+                       if args.retry_missing or done.get(server.get_cache_key(song[0], song[1])) != 'missing']
+            print(f"🎵 {len(songs)} 曲（前回見つからなかった {len(songs) - len(pending)} 曲を除く {len(pending)} 曲）",
+                  file=sys.stderr)
+            progress = Progress(len(pending), state_path)
+            warm_songs(server, pending, args.workers, limit, progress)
+        progress.close()
+    finally:
+        close_server(server)
+
+    counts = progress.counts
+    print(f"✅ 保存 {counts['found']} / キャッシュ済み {counts['cached']} / 見つからず {counts['missing']} / "
+          f"未処理 {counts['skipped']}", file=sys.stderr)
+    if counts['found'] >= limit:
+        print(f"   新しく保存する曲数の上限（{limit}）に達しました", file=sys.stderr)
+    if counts['skipped']:
+        print("   未処理の曲は、もう一度実行すると続きから検索します", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+稼働中のサーバーのプロファイル（/debug/profile）
+指定した秒数だけ全スレッドのスタックを一定間隔で記録し（sys._current_frames）、
+flamegraph.pl・speedscope で読める collapsed stacks（1行に「スレッド;関数;…;関数 回数」）にまとめる。
+同じ間、/update の処理段階（検証・状態の更新・画像の検索・送信・ログ）ごとの時間も記録する。
+
+計測していない間の処理段階の記録は、フラグを1つ見るだけで何もしない。
+"""
+
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+_trace = contextvars.ContextVar('profile_trace', default=None)
+
+
+class ProfilerBusy(Exception):
+    """別のプロファイルを取得中"""
+
+
+class Profiler:
+    """サンプリングプロファイラと、リクエストの処理段階の時間
+
+    計測は run() を呼んだスレッドで行い（その間は戻らない）、同時に1つだけ。
+    処理段階は begin() で記録を始め、段階が終わるたびに mark()、最後に end() を呼ぶ。
+    mark() は前回の mark()（なければ begin()）からの時間をその段階の時間とする。
+    asyncio のタスクごとに別の記録になるよう、記録中のリクエストは contextvars で持つ。
+    """
+
+    def __init__(self, interval: float = 0.005, max_traces: int = 2000, slowest: int = 10):
+        self.interval = interval
+        self.slowest = slowest
+        self.active = False
+        self._traces = deque(maxlen=max_traces)
+        self._busy = threading.Lock()
+        self._generation = 0  # run() ごとに増やす（前回の計測中に始まったリクエストの記録を混ぜない）
+        self._names = {}  # コードオブジェクト -> "ファイル名:関数名"
+
+    # ----------------------------------------
+    #  処理段階の時間
+    # ----------------------------------------
+
+    def begin(self, kind: str):
+        """リクエストの記録を始める（計測中でなければ何もしない）"""
+        if not self.active:
+            return
+        now = time.perf_counter()
+        _trace.set([kind, now, now, [], self._generation])
+
+    def mark(self, stage: str):
+        """直前の区切りからここまでを stage の時間として記録"""
+        if not self.active:
+            return
+        trace = _trace.get()
+        if trace is None or trace[4] != self._generation:
+            return
+        now = time.perf_counter()
+        trace[3].append((stage, now - trace[2]))
+        trace[2] = now
+
+    def end(self):
+        """リクエストの記録を終える"""
+        if not self.active:
+            return
+        trace = _trace.get()
+        if trace is None or trace[4] != self._generation:
+            return
+        _trace.set(None)
+        kind, started, _, spans, _ = trace
+        self._traces.append((kind, time.perf_counter() - started, spans))
+
+    # ----------------------------------------
+    #  サンプリング
+    # ----------------------------------------
+
+    def run(self, seconds: float) -> dict:
+        """seconds秒間サンプリングし、collapsed stacks と処理段階の集計を返す（計測中ならProfilerBusy）"""
+        if not self._busy.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            self._traces.clear()
+            self._generation += 1
+            self.active = True
+            stacks, samples, started = self._sample(seconds)
+        finally:
+            self.active = False
+            self._busy.release()
+
+        return {
+            'seconds': round(time.monotonic() - started, 3),
+            'interval_ms': self.interval * 1000,
+            'samples': samples,
+            'collapsed': '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common()),
+            'spans': self._summarize(list(self._traces)),
+        }
+
+    def _sample(self, seconds: float) -> tuple[Counter, int, float]:
+        own = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        started = time.monotonic()
+        deadline = started + seconds
+        while True:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+            samples += 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return stacks, samples, started
+            time.sleep(min(self.interval, remaining))
+
+    def _collapse(self, thread_name: str, frame) -> str:
+        """フレームを外側から順に「スレッド;関数;…」の1行にする"""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = self._names.get(code)
+            if name is None:
+                name = self._names[code] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+            names.append(name)
+            frame = frame.f_back
+        names.append(thread_name.replace(';', ':').replace(' ', '_'))
+        return ';'.join(reversed(names))
+
+    def _summarize(self, traces: list) -> dict:
+        """処理段階ごとの回数・平均・p95・最大（ミリ秒）と、時間のかかったリクエスト"""
+        durations = {}
+        for _, _, spans in traces:
+            for stage, seconds in spans:
+                durations.setdefault(stage, []).append(seconds)
+
+        stages = {}
+        for stage, values in durations.items():
+            values.sort()
+            stages[stage] = {
+                'count': len(values),
+                'mean_ms': round(sum(values) / len(values) * 1000, 3),
+                'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 3),
+                'max_ms': round(values[-1] * 1000, 3),
+            }
+
+        slowest = sorted(traces, key=lambda t: t[1], reverse=True)[:self.slowest]
+        return {
+            'requests': len(traces),
+            'stages': stages,
+            'slowest': [
+                {'kind': kind, 'total_ms': round(total * 1000, 3),
+                 'spans': [(stage, round(seconds * 1000, 3)) for stage, seconds in spans]}
+                for kind, total, spans in slowest
+            ],
+        }
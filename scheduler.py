@@ -0,0 +1,107 @@
+"""
+遅延実行スケジューラ
+1本のスレッドと締め切りのヒープで、名前付きの遅延タスクを実行する
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineScheduler:
+    """名前付きタスクを締め切り時刻に実行する（同じ名前で登録し直すと締め切りを更新）
+
+    締め切りの延長は辞書の時刻を書き換えるだけで、スレッドの起こし直しは不要。
+    ヒープに残った古い締め切りは、取り出した時点で新しい締め切りに積み直す。
+    """
+
+    def __init__(self, name: str = 'scheduler'):
+        self.name = name
+        self._cond = threading.Condition()
+        self._tasks = {}  # name -> [deadline, fn]
+        self._heap = []  # (deadline, seq, name)
+        self._seq = itertools.count()
+        self._thread = None
+        self._stopping = False
+
+    def schedule(self, name: str, delay: float, fn):
+        """delay秒後にfnを実行（同じ名前のタスクがあれば置き換える）"""
+        deadline = time.monotonic() + delay
+
+        with self._cond:
+            task = self._tasks.get(name)
+            if task is not None and task[0] <= deadline:
+                # 締め切りの延長は時刻の更新だけで済む
+                task[0] = deadline
+                task[1] = fn
+                return
+
+            self._tasks[name] = [deadline, fn]
+            heapq.heappush(self._heap, (deadline, next(self._seq), name))
+            self._ensure_thread()
+            self._cond.notify()
+
+    def cancel(self, name: str):
+        """タスクを取り消す"""
+        with self._cond:
+            self._tasks.pop(name, None)
+
+    def pending(self, name: str) -> bool:
+        """タスクが登録されているか"""
+        return name in self._tasks
+
+    def stop(self):
+        """スケジューラを停止（未実行のタスクは破棄）"""
+        with self._cond:
+            self._stopping = True
+            self._tasks.clear()
+            self._cond.notify()
+
+    def _ensure_thread(self):
+        if self._thread is None and not self._stopping:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                fn = self._next_due()
+                if fn is None:
+                    return
+
+            try:
+                fn()
+            except Exception as e:
+                logger.exception("⚠️ 遅延タスク失敗: %s", e)
+
+    def _next_due(self):
+        """締め切りを迎えたタスクを取り出す（停止時はNone）"""
+        while not self._stopping:
+            if not self._heap:
+                self._cond.wait()
+                continue
+
+            deadline, _, name = self._heap[0]
+            now = time.monotonic()
+            if deadline > now:
+                self._cond.wait(deadline - now)
+                continue
+
+            heapq.heappop(self._heap)
+            task = self._tasks.get(name)
+            if task is None:
+                continue  # 取り消し済み
+
+            if task[0] > now:
+                # 締め切りが延長されていたので積み直す
+                heapq.heappush(self._heap, (task[0], next(self._seq), name))
+                continue
+
+            del self._tasks[name]
+            return task[1]
+
+        return None
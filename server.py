@@ -7,42 +7,64 @@ YouTubeMusicの再生情報をDiscordに表示するサーバー
 
 import sys
 import io
-import re
 import secrets
 import logging
+import time
+
+# 起動時間の計測（節目ごとの起動からの秒数。/health と起動時の表示で使う）
+STARTUP_STARTED = time.perf_counter()
+startup_timings = {}
+
+
+def mark_startup(name: str):
+    """起動の節目を記録（最初の1回だけ）"""
+    startup_timings.setdefault(name, time.perf_counter() - STARTUP_STARTED)
+
 
 # Windows文字コード問題対策（UTF-8強制）
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
-# ファイルログ設定
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(message)s',
-    handlers=[
-        logging.FileHandler('server_debug.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
 logger = logging.getLogger(__name__)
 
-from flask import Flask, request, jsonify, g
+from flask import Flask, Response, abort, request, jsonify, g
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_cors import CORS
-from pypresence import Presence
-from ytmusicapi import YTMusic
-from difflib import SequenceMatcher
+from werkzeug.exceptions import HTTPException
+from art_cache import ArtCache, SingleFlight
+from catalogue import ArtistCatalogue
+from ingest import UnsupportedFormat, body_formats, clamp_number, clean_text, decode_body, parse_update
+from matching import best_match
+from presence_writer import PresenceWriter, ReconnectBackoff
+from scheduler import DeadlineScheduler
+from shared_state import SharedLimitsStorage, open_store  # noqa: F401  (storage_uri の shared+sqlite:// を登録する)
+from sessions import SessionArbiter
+from ip_filter import IPAllowList
+from auth_tracker import AuthFailureTracker
+from metrics import MetricsRegistry
+from profiler import Profiler, ProfilerBusy
+from event_log import (
+    EventLogWriter, KIND_UPDATE, KIND_PAUSE, KIND_BATCH, KIND_BATCH_EVENT, KIND_NAMES, FLAG_PLAYING,
+    decision_flags, describe_flags
+)
+from log_pipeline import parse_level, start_logging
+from upstream import CircuitBreaker, GuardedUpstream, TokenBucket, UpstreamTimeout, UpstreamUnavailable
+import workers
 from dotenv import load_dotenv
 import os
-import time
+import signal
 import threading
 import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import hmac
 
 # 本番用サーバー
-from waitress import serve
+from waitress import create_server
+
+mark_startup('imports')
 
 # ========================================
 #  設定
@@ -58,17 +80,92 @@ SERVER_PORT = int(os.getenv('SERVER_PORT', '5000'))
 AUTH_TOKEN = os.getenv('AUTH_TOKEN')  # 設定されていない場合はNone
 
 # セキュリティ設定
-ALLOWED_IPS = os.getenv('ALLOWED_IPS', '')  # カンマ区切りで許可IP指定 (空なら全許可)
+ALLOWED_IPS = os.getenv('ALLOWED_IPS', '')  # カンマ区切りで許可IP・CIDR指定 (空なら全許可)
 RATE_LIMIT_UPDATE = os.getenv('RATE_LIMIT_UPDATE', '60/minute')  # /update のレート制限
 RATE_LIMIT_DEFAULT = os.getenv('RATE_LIMIT_DEFAULT', '120/minute')  # デフォルトのレート制限
 MAX_CONTENT_LENGTH = 10 * 1024  # 10KB（リクエストボディの最大サイズ）
+MAX_BATCH_EVENTS = 20  # /update/batch で受け付けるイベント数の上限（ボディは上と同じ10KBまで）
 
 # リバースプロキシ設定（X-Forwarded-Forを信頼するか）
 # Nginx等のリバースプロキシ経由でアクセスする場合のみtrueに設定
 TRUST_PROXY = os.getenv('TRUST_PROXY', 'false').lower() == 'true'
 
-# 許可IPリストをパース
-ALLOWED_IP_LIST = [ip.strip() for ip in ALLOWED_IPS.split(',') if ip.strip()]
+# アルバムアートキャッシュ設定
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', 'album_art_cache.db')  # 空ならメモリのみ
+CACHE_MAX_SIZE = int(os.getenv('CACHE_MAX_SIZE', '5000'))  # 最大保存件数
+CACHE_TTL = int(os.getenv('CACHE_TTL', str(30 * 24 * 3600)))  # 有効期限（秒、0で無期限）
+
+# 画像検索を待たずにPresenceを先に更新するか（画像は取得後に再送信）
+ASYNC_ART_LOOKUP = os.getenv('ASYNC_ART_LOOKUP', 'false').lower() == 'true'
+ART_LOOKUP_WORKERS = int(os.getenv('ART_LOOKUP_WORKERS', '2'))
+
+# 次に再生される曲の画像を先読みする曲数（0で無効）と並列数
+PREFETCH_DEPTH = int(os.getenv('PREFETCH_DEPTH', '0'))
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', '1'))
+# 先読みした画像を検索せずに使う期間（秒）。再生キューの画像は検索で確かめていないので、キャッシュには保存しない
+PREFETCH_TTL = int(os.getenv('PREFETCH_TTL', '1800'))
+
+# Discordへの送信頻度の上限（Discord側の制限: 20秒あたり約5回）
+PRESENCE_MAX_UPDATES = int(os.getenv('PRESENCE_MAX_UPDATES', '5'))
+PRESENCE_RATE_WINDOW = float(os.getenv('PRESENCE_RATE_WINDOW', '20'))
+
+# 認証失敗記録の保存先（空なら保存しない。再起動後もブロックを維持したい場合に指定）
+AUTH_FAILURE_STORE = os.getenv('AUTH_FAILURE_STORE', '')
+
+# Discord再接続の待ち時間（指数バックオフの初期値と上限、秒）
+RECONNECT_BACKOFF_BASE = float(os.getenv('RECONNECT_BACKOFF_BASE', '1'))
+RECONNECT_BACKOFF_MAX = float(os.getenv('RECONNECT_BACKOFF_MAX', '60'))
+
+# サーバーモード（waitress: スレッドプール / asgi: asyncio + uvicorn）
+SERVER_MODE = os.getenv('SERVER_MODE', 'waitress').lower()
+# ASGIモードで画像検索を待つ最大秒数（超えたら先に表示し、画像は後で反映）
+ART_LOOKUP_TIMEOUT = float(os.getenv('ART_LOOKUP_TIMEOUT', '3'))
+
+# ワーカープロセス数（2以上で1つのポートを複数プロセスで受け付ける。POSIXのみ）
+# キャッシュ・レート制限・認証失敗・再生状態はプロセス間で共有し、Discordへの接続は親プロセスだけが持つ
+WORKERS = int(os.getenv('WORKERS', '1'))
+SHARED_STATE_PATH = os.getenv('SHARED_STATE_PATH', 'shared_state.db')  # WORKERS > 1 の場合の共有ストア
+METRICS_SHARE_INTERVAL = 1.0  # 各プロセスのメトリクスを共有ストアに置く間隔（秒）
+WORKER_ID = workers.worker_id()  # 1以上ならワーカープロセス
+MULTI_PROCESS = WORKERS > 1 and workers.supported()
+
+# 受信イベントの記録先（空なら記録しない。benchmarks/replay_events.py で再生できる）
+EVENT_LOG_PATH = os.getenv('EVENT_LOG_PATH', '')
+
+# YouTube Musicへの問い合わせ制御
+YTMUSIC_RATE = float(os.getenv('YTMUSIC_RATE', '1'))  # 1秒あたりの問い合わせ数（0で無制限）
+YTMUSIC_BURST = float(os.getenv('YTMUSIC_BURST', '10'))  # まとめて使える問い合わせ数
+YTMUSIC_TIMEOUT = float(os.getenv('YTMUSIC_TIMEOUT', '5'))  # 1回の問い合わせの締め切り（秒、予算待ちを含む）
+YTMUSIC_BREAKER_FAILURES = int(os.getenv('YTMUSIC_BREAKER_FAILURES', '5'))  # 連続でこの回数失敗したら問い合わせを止める
+YTMUSIC_BREAKER_RESET = float(os.getenv('YTMUSIC_BREAKER_RESET', '30'))  # 止めてから試し直すまでの秒数
+# 画像が見つからなかった・検索に失敗した曲を覚えておく秒数（過ぎたら検索し直す）
+NEGATIVE_CACHE_TTL = float(os.getenv('NEGATIVE_CACHE_TTL', '600'))
+
+# アーティスト単位の曲目インデックス（画像が見つかったアーティストの曲目を裏で取得し、同じアーティストの曲は検索しない）
+CATALOGUE_ENABLED = os.getenv('CATALOGUE_ENABLED', 'false').lower() == 'true'
+CATALOGUE_MAX_ARTISTS = int(os.getenv('CATALOGUE_MAX_ARTISTS', '100'))  # 覚えておくアーティスト数
+CATALOGUE_MAX_ALBUMS = int(os.getenv('CATALOGUE_MAX_ALBUMS', '10'))  # 1アーティストあたりに取得するアルバム・シングル数
+CATALOGUE_TTL = int(os.getenv('CATALOGUE_TTL', str(7 * 24 * 3600)))  # 取得し直すまでの秒数
+
+# 複数端末（端末はX-Device-Idヘッダーで区別。Presenceは1台分だけ表示する）
+# 表示する端末の優先順（カンマ区切りの端末ID、先頭ほど優先。載っていない端末は最後に再生を始めたものが優先）
+SESSION_PRIORITY = [d.strip() for d in os.getenv('SESSION_PRIORITY', '').split(',') if d.strip()]
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', '16'))  # 覚えておく端末数
+
+# /debug/profile で1回に計測できる最大秒数（0でエンドポイントを無効にする）
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', '30'))
+
+# ログ設定（出力は専用スレッドで行う。本番で受信ごとのログを止める場合は WARNING）
+LOG_LEVEL = parse_level(os.getenv('LOG_LEVEL', 'INFO'))
+LOG_FILE = os.getenv('LOG_FILE', 'server_debug.log')  # JSON Lines（空ならコンソールのみ）
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))  # このサイズを超えたらローテーション（0で無効）
+LOG_ROTATE_HOURS = float(os.getenv('LOG_ROTATE_HOURS', '24'))  # この時間が経ったらローテーション（0で無効）
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))  # 残す古いログの数
+
+log_listener = start_logging(LOG_LEVEL, workers.worker_path(LOG_FILE, WORKER_ID), LOG_MAX_BYTES, LOG_ROTATE_HOURS * 3600, LOG_BACKUP_COUNT)
+
+# 許可IPリストをパース（CIDRはプレフィックス長ごとの集合に変換）
+ALLOWED_IP_LIST = IPAllowList.parse(ALLOWED_IPS)
 
 # ========================================
 #  Flaskアプリ初期化
@@ -82,16 +179,17 @@ CORS(app, resources={
     r"/*": {
         "origins": "*",  # 本番環境では特定のオリジンに制限推奨
         "methods": ["GET", "POST"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": ["Content-Type", "Authorization", "X-Device-Id"]
     }
 })
 
-# レート制限設定
+# レート制限設定（複数ワーカーの場合は共有ストアで全ワーカーの回数を数える）
+RATE_LIMIT_STORAGE = f"shared+sqlite://{SHARED_STATE_PATH}" if MULTI_PROCESS else "memory://"
 limiter = Limiter(
     key_func=get_remote_address,
     app=app,
     default_limits=[RATE_LIMIT_DEFAULT],
-    storage_uri="memory://",
+    storage_uri=RATE_LIMIT_STORAGE,
     strategy="fixed-window"
 )
 
@@ -99,31 +197,135 @@ limiter = Limiter(
 #  グローバル変数
 # ========================================
 
-# Discord RPC関連
-RPC = None
-rpc_connected = False
-rpc_lock = threading.Lock()
+# /debug/profile のプロファイラ（計測していない間の処理段階の記録はフラグを見るだけ）
+profiler = Profiler()
+
+# メトリクス（/metrics で公開。記録はスレッドごとの加算だけでロックを取らない）
+metrics = MetricsRegistry(prefix='ytm_rpc_')
+MATCH_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+request_seconds = metrics.histogram('request_seconds', 'リクエストの処理時間（秒）', ('endpoint',))
+ytmusic_seconds = metrics.histogram('ytmusic_seconds', 'YouTube Music APIの応答時間（秒）', ('call',))
+match_seconds = metrics.histogram('match_seconds', '検索結果のスコア計算時間（秒）', buckets=MATCH_BUCKETS)
+discord_update_seconds = metrics.histogram('discord_update_seconds', 'Discord RPC更新の処理時間（秒）')
+art_cache_lookups = metrics.counter('art_cache_lookups_total', 'アルバムアートのキャッシュ参照数', ('result',))
+ytmusic_calls_total = metrics.counter(
+    'ytmusic_calls_total', 'YouTube Music APIの呼び出し結果（ok / error / timeout / circuit_open / budget）', ('call', 'result')
+)
+updates_total = metrics.counter('updates_total', '再生情報の受信数（applied: 反映 / skipped: 重複）', ('result',))
+seeks_total = metrics.counter('seeks_total', 'シーク検出数')
+new_songs_total = metrics.counter('new_songs_total', '曲の切り替え検出数')
+auth_failures_total = metrics.counter('auth_failures_total', '認証失敗数')
+rate_limited_total = metrics.counter('rate_limited_total', 'レート制限で拒否したリクエスト数', ('endpoint',))
+# よく使うラベルは先に取り出しておく
+art_cache_hits = art_cache_lookups.labels('hit')
+art_cache_misses = art_cache_lookups.labels('miss')
+art_cache_negative_hits = art_cache_lookups.labels('negative')
+art_cache_catalogue_hits = art_cache_lookups.labels('catalogue')
+art_cache_prefetch_hits = art_cache_lookups.labels('prefetch')
+updates_applied = updates_total.labels('applied')
+updates_skipped = updates_total.labels('skipped')
+
+# 複数ワーカーで共有する状態（WORKERS > 1 の場合のみ）
+shared_store = open_store(SHARED_STATE_PATH) if MULTI_PROCESS else None
+
+# Discord RPC関連（Presenceオブジェクトは送信スレッドだけが扱う）
+if MULTI_PROCESS and WORKER_ID:
+    # ワーカーは表示したい状態を共有ストアに置くだけ（送信は親プロセスが行う）
+    presence_writer = workers.SharedPresence(shared_store)
+else:
+    presence_writer = PresenceWriter(
+        CLIENT_ID,
+        max_updates=PRESENCE_MAX_UPDATES,
+        per_seconds=PRESENCE_RATE_WINDOW,
+        backoff=ReconnectBackoff(RECONNECT_BACKOFF_BASE, RECONNECT_BACKOFF_MAX),
+        observe_send=discord_update_seconds.observe,
+        on_connect=lambda: mark_startup('discord')
+    )
+
+# YTMusic検索（ytmusicapiの読み込みが重いため、起動後にバックグラウンドで作る）
+yt = None
+yt_lock = threading.Lock()
+
+# 画像キャッシュ（永続化・起動時に読み込み）
+# （見つからなかった曲は短い期限付きで別に覚える。以前保存されたプレースホルダーは起動時に捨てて検索し直す）
+# （複数ワーカーの場合は、他のワーカーが保存した画像もSQLiteから読む）
+image_cache = ArtCache(CACHE_DB_PATH, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL,
+                       negative_ttl=NEGATIVE_CACHE_TTL, placeholder="youtube_music_icon", shared=MULTI_PROCESS)
+
+# YouTube Musicへの問い合わせ（予算・サーキットブレーカー・締め切り付き）
+# （複数ワーカーの場合は、予算とブレーカーの状態を共有ストアに置いて全ワーカーで1つにする）
+ytmusic_upstream = GuardedUpstream(
+    TokenBucket(YTMUSIC_RATE, YTMUSIC_BURST, store=shared_store, key='ytmusic_bucket'),
+    CircuitBreaker(YTMUSIC_BREAKER_FAILURES, YTMUSIC_BREAKER_RESET, store=shared_store, key='ytmusic_breaker'),
+    timeout=YTMUSIC_TIMEOUT,
+    workers=ART_LOOKUP_WORKERS + max(1, PREFETCH_WORKERS) + 2,
+    name='ytmusic'
+)
+
+# 同じ曲の同時検索をまとめる
+art_lookups = SingleFlight()
+
+# 曲目インデックス（取得は1本のスレッドで順に行う）
+catalogue = ArtistCatalogue(CATALOGUE_MAX_ARTISTS, CATALOGUE_TTL) if CATALOGUE_ENABLED else None
+catalogue_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='catalogue')
 
-# YTMusic検索
-yt = YTMusic()
+# 非同期画像検索用
+art_executor = ThreadPoolExecutor(max_workers=ART_LOOKUP_WORKERS, thread_name_prefix='art-lookup')
 
-# 状態保存用
-last_title = ""
-last_artist = ""
-last_is_playing = True
-# 画像キャッシュ
-image_cache = {}
-CACHE_MAX_SIZE = 100
+# 先読み用
+prefetch_executor = ThreadPoolExecutor(max_workers=max(1, PREFETCH_WORKERS), thread_name_prefix='art-prefetch')
+prefetch_lock = threading.Lock()
+prefetched_keys = OrderedDict()  # 先読みしたがまだ再生されていない曲のキャッシュキー
+prefetched_videos = OrderedDict()  # 先読み済み（または先読み中）の起点videoId
+prefetch_stats = {'batches': 0, 'tracks': 0, 'hits': 0, 'wasted': 0, 'errors': 0}
 
-# 自動クリア用
+# 受信イベントの記録
+event_log = EventLogWriter(workers.worker_path(EVENT_LOG_PATH, WORKER_ID)) if EVENT_LOG_PATH else None
+
+# 自動クリア用（遅延タスクは1本のスケジューラスレッドで実行）
 IDLE_TIMEOUT = 180
-idle_timer = None
+# タイマー（monotonic）と端末の最終受信時刻（time.time）の時計のずれの許容範囲（秒）
+IDLE_CLOCK_TOLERANCE = 5
+scheduler = DeadlineScheduler('idle-scheduler')
+
+# 端末ごとの再生状態（Presenceを表示する端末は sessions.owner）
+DEFAULT_DEVICE = 'default'  # X-Device-Idを送らない端末
+# （複数ワーカーの場合は共有ストアに置き、状態の更新はプロセスをまたいで1つずつ行う）
+sessions = SessionArbiter(SESSION_PRIORITY, idle_timeout=IDLE_TIMEOUT, max_sessions=MAX_SESSIONS,
+                          store=shared_store)
 
 # 認証失敗ログ用（ブルートフォース対策）
-auth_failures = {}
 AUTH_FAILURE_THRESHOLD = 10  # 10回失敗でブロック
 AUTH_FAILURE_WINDOW = 300    # 5分間
 MAX_AUTH_FAILURE_ENTRIES = 1000  # メモリ保護: 最大追跡IP数
+auth_tracker = AuthFailureTracker(
+    threshold=AUTH_FAILURE_THRESHOLD,
+    window=AUTH_FAILURE_WINDOW,
+    max_entries=MAX_AUTH_FAILURE_ENTRIES,
+    store_path=AUTH_FAILURE_STORE if shared_store is None else '',  # 共有ストアに残るため不要
+    shared=shared_store
+)
+
+# 既存の統計値は出力時に読むだけ
+metrics.counter_func('art_cache_evictions_total', 'キャッシュ上限による削除数', lambda: image_cache.stats['evictions'])
+metrics.counter_func('art_cache_expired_total', '有効期限切れによる削除数', lambda: image_cache.stats['expired'])
+metrics.counter_func('discord_reconnects_total', 'Discord再接続の試行数', lambda: presence_writer.stats['reconnect_attempts'])
+metrics.counter_func('presence_coalesced_total', '送信前に上書きされたPresence数', lambda: presence_writer.stats['coalesced'])
+metrics.counter_func('presence_failed_total', 'Presence送信の失敗数', lambda: presence_writer.stats['failed'])
+metrics.gauge('art_cache_entries', 'キャッシュ件数', lambda: len(image_cache))
+metrics.gauge('art_cache_negative_entries', '見つからなかった曲として覚えている件数', image_cache.negative_count)
+metrics.gauge('ytmusic_circuit_open', 'YouTube Musicへの問い合わせを止めていれば1',
+              lambda: int(ytmusic_upstream.breaker.state != CircuitBreaker.CLOSED))
+metrics.gauge('discord_connected', 'Discordに接続中なら1', lambda: int(presence_writer.connected))
+metrics.gauge('threads', 'スレッド数', threading.active_count)
+metrics.gauge('sessions', '再生情報を送ってきた端末数', lambda: len(sessions))
+metrics.counter_func('session_handovers_total', 'Presenceを表示する端末の切り替え数', lambda: sessions.stats['handovers'])
+if catalogue is not None:
+    metrics.gauge('catalogue_artists', '曲目インデックスのアーティスト数', lambda: len(catalogue))
+    metrics.gauge('catalogue_tracks', '曲目インデックスの曲数', catalogue.track_count)
+    metrics.counter_func('catalogue_fills_total', '曲目インデックスの取得数', lambda: catalogue.stats['fills'])
+
+mark_startup('init')
 
 # ========================================
 #  セキュリティ関数
@@ -131,12 +333,17 @@ MAX_AUTH_FAILURE_ENTRIES = 1000  # メモリ保護: 最大追跡IP数
 
 def get_client_ip():
     """クライアントIPを取得（プロキシ対応）"""
+    return resolve_client_ip(request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+
+def resolve_client_ip(remote_addr: str | None, forwarded_for: str | None) -> str:
+    """接続元アドレスとX-Forwarded-ForからクライアントIPを決定"""
     # TRUST_PROXYが有効な場合のみX-Forwarded-Forを信頼
     # 直接接続時にこれを信頼すると、攻撃者がIPを偽装できる
-    if TRUST_PROXY and request.headers.get('X-Forwarded-For'):
+    if TRUST_PROXY and forwarded_for:
         # 最初のIPが元のクライアント
-        return request.headers.get('X-Forwarded-For').split(',')[0].strip()
-    return request.remote_addr or '0.0.0.0'
+        return forwarded_for.split(',')[0].strip()
+    return remote_addr or '0.0.0.0'
 
 
 def is_ip_allowed(ip: str) -> bool:
@@ -144,44 +351,34 @@ def is_ip_allowed(ip: str) -> bool:
     if not ALLOWED_IP_LIST:
         return True  # 許可リストが空なら全許可
     
-    # CIDR表記やワイルドカードにも対応可能だが、簡易実装として完全一致のみ
+    # 単一IP・CIDRブロック（IPv4/IPv6）に対応
     return ip in ALLOWED_IP_LIST
 
 
 def is_ip_blocked(ip: str) -> bool:
     """IPがブルートフォース対策でブロックされているか"""
-    if ip not in auth_failures:
-        return False
-    
-    failures = auth_failures[ip]
-    current_time = time.time()
-    
-    # ウィンドウ外の古い失敗を削除
-    failures = [t for t in failures if current_time - t < AUTH_FAILURE_WINDOW]
-    auth_failures[ip] = failures
-    
-    return len(failures) >= AUTH_FAILURE_THRESHOLD
+    return auth_tracker.is_blocked(ip)
 
 
 def record_auth_failure(ip: str):
     """認証失敗を記録（メモリ制限付き）"""
-    if ip not in auth_failures:
-        # メモリ保護: エントリ数が上限に達したら最も古いものを削除
-        if len(auth_failures) >= MAX_AUTH_FAILURE_ENTRIES:
-            # 最も古い失敗記録を持つIPを削除
-            oldest_ip = min(auth_failures.keys(), key=lambda k: min(auth_failures[k]) if auth_failures[k] else float('inf'))
-            del auth_failures[oldest_ip]
-        auth_failures[ip] = []
-    auth_failures[ip].append(time.time())
+    auth_failures_total.inc()
+    if auth_tracker.record_failure(ip) and AUTH_FAILURE_STORE:
+        # ブロックが発生したら少し待ってまとめて保存
+        if not scheduler.pending('auth_failure_save'):
+            scheduler.schedule('auth_failure_save', 5, auth_tracker.save)
 
 
 def check_auth() -> bool:
     """認証トークンを確認（タイミング攻撃対策付き）"""
+    return check_auth_header(request.headers.get('Authorization', ''))
+
+
+def check_auth_header(auth_header: str) -> bool:
+    """Authorizationヘッダーの値を確認"""
     if not AUTH_TOKEN:
         return True  # トークン設定がなければ認証スキップ
     
-    auth_header = request.headers.get('Authorization', '')
-    
     # Bearer プレフィックスを除去
     token = auth_header
     if auth_header.startswith('Bearer '):
@@ -191,157 +388,406 @@ def check_auth() -> bool:
     return hmac.compare_digest(token, AUTH_TOKEN)
 
 
-def sanitize_string(s: str, max_length: int = 200) -> str:
-    """文字列をサニタイズ（長さ制限、危険な文字除去）"""
-    if not isinstance(s, str):
-        s = str(s)
+def check_access(client_ip: str, auth_header: str, require_auth: bool = True) -> tuple[dict, int] | None:
+    """IP制限・ブロック・認証を確認（拒否する場合はエラーレスポンスを返す）"""
+    # IP制限チェック
+    if not is_ip_allowed(client_ip):
+        logger.warning("⛔ IP制限: %s", client_ip)
+        return {"error": "Forbidden"}, 403
+    
+    # ブルートフォース対策
+    if is_ip_blocked(client_ip):
+        logger.warning("🚫 ブロック中: %s", client_ip)
+        return {"error": "Too many failed attempts"}, 429
     
-    # 長さ制限
-    s = s[:max_length]
+    if not require_auth:
+        return None
     
-    # 制御文字を除去（改行・タブは許容）
-    s = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]', '', s)
+    # 認証チェック
+    if not check_auth_header(auth_header):
+        record_auth_failure(client_ip)
+        logger.warning("⛔ 認証失敗: %s", client_ip)
+        return {"error": "Unauthorized"}, 401
     
-    return s.strip()
+    return None
 
 
-def validate_number(value, default: float = 0, min_val: float = 0, max_val: float = float('inf')) -> float:
-    """数値をバリデーション"""
-    try:
-        num = float(value)
-        if num < min_val:
-            return min_val
-        if num > max_val:
-            return max_val
-        return num
-    except (ValueError, TypeError):
-        return default
+# レスポンスに付けるセキュリティヘッダー
+SECURITY_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+    'Referrer-Policy': 'strict-origin-when-cross-origin',
+    'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
+    'Pragma': 'no-cache',
+    # サーバー情報を隠す
+    'Server': 'YTM-RPC',
+}
 
 
 # ========================================
 #  ユーティリティ関数
 # ========================================
 
-def similar(a: str, b: str) -> float:
-    """文字列の類似度を判定（0.0〜1.0）"""
-    return SequenceMatcher(None, a.lower(), b.lower()).ratio()
-
-
 def get_cache_key(title: str, artist: str) -> str:
     """キャッシュ用のキーを生成"""
     return f"{title.lower()}|{artist.lower()}"
 
 
-def connect_rpc() -> bool:
-    """Discord RPCに接続を試みる"""
-    global RPC, rpc_connected
-    
-    with rpc_lock:
-        try:
-            if RPC is None:
-                RPC = Presence(CLIENT_ID)
-            
-            RPC.connect()
-            rpc_connected = True
-            print("✅ Discordに接続しました！")
-            return True
-        except Exception as e:
-            rpc_connected = False
-            print(f"⚠️ Discord接続失敗: {e}")
-            return False
+def get_ytmusic():
+    """YTMusicを返す（まだなければここで作る）"""
+    global yt
+    if yt is None:
+        with yt_lock:
+            if yt is None:
+                from ytmusicapi import YTMusic
+                yt = YTMusic()
+                mark_startup('ytmusic')
+    return yt
 
 
-def ensure_rpc_connection() -> bool:
-    """RPC接続を確認し、必要なら再接続"""
-    global rpc_connected
-    
-    if rpc_connected:
-        return True
-    
-    print("🔄 Discord再接続を試みます...")
-    return connect_rpc()
+def format_startup_timings() -> str:
+    """起動の節目を「名前 ミリ秒」の並びにする"""
+    return ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in startup_timings.items())
+
+
+def warm_up_ytmusic():
+    """起動直後にバックグラウンドでYTMusicを用意しておく"""
+    try:
+        get_ytmusic()
+    except Exception as e:
+        # 失敗しても最初の検索時に作り直す
+        logger.warning("⚠️ YTMusic初期化失敗: %s", e)
 
 
 def clear_presence():
     """Presenceをクリアする"""
-    global rpc_connected
-    
-    with rpc_lock:
-        if rpc_connected and RPC:
-            try:
-                RPC.clear()
-                print("🧹 Presenceをクリアしました")
-            except Exception as e:
-                print(f"⚠️ Presenceクリア失敗: {e}")
-                rpc_connected = False
+    presence_writer.post_clear()
 
 
-def reset_idle_timer():
-    """アイドルタイマーをリセット"""
-    global idle_timer
-    
-    if idle_timer:
-        idle_timer.cancel()
-    
-    idle_timer = threading.Timer(IDLE_TIMEOUT, clear_presence)
-    idle_timer.daemon = True
-    idle_timer.start()
+def reset_idle_timer(delay: float = IDLE_TIMEOUT):
+    """アイドルタイマーをリセット（締め切り時刻を更新するだけ）"""
+    scheduler.schedule('idle_clear', delay, expire_owner)
 
 
-def search_album_art(title: str, artist: str) -> tuple[str, str | None]:
-    """曲のアルバムアートを検索"""
-    global image_cache
+def expire_owner():
+    """表示中の端末から一定時間届かなかった（他に送ってきている端末があれば表示を引き継ぐ）
     
+    タイマーは monotonic、端末の最終受信時刻は time.time なので、時計が少し戻っても
+    まだ届いている扱いにならないよう、IDLE_CLOCK_TOLERANCE 秒先の時刻で選び直す。
+    """
+    now = time.time()
+    with sessions.exclusive():
+        owner, changed = sessions.elect(now + IDLE_CLOCK_TOLERANCE)
+        if changed:
+            hand_over(owner)
+        elif owner is None:
+            clear_presence()
+        else:
+            # 他のワーカーで受け付けていた場合は、最後に届いてからIDLE_TIMEOUT秒経つまで待つ
+            remaining = IDLE_TIMEOUT - (now - owner.last_seen)
+            reset_idle_timer(min(IDLE_TIMEOUT, max(IDLE_CLOCK_TOLERANCE, remaining)))
+
+
+def get_cached_album_art(cache_key: str) -> tuple[str, str | None] | None:
+    """キャッシュから画像を取得（なければNone）"""
+    cached = image_cache.get(cache_key)
+    if cached is None:
+        return None
+    return cached['image'], cached.get('video_id')
+
+
+def call_ytmusic(call: str, fn, *args, **kwargs):
+    """YouTube Music APIを予算・ブレーカー・締め切りを通して呼ぶ（応答時間と結果を記録）"""
+    started = time.perf_counter()
+    try:
+        result = ytmusic_upstream.call(fn, *args, **kwargs)
+    except UpstreamUnavailable as e:
+        ytmusic_calls_total.labels(call, e.reason).inc()
+        raise
+    except UpstreamTimeout:
+        ytmusic_calls_total.labels(call, 'timeout').inc()
+        raise
+    except Exception:
+        ytmusic_calls_total.labels(call, 'error').inc()
+        raise
+    ytmusic_seconds.labels(call).observe(time.perf_counter() - started)
+    ytmusic_calls_total.labels(call, 'ok').inc()
+    return result
+
+
+def search_album_art(title: str, artist: str, duration: float = 0) -> tuple[str, str | None]:
+    """曲のアルバムアートを検索（同じ曲の同時検索は1回にまとめる）"""
+    image_url, video_id, _ = find_album_art(title, artist, duration)
+    return image_url, video_id
+
+
+def find_album_art(title: str, artist: str, duration: float = 0) -> tuple[str, str | None, str]:
+    """search_album_art と同じ検索をして、(画像, videoId, 結果) を返す
+
+    結果は cached（キャッシュ・曲目インデックス）/ found / no_match（検索したが合う曲がない）/
+    negative（最近見つからなかった・失敗した曲として覚えている）/ error（失敗・締め切り超過）/
+    unavailable（ブレーカー・予算切れで検索しなかった）のどれか。
+    """
     cache_key = get_cache_key(title, artist)
     
-    if cache_key in image_cache:
-        cached = image_cache[cache_key]
-        print(f"📦 キャッシュヒット: {title}")
-        return cached['image'], cached.get('video_id')
+    cached = get_cached_album_art(cache_key)
+    if cached is not None:
+        art_cache_hits.inc()
+        logger.debug("📦 キャッシュヒット: %s", title)
+        return *cached, 'cached'
+    
+    # 曲目インデックスにあれば検索しない（次からはキャッシュヒット）
+    if catalogue is not None:
+        found = catalogue.lookup(title, artist, duration)
+        if found is not None:
+            art_cache_catalogue_hits.inc()
+            image_cache.put(cache_key, *found)
+            # 期限切れなら使いながら取得し直す
+            channel_id = catalogue.begin_refresh(artist)
+            if channel_id:
+                catalogue_executor.submit(fill_catalogue, artist, channel_id)
+            return *found, 'cached'
+    
+    # 先読みした曲は期限内ならそのまま使う（期限が切れたら検索し、結果で置き換える）
+    prefetched = image_cache.get_provisional(cache_key)
+    if prefetched is not None:
+        art_cache_prefetch_hits.inc()
+        note_prefetch_hit(cache_key)
+        return prefetched['image'], prefetched['video_id'], 'cached'
+    
+    # 最近見つからなかった曲は、期限が切れるまで検索しない
+    if image_cache.is_negative(cache_key):
+        art_cache_negative_hits.inc()
+        return "youtube_music_icon", None, 'negative'
     
+    art_cache_misses.inc()
+
+    def recheck():
+        cached = get_cached_album_art(cache_key)
+        return None if cached is None else (*cached, 'cached')
+
+    return art_lookups.do(cache_key, lookup_album_art, title, artist, duration, cache_key, recheck=recheck)
+
+
+def lookup_album_art(title: str, artist: str, duration: float, cache_key: str) -> tuple[str, str | None, str]:
+    """YouTube Musicで検索してキャッシュに保存し、(画像, videoId, 結果) を返す
+    
+    見つからなかった・失敗した場合は「なし」として短期間だけ覚える。
+    問い合わせを止めている（ブレーカー・予算切れ）場合は何も覚えず、次の受信で検索し直す。
+    """
     image_url = "youtube_music_icon"
     video_id = None
+    outcome = 'no_match'
     
     try:
-        search_results = yt.search(f"{title} {artist}", filter="songs")
+        search_results = call_ytmusic('search', get_ytmusic().search, f"{title} {artist}", filter="songs")
+        profiler.mark('ytmusic_search')
         
         if search_results:
-            best_match = None
-            highest_score = 0
-
-            for item in search_results:
-                res_title = item.get('title', "")
-                res_artists = item.get('artists', [])
-                res_artist_name = res_artists[0]['name'] if res_artists else ""
-
-                title_score = similar(title, res_title)
-                artist_score = similar(artist, res_artist_name)
-                total_score = (title_score + artist_score) / 2
-
-                if total_score > 0.5 and total_score > highest_score:
-                    highest_score = total_score
-                    best_match = item
+            started = time.perf_counter()
+            match, score = best_match(title, artist, search_results, duration=duration)
+            match_seconds.observe(time.perf_counter() - started)
+            profiler.mark('match')
 
-            if best_match and highest_score > 0.5:
-                thumbnails = best_match.get('thumbnails', [])
+            if match:
+                thumbnails = match.get('thumbnails', [])
                 if thumbnails:
                     image_url = thumbnails[-1]['url']
-                video_id = best_match.get('videoId')
-                print(f"✅ 画像特定 (信頼度: {highest_score:.2f}): {best_match['title']}")
+                video_id = match.get('videoId')
+                logger.info("✅ 画像特定 (信頼度: %.2f): %s", score, match['title'])
+                if catalogue is not None:
+                    schedule_catalogue_fill(artist, match)
             else:
-                print(f"⚠️ 良い画像が見つかりませんでした (最高スコア: {highest_score:.2f})")
+                logger.info("⚠️ 良い画像が見つかりませんでした: %s - %s", title, artist)
 
+    except UpstreamUnavailable as e:
+        logger.info("⏭️ 画像検索を省略 (%s): %s", e.reason, title)
+        return image_url, video_id, 'unavailable'
     except Exception as search_error:
-        print(f"🔍 画像検索失敗: {search_error}")
+        logger.warning("🔍 画像検索失敗: %s", search_error)
+        outcome = 'error'
     
     # キャッシュに保存
-    if len(image_cache) >= CACHE_MAX_SIZE:
-        oldest_key = next(iter(image_cache))
-        del image_cache[oldest_key]
+    if image_url == "youtube_music_icon" and not video_id:
+        image_cache.put_negative(cache_key)
+    else:
+        image_cache.put(cache_key, image_url, video_id)
+        outcome = 'found'
+    
+    return image_url, video_id, outcome
+
+
+def resolves_without_search(cache_key: str, title: str, artist: str, duration: float = 0) -> bool:
+    """検索せずに画像が決まるか（キャッシュ・曲目インデックス・先読みした曲・最近見つからなかった曲）"""
+    if (image_cache.get(cache_key) is not None or image_cache.get_provisional(cache_key) is not None
+            or image_cache.is_negative(cache_key)):
+        return True
+    return catalogue is not None and catalogue.lookup(title, artist, duration) is not None
+
+
+def largest_thumbnail(thumbnails) -> str | None:
+    """サムネイル一覧の最後（最大サイズ）のURL"""
+    return thumbnails[-1].get('url') if thumbnails else None
+
+
+def schedule_catalogue_fill(artist: str, match: dict):
+    """見つかった曲のアーティストの曲目を裏で取得（未取得・期限切れの場合のみ）"""
+    artists = match.get('artists') or []
+    channel_id = artists[0].get('id') if artists else None
+    if channel_id and catalogue.begin_fill(artist):
+        catalogue_executor.submit(fill_catalogue, artist, channel_id)
+
+
+def wait_for_spare_budget(timeout: float = 60):
+    """問い合わせ予算が半分以上残るまで待つ（曲目の取得で画像検索の分を使い切らないため）"""
+    bucket = ytmusic_upstream.bucket
+    deadline = time.monotonic() + timeout
+    while bucket.rate > 0 and bucket.tokens < bucket.burst / 2:
+        if time.monotonic() > deadline:
+            raise UpstreamUnavailable('budget')
+        time.sleep(1 / bucket.rate)
+
+
+def fill_catalogue(artist: str, channel_id: str):
+    """アーティストのアルバム・シングル・人気曲の曲目を取得して索引に入れる"""
+    try:
+        wait_for_spare_budget()
+        info = call_ytmusic('artist', get_ytmusic().get_artist, channel_id)
+        
+        albums = []
+        for section in ('albums', 'singles'):
+            albums.extend((info.get(section) or {}).get('results') or [])
+        
+        tracks = []
+        for album in albums[:CATALOGUE_MAX_ALBUMS]:
+            if not album.get('browseId'):
+                continue
+            wait_for_spare_budget()
+            data = call_ytmusic('album', get_ytmusic().get_album, album['browseId'])
+            image = largest_thumbnail(data.get('thumbnails') or album.get('thumbnails'))
+            for track in data.get('tracks') or []:
+                tracks.append((track.get('title'), largest_thumbnail(track.get('thumbnails')) or image,
+                               track.get('videoId'), track.get('duration_seconds') or 0))
+        
+        for song in (info.get('songs') or {}).get('results') or []:
+            tracks.append((song.get('title'), largest_thumbnail(song.get('thumbnails')), song.get('videoId'), 0))
+    except Exception as e:
+        catalogue.fail_fill(artist)
+        logger.warning("📚 曲目の取得失敗: %s (%s)", artist, e)
+        return
+    
+    tracks = [t for t in tracks if t[0] and t[1] and t[2]]
+    catalogue.store(artist, tracks, channel_id)
+    logger.info("📚 曲目を取得: %s (%d曲)", artist, len(tracks))
+
+
+def note_prefetch_hit(cache_key: str):
+    """先読みした曲が実際に再生されたら記録"""
+    with prefetch_lock:
+        if prefetched_keys.pop(cache_key, None) is not None:
+            prefetch_stats['hits'] += 1
+
+
+def schedule_prefetch(video_id: str | None):
+    """再生中の曲の次に流れる曲の画像を裏で先読み"""
+    if PREFETCH_DEPTH <= 0 or not video_id:
+        return
     
-    image_cache[cache_key] = {'image': image_url, 'video_id': video_id}
+    with prefetch_lock:
+        if video_id in prefetched_videos:
+            return
+        prefetched_videos[video_id] = True
+        while len(prefetched_videos) > PREFETCH_DEPTH * 4:
+            prefetched_videos.popitem(last=False)
     
-    return image_url, video_id
+    prefetch_executor.submit(prefetch_queue, video_id)
+
+
+def track_cache_entry(track: dict) -> tuple[str, str, str | None] | None:
+    """プレイリストの曲を (キャッシュキー, 画像URL, videoId) にする（曲名・アーティストがなければNone）
+    
+    アーティストは先頭の1人（通知のアーティスト名と同じ）、画像は最大サイズのサムネイル。
+    """
+    artists = track.get('artists') or []
+    if not track.get('title') or not artists:
+        return None
+    thumbnails = track.get('thumbnail') or track.get('thumbnails') or []
+    image_url = largest_thumbnail(thumbnails) or "youtube_music_icon"
+    return get_cache_key(track['title'], artists[0].get('name', '')), image_url, track.get('videoId')
+
+
+def prefetch_queue(video_id: str):
+    """再生キュー（ウォッチプレイリスト）を取得し、次のN曲の画像を仮の画像として覚える
+
+    再生キューの曲は通常の検索のような曲名・アーティストの照合を経ていないので、キャッシュには保存せず、
+    PREFETCH_TTL秒だけ使う（その後の検索の結果で置き換わる）。
+    """
+    try:
+        playlist = call_ytmusic('watch_playlist', get_ytmusic().get_watch_playlist,
+                                videoId=video_id, limit=PREFETCH_DEPTH + 1)
+    except UpstreamUnavailable:
+        return
+    except Exception as e:
+        with prefetch_lock:
+            prefetch_stats['errors'] += 1
+        logger.warning("🔍 先読み失敗: %s", e)
+        return
+    
+    tracks = [t for t in playlist.get('tracks', []) if t.get('videoId') != video_id]
+    stored = 0
+    
+    for track in tracks[:PREFETCH_DEPTH]:
+        entry = track_cache_entry(track)
+        if (entry is None or get_cached_album_art(entry[0]) is not None
+                or image_cache.get_provisional(entry[0]) is not None):
+            continue
+        
+        cache_key, image_url, video_id = entry
+        image_cache.put_provisional(cache_key, image_url, video_id, PREFETCH_TTL)
+        stored += 1
+        
+        with prefetch_lock:
+            prefetched_keys[cache_key] = True
+            # 再生されないまま押し出された先読みは無駄とみなす
+            while len(prefetched_keys) > PREFETCH_DEPTH * 4:
+                prefetched_keys.popitem(last=False)
+                prefetch_stats['wasted'] += 1
+    
+    with prefetch_lock:
+        prefetch_stats['batches'] += 1
+        prefetch_stats['tracks'] += stored
+    
+    if stored:
+        logger.debug("⏭️ 先読み: %d 曲をキャッシュ", stored)
+
+
+def build_buttons(video_id: str | None) -> list | None:
+    """YouTube Musicへのリンクボタンを作成"""
+    if not video_id:
+        return None
+    return [{
+        "label": "🎵 Listen on YouTube Music",
+        "url": f"https://music.youtube.com/watch?v={video_id}"
+    }]
+
+
+def enrich_presence(title: str, artist: str, duration: float, generation: int):
+    """バックグラウンドで画像を検索し、同じ曲のままならPresenceを再送信"""
+    image_url, video_id = search_album_art(title, artist, duration)
+    schedule_prefetch(video_id)
+    
+    if image_url == "youtube_music_icon" and not video_id:
+        return
+    
+    fields = {'large_image': image_url}
+    buttons = build_buttons(video_id)
+    if buttons:
+        fields['buttons'] = buttons
+    
+    # 検索中に曲が変わった・クリアされた場合は破棄
+    if not presence_writer.patch(generation, fields):
+        logger.debug("🗑️ 画像更新を破棄 (曲が変更済み): %s", title)
 
 
 # ========================================
@@ -351,44 +797,27 @@ def search_album_art(title: str, artist: str) -> tuple[str, str | None]:
 @app.before_request
 def before_request():
     """リクエストごとの前処理"""
+    g.request_started = time.perf_counter()
     client_ip = get_client_ip()
     g.client_ip = client_ip
     
-    # IP制限チェック
-    if not is_ip_allowed(client_ip):
-        print(f"⛔ IP制限: {client_ip}")
-        return jsonify({"error": "Forbidden"}), 403
-    
-    # ブルートフォース対策
-    if is_ip_blocked(client_ip):
-        print(f"🚫 ブロック中: {client_ip}")
-        return jsonify({"error": "Too many failed attempts"}), 429
-    
     # health checkは認証不要
-    if request.endpoint == 'health_check':
-        return
-    
-    # 認証チェック
-    if not check_auth():
-        record_auth_failure(client_ip)
-        print(f"⛔ 認証失敗: {client_ip}")
-        return jsonify({"error": "Unauthorized"}), 401
+    denied = check_access(
+        client_ip,
+        request.headers.get('Authorization', ''),
+        require_auth=request.endpoint != 'health_check'
+    )
+    if denied:
+        body, status = denied
+        return jsonify(body), status
 
 
 @app.after_request
 def after_request(response):
     """レスポンスにセキュリティヘッダーを追加"""
-    # セキュリティヘッダー
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-    response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    
-    # サーバー情報を隠す
-    response.headers['Server'] = 'YTM-RPC'
-    
+    response.headers.update(SECURITY_HEADERS)
+    if 'request_started' in g:
+        request_seconds.labels(request.endpoint or 'other').observe(time.perf_counter() - g.request_started)
     return response
 
 
@@ -421,8 +850,14 @@ def request_entity_too_large(e):
     return jsonify({"error": "Request too large"}), 413
 
 
+@app.errorhandler(415)
+def unsupported_media_type(e):
+    return jsonify({"error": "Unsupported Media Type"}), 415
+
+
 @app.errorhandler(429)
 def rate_limit_exceeded(e):
+    rate_limited_total.labels(request.endpoint or 'other').inc()
     return jsonify({"error": "Rate limit exceeded"}), 429
 
 
@@ -433,168 +868,584 @@ def internal_error(e):
 
 
 # ========================================
-#  APIエンドポイント
+#  再生情報の処理（Waitress / ASGI 共通）
 # ========================================
 
-last_update_time = 0
-last_calc_start_time = 0
+PAUSE_ICON = "https://img.icons8.com/ios-glyphs/60/ffffff/pause--v1.png"
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
 
 
-@app.route('/update', methods=['POST'])
-@limiter.limit(RATE_LIMIT_UPDATE)
-def update_status():
-    """再生情報を受け取りDiscord Presenceを更新"""
-    global last_title, last_artist, last_is_playing, last_update_time, last_calc_start_time
-    
-    try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "Invalid JSON"}), 400
-
-        # 入力のバリデーションとサニタイズ
-        title = sanitize_string(data.get('title', 'Unknown Title'), max_length=100)
-        artist = sanitize_string(data.get('artist', 'Unknown Artist'), max_length=100)
-        is_playing = bool(data.get('is_playing', True))
-        duration = validate_number(data.get('duration', 0), min_val=0, max_val=86400)  # 最大24時間
-        position = validate_number(data.get('position', 0), min_val=0, max_val=86400)
-        
-        print(f"📩 受信: {title} - {artist} (Pos: {position}s)")
-        
-        # 一時停止中の表示設定
-        small_image = "youtube_music_icon"
-        small_text = "Playing on Android"
-        
-        if not is_playing:
-            print("⏸️ 一時停止中")
-            small_image = "https://img.icons8.com/ios-glyphs/60/ffffff/pause--v1.png"
-            small_text = "⏸️ Paused"
-        
-        # 空文字チェック
-        if not title.strip():
-            title = "Unknown Title"
-        if not artist.strip():
-            artist = "Unknown Artist"
-        if len(title) < 2:
-            title += " "
-        if len(artist) < 2:
-            artist += " "
-
-        # シーク検知ロジック
-        current_time = time.time()
-        calc_start_time = current_time - position
-        
-        time_diff = abs(calc_start_time - last_calc_start_time)
-        is_seeked = time_diff > 2
-        
-        # 曲が変わったかどうか
-        is_new_song = (title != last_title or artist != last_artist)
-        
-        # デバッグログ
-        if is_new_song:
-            logger.info(f"🆕 新しい曲検出: {last_title} → {title}")
-        
-        # 重複更新スキップ（同じ曲・同じ状態・シークなし・60秒以内）
-        if (not is_new_song and 
-            is_playing == last_is_playing and 
-            not is_seeked and
-            current_time - last_update_time < 60):
-            
-            reset_idle_timer()
-            return jsonify({"status": "skipped"}), 200
+def get_session(device: str | None):
+    """端末IDのセッション（IDは X-Device-Id ヘッダー。なければ共通の1台として扱う）"""
+    device = clean_text(device or '', max_length=64) or DEFAULT_DEVICE
+    return sessions.session(device, time.time())
+
 
+def apply_playback_state(session, fields: dict) -> dict:
+    """端末の再生状態を更新し、判定結果（スキップ・新しい曲・シーク）を返す"""
+    with session.lock:
+        return advance_playback_state(session, fields, time.time())
+
+
+def advance_playback_state(session, fields: dict, current_time: float) -> dict:
+    """current_time時点のイベントとして端末の状態を進める（session.lock内で呼ぶ）"""
+    title = fields['title']
+    artist = fields['artist']
+    is_playing = fields['is_playing']
+    position = fields['position']
+    
+    # シーク検知ロジック
+    calc_start_time = current_time - position
+    
+    time_diff = abs(calc_start_time - session.calc_start_time)
+    is_seeked = time_diff > 2
+    
+    # 曲が変わったかどうか
+    is_new_song = (title != session.title or artist != session.artist)
+    
+    # デバッグログ
+    if is_new_song:
+        logger.info("🆕 新しい曲検出: %s → %s", session.title, title)
+    
+    # 重複更新スキップ（同じ曲・同じ状態・シークなし・60秒以内）
+    is_skipped = (not is_new_song and 
+                  is_playing == session.is_playing and 
+                  not is_seeked and
+                  current_time - session.update_time < 60)
+    
+    # 端末の選択用（最後に再生を始めた端末を優先する）
+    session.last_seen = current_time
+    session.ended = False
+    if is_playing and (is_new_song or not session.is_playing or session.fields is None):
+        session.playing_since = current_time
+    
+    if not is_skipped:
         # 曲が変わった場合は必ずタイムスタンプをリセット（position=0から開始）
         if is_new_song:
             # 新しい曲はposition=0として扱う（Android側から古いpositionが送られることがあるため）
-            last_calc_start_time = current_time
-            logger.info(f"⏱️ タイムスタンプリセット: start={int(last_calc_start_time)} (pos={position}s→0s に強制)")
+            session.calc_start_time = current_time
+            session.generation = sessions.next_generation()
+            new_songs_total.inc()
+            logger.debug("⏱️ タイムスタンプリセット: start=%d (pos=%ss→0s に強制)", session.calc_start_time, position)
         # シークした場合もタイムスタンプを更新
         elif is_seeked:
-            last_calc_start_time = calc_start_time
-            logger.info(f"⏩ シーク検出: タイムスタンプ更新")
+            session.calc_start_time = calc_start_time
+            seeks_total.inc()
+            logger.info("⏩ シーク検出: タイムスタンプ更新")
         
         # 状態更新
-        last_title = title
-        last_artist = artist
-        last_is_playing = is_playing
-        last_update_time = current_time
-
-        # Discord接続確認
-        if not ensure_rpc_connection():
-            return jsonify({"error": "Discord not connected"}), 503
-
-        # 画像検索
-        image_url, video_id = search_album_art(title, artist)
-
-        # タイムスタンプ計算（保存したstart_timeを使用して時間が進むようにする）
-        timestamps = {}
-        logger.info(f"📊 is_playing={is_playing}, duration={duration}, last_calc_start_time={int(last_calc_start_time)}")
-        if is_playing and duration > 0:
-            # 保存されたstart_timeを使用（曲変更/シーク時のみ更新される）
-            timestamps = {'start': int(last_calc_start_time)}
-            logger.info(f"⏰ Discord送信: start={timestamps['start']}")
-
-        # ボタン設定
-        buttons = None
-        if video_id:
-            buttons = [{
-                "label": "🎵 Listen on YouTube Music",
-                "url": f"https://music.youtube.com/watch?v={video_id}"
-            }]
-
-        # Discord Presence更新
-        with rpc_lock:
-            try:
-                update_args = {
-                    'details': title,
-                    'state': artist,
-                    'large_image': image_url,
-                    'large_text': "YouTube Music",
-                    'small_image': small_image,
-                    'small_text': small_text
-                }
-                
-                if timestamps:
-                    update_args['start'] = timestamps.get('start')
-                
-                if buttons:
-                    update_args['buttons'] = buttons
-                
-                RPC.update(**update_args)
-                print(f"🎵 Presence更新: {title} - {artist}")
-                
-            except Exception as rpc_error:
-                global rpc_connected
-                rpc_connected = False
-                print(f"⚠️ Presence更新失敗: {rpc_error}")
-                return jsonify({"error": "RPC error"}), 500
+        session.title = title
+        session.artist = artist
+        session.is_playing = is_playing
+        session.update_time = current_time
+        session.version = sessions.next_version()
+    session.fields = fields
+    
+    (updates_skipped if is_skipped else updates_applied).inc()
+    
+    return {
+        'skipped': is_skipped,
+        'new_song': is_new_song,
+        'seeked': is_seeked,
+        'generation': session.generation,
+        'version': session.version,
+        'start_time': session.calc_start_time,
+        'received_at': current_time
+    }
+
+
+def parse_update_batch(data, session) -> dict | None:
+    """/update/batch のボディを検証（不正ならNone）
+    
+    反映済みのシーケンス番号のイベントは、中身を検証する前に捨てる。
+    各イベントの発生時刻は、送信時刻 sent_at との差（経過秒）に変換する（端末とサーバーの時計のずれを避けるため）。
+    """
+    if not isinstance(data, dict):
+        return None
+    
+    events = data.get('events')
+    if not isinstance(events, list) or not 0 < len(events) <= MAX_BATCH_EVENTS:
+        return None
+    
+    stream = clean_text(data.get('stream', ''), max_length=64)
+    sent_at = clamp_number(data.get('sent_at', 0))
+    
+    with session.lock:
+        floor = session.seq if stream == session.stream else -1
+    
+    parsed = []
+    for event in events:
+        if not isinstance(event, dict):
+            return None
+        seq = event.get('seq')
+        if not isinstance(seq, int) or isinstance(seq, bool):
+            return None
+        if seq <= floor:
+            continue
+        
+        fields = parse_update(event)
+        if fields is None:
+            return None
+        
+        age = 0
+        if sent_at:
+            age = clamp_number(sent_at - clamp_number(event.get('ts', sent_at)), max_val=86400)
+        parsed.append((seq, age, fields))
+    
+    parsed.sort(key=lambda e: e[0])
+    return {'stream': stream, 'events': parsed, 'stale': len(events) - len(parsed)}
+
+
+def apply_playback_batch(session, batch: dict) -> tuple[dict, dict | None, int]:
+    """イベントを順に端末の状態へ反映し、(判定結果, 最後の状態, 反映数) を返す
+    
+    途中のイベントは曲の切り替え・シークの検知にだけ使い、Presenceは最後の状態だけを送る。
+    """
+    now = time.time()
+    final = None
+    applied = 0
+    changed = new_song = seeked = False
+    event_time = 0
+    
+    with session.lock:
+        if batch['stream'] != session.stream:
+            session.stream = batch['stream']
+            session.seq = -1
+        
+        for seq, age, fields in batch['events']:
+            if seq <= session.seq:
+                continue  # 重複、または同時に届いた別の一括で反映済み
+            session.seq = seq
+            
+            # 発生順を保ったままサーバーの時刻に直す
+            event_time = max(event_time, now - age)
+            step = advance_playback_state(session, fields, event_time)
+            if not step['skipped']:
+                changed = True
+                new_song = new_song or step['new_song']
+                seeked = seeked or step['seeked']
+            final = fields
+            applied += 1
+        
+        decision = {
+            'skipped': not changed,
+            'new_song': new_song,
+            'seeked': seeked,
+            'generation': session.generation,
+            'version': session.version,
+            'start_time': session.calc_start_time,
+            'received_at': now,
+            # イベントログに中身を残す（replay_events.py が同じ一括を送り直せるように）
+            'stream': batch['stream'],
+            'events': batch['events']
+        }
+    
+    return decision, final, applied
+
+
+def arbitrate(session, decision: dict) -> str:
+    """端末の更新を反映した後、Presenceをどうするか決める
+    
+    'publish': この端末が表示中で、状態が変わった（または表示を引き継いだ）
+    'skip': この端末が表示中で、状態は変わっていない
+    'standby': 別の端末が表示中（この端末の状態は覚えておき、表示が空いたら引き継ぐ）
+    """
+    decision['device'] = session.device
+    owner, changed = sessions.elect(decision['received_at'])
+    if owner is session:
+        if changed:
+            logger.debug("🔀 表示する端末: %s", session.device)
+            # 他の端末が送った状態より新しい状態として扱う
+            decision['version'] = sessions.next_version()
+            return 'publish'
+        return 'skip' if decision['skipped'] else 'publish'
+    
+    if changed:
+        hand_over(owner)
+    decision['standby'] = True
+    return 'standby'
+
+
+def hand_over(session):
+    """表示する端末が変わった時に、その端末の最後の状態でPresenceを送り直す（Noneならクリア）"""
+    if session is not None:
+        with session.lock:
+            fields = session.fields
+            decision = {
+                'skipped': False,
+                'new_song': False,
+                'seeked': False,
+                'generation': session.generation,
+                'version': sessions.next_version(),
+                'start_time': session.calc_start_time,
+                'received_at': time.time()
+            }
+    if session is None or fields is None:
+        scheduler.cancel('idle_clear')
+        clear_presence()
+        return
+    
+    logger.info("🔀 表示する端末を切り替え: %s", session.device)
+    cache_key = get_cache_key(fields['title'], fields['artist'])
+    if resolves_without_search(cache_key, fields['title'], fields['artist'], fields['duration']):
+        image_url, video_id = search_album_art(fields['title'], fields['artist'], fields['duration'])
+        publish_playback(fields, decision, image_url, video_id)
+    else:
+        publish_playback(fields, decision, "youtube_music_icon", None, lookup_pending=True)
+
+
+def resolve_album_art(fields: dict) -> tuple[str, str | None, bool, bool]:
+    """画像を決める（画像URL, videoId, 後で検索するか, キャッシュヒットか）
+    
+    非同期モードでキャッシュにない場合は、先にプレースホルダーで表示する。
+    """
+    cache_key = get_cache_key(fields['title'], fields['artist'])
+    cache_hit = image_cache.get(cache_key) is not None or image_cache.get_provisional(cache_key) is not None
+    if (not cache_hit and ASYNC_ART_LOOKUP
+            and not resolves_without_search(cache_key, fields['title'], fields['artist'], fields['duration'])):
+        return "youtube_music_icon", None, True, False
+    
+    image_url, video_id = search_album_art(fields['title'], fields['artist'], fields['duration'])
+    return image_url, video_id, False, cache_hit
+
+
+def log_event(kind: int, fields: dict | None, decision: dict, started: float,
+              cache_hit: bool = False, lookup_pending: bool = False):
+    """処理済みのイベントを判定結果・処理時間付きでログに出す（EVENT_LOG_PATHが設定されていればバイナリログにも記録）"""
+    elapsed = time.perf_counter() - started
+    fields = fields or {}
+    flags = decision_flags(decision, fields.get('is_playing', False), cache_hit, lookup_pending,
+                           decision.get('standby', False))
+    
+    if logger.isEnabledFor(logging.INFO):
+        if fields:
+            label = f"{fields['title']} - {fields['artist']} (Pos: {fields['position']}s)"
+        else:
+            label = "Presenceクリア"
+        logger.info("📩 %s: %s [%s] %.1fms", KIND_NAMES[kind], label, describe_flags(flags), elapsed * 1000, extra={
+            'event': KIND_NAMES[kind],
+            'device': decision.get('device', ''),
+            'title': fields.get('title', ''),
+            'artist': fields.get('artist', ''),
+            'position': fields.get('position', 0),
+            'decision': describe_flags(flags),
+            'elapsed_ms': round(elapsed * 1000, 3),
+        })
+    
+    if event_log is None:
+        return
+    
+    received_at = decision.get('received_at') or time.time()
+    device = decision.get('device', '')
+    stream = decision.get('stream', '')
+    if kind == KIND_BATCH:
+        # 一括の中身を先に（発生時刻はサーバーの時刻に直したもの）
+        for seq, age, item in decision.get('events', ()):
+            event_log.append(
+                received_at - age, KIND_BATCH_EVENT, FLAG_PLAYING if item['is_playing'] else 0,
+                item['title'], item['artist'], item['duration'], item['position'], 0, device, seq, stream
+            )
+    event_log.append(
+        received_at,
+        kind,
+        flags,
+        fields.get('title', ''),
+        fields.get('artist', ''),
+        fields.get('duration', 0),
+        fields.get('position', 0),
+        elapsed,
+        device,
+        0,
+        stream
+    )
+    # ディスクへの書き出しはまとめて行う
+    if not scheduler.pending('event_log_flush'):
+        scheduler.schedule('event_log_flush', 1, event_log.flush)
+
+
+def publish_playback(fields: dict, decision: dict, image_url: str, video_id: str | None,
+                     lookup_pending: bool = False) -> tuple[dict, int]:
+    """Presenceを送信スレッドに渡し、レスポンスを返す"""
+    title = fields['title']
+    artist = fields['artist']
+    is_playing = fields['is_playing']
+    duration = fields['duration']
+    start_time = decision['start_time']
+    
+    # 一時停止中の表示設定
+    small_image = "youtube_music_icon"
+    small_text = "Playing on Android"
+    
+    if not is_playing:
+        small_image = PAUSE_ICON
+        small_text = "⏸️ Paused"
+    
+    # タイムスタンプ計算（保存したstart_timeを使用して時間が進むようにする）
+    timestamps = {}
+    logger.debug("📊 is_playing=%s, duration=%s, last_calc_start_time=%d", is_playing, duration, start_time)
+    if is_playing and duration > 0:
+        # 保存されたstart_timeを使用（曲変更/シーク時のみ更新される）
+        timestamps = {'start': int(start_time)}
+        logger.debug("⏰ Discord送信: start=%d", timestamps['start'])
+    
+    # Discord Presence更新
+    update_args = {
+        'details': title,
+        'state': artist,
+        'large_image': image_url,
+        'large_text': "YouTube Music",
+        'small_image': small_image,
+        'small_text': small_text
+    }
+    
+    if timestamps:
+        update_args['start'] = timestamps.get('start')
+    
+    buttons = build_buttons(video_id)
+    if buttons:
+        update_args['buttons'] = buttons
+    
+    # 送信は送信スレッドに任せる（古い状態が後から届いた場合は破棄される）
+    presence_writer.post(update_args, decision['generation'], decision['version'])
+    
+    # 画像は裏で取得して、取得後にもう一度Presenceを更新
+    if lookup_pending:
+        art_executor.submit(enrich_presence, title, artist, duration, decision['generation'])
+    elif decision['new_song']:
+        schedule_prefetch(video_id)
+    
+    reset_idle_timer()
+    
+    if not presence_writer.connected:
+        return {"error": "Discord not connected"}, 503
+    return {"status": "ok"}, 200
+
+
+def process_update(data, device: str | None = None) -> tuple[dict, int]:
+    """再生情報を処理してPresenceを更新（レスポンスとステータスを返す）"""
+    started = time.perf_counter()
+    fields = parse_update(data)
+    profiler.mark('parse')
+    if fields is None:
+        return {"error": "Invalid JSON"}, 400
+    
+    session = get_session(device)
+    with sessions.exclusive():
+        decision = apply_playback_state(session, fields)
+        action = arbitrate(session, decision)
+    profiler.mark('state')
+    if action != 'publish':
+        if action == 'skip':
+            reset_idle_timer()
+        log_event(KIND_UPDATE, fields, decision, started)
+        profiler.mark('log')
+        return {"status": "skipped" if action == 'skip' else "standby"}, 200
+    
+    image_url, video_id, lookup_pending, cache_hit = resolve_album_art(fields)
+    profiler.mark('art')
+    result = publish_playback(fields, decision, image_url, video_id, lookup_pending)
+    profiler.mark('publish')
+    log_event(KIND_UPDATE, fields, decision, started, cache_hit, lookup_pending)
+    profiler.mark('log')
+    return result
+
+
+def process_update_batch(data, device: str | None = None) -> tuple[dict, int]:
+    """まとめて届いた再生情報を最後の状態に畳み込み、Presenceを1回だけ更新"""
+    started = time.perf_counter()
+    session = get_session(device)
+    batch = parse_update_batch(data, session)
+    profiler.mark('parse')
+    if batch is None:
+        return {"error": "Invalid JSON"}, 400
+    
+    with sessions.exclusive():
+        decision, fields, applied = apply_playback_batch(session, batch)
+        action = arbitrate(session, decision) if fields is not None else 'skip'
+    profiler.mark('state')
+    logger.info("📨 一括受信: %d件反映 / %d件破棄", applied, batch['stale'])
+    result = {"applied": applied, "stale": batch['stale']}
+    if action != 'publish':
+        if action == 'skip':
+            reset_idle_timer()
+        if fields is not None:
+            log_event(KIND_BATCH, fields, decision, started)
+        profiler.mark('log')
+        return dict(result, status="skipped" if action == 'skip' else "standby"), 200
+    
+    image_url, video_id, lookup_pending, cache_hit = resolve_album_art(fields)
+    profiler.mark('art')
+    body, status = publish_playback(fields, decision, image_url, video_id, lookup_pending)
+    profiler.mark('publish')
+    log_event(KIND_BATCH, fields, decision, started, cache_hit, lookup_pending)
+    profiler.mark('log')
+    return dict(body, **result), status
+
+
+def process_pause(device: str | None = None) -> tuple[dict, int]:
+    """一時停止時にPresenceをクリア（他に再生中の端末があれば、その端末の表示に切り替える）"""
+    started = time.perf_counter()
+    session = get_session(device)
+    with sessions.exclusive():
+        sessions.end(session)
+        owner, changed = sessions.elect(time.time())
+        if changed:
+            hand_over(owner)
+        elif owner is None:
+            scheduler.cancel('idle_clear')
+            clear_presence()
+    log_event(KIND_PAUSE, None, {'device': session.device}, started)
+    return {"status": "cleared" if owner is None else "standby"}, 200
+
+
+def build_health() -> dict:
+    """ヘルスチェックの内容"""
+    health = {
+        "status": "running",
+        "discord_connected": presence_writer.connected,
+        "cache_size": len(image_cache),
+        "auth_enabled": bool(AUTH_TOKEN),
+        "ip_restriction": bool(ALLOWED_IP_LIST),
+        "presence": presence_writer.health(),
+        "sessions": sessions.health(time.time()),
+        "ytmusic": ytmusic_upstream.health(),
+        "body_formats": body_formats(),
+        # サブシステムごとの準備状況（YTMusicは起動後に用意する）
+        "ready": {
+            "http": 'http' in startup_timings,
+            "ytmusic": yt is not None,
+            "discord": presence_writer.connected,
+        },
+        "startup_ms": {name: round(seconds * 1000, 1) for name, seconds in startup_timings.items()}
+    }
+    
+    if catalogue is not None:
+        health["catalogue"] = catalogue.health()
+    
+    if PREFETCH_DEPTH > 0:
+        with prefetch_lock:
+            health["prefetch"] = dict(prefetch_stats, pending=len(prefetched_keys))
+    
+    return health
+
+
+def render_metrics() -> str:
+    """/metrics の本文（WORKERS > 1 ならカウンター・ヒストグラムは全プロセスの合計）"""
+    if shared_store is None:
+        return metrics.render()
+    return metrics.render(others=shared_store.read_metrics(exclude=WORKER_ID))
+
+
+def share_metrics():
+    """このプロセスのメトリクスを共有ストアに置く（WORKERS > 1 の場合、METRICS_SHARE_INTERVAL秒ごと）"""
+    try:
+        shared_store.publish_metrics(WORKER_ID, metrics.snapshot())
+    except Exception as e:
+        logger.warning("⚠️ メトリクスの共有に失敗: %s", e)
+    scheduler.schedule('metrics_share', METRICS_SHARE_INTERVAL, share_metrics)
+
+
+def run_profile(seconds, output: str = 'json') -> tuple[dict | str, int]:
+    """/debug/profile の本体（seconds秒間プロファイルを取り、JSONか collapsed stacks のテキストを返す）"""
+    if PROFILE_MAX_SECONDS <= 0:
+        return {"error": "Not Found"}, 404
+    seconds = clamp_number(seconds, default=5, min_val=0.1, max_val=PROFILE_MAX_SECONDS)
+    
+    logger.info("🔬 プロファイル開始: %.1f秒", seconds)
+    try:
+        result = profiler.run(seconds)
+    except ProfilerBusy:
+        return {"error": "Profile already running"}, 409
+    logger.info("🔬 プロファイル終了: %dサンプル / %dリクエスト", result['samples'], result['spans']['requests'])
+    
+    if output == 'collapsed':
+        return result['collapsed'] + '\n', 200
+    return result, 200
+
+
+# ========================================
+#  APIエンドポイント
+# ========================================
+
+def read_body():
+    """リクエストの本文をデコード（JSON・MessagePack。読めなければ400、受け付けない形式なら415）"""
+    try:
+        return decode_body(request.get_data(cache=False), request.content_type)
+    except UnsupportedFormat:
+        abort(415)
+    except ValueError:
+        abort(400)
+
+
+@app.route('/update', methods=['POST'])
+@limiter.limit(RATE_LIMIT_UPDATE)
+def update_status():
+    """再生情報を受け取りDiscord Presenceを更新"""
+    profiler.begin('update')
+    try:
+        data = read_body()
+        profiler.mark('read')
+        body, status = process_update(data, request.headers.get('X-Device-Id'))
+        return jsonify(body), status
         
-        reset_idle_timer()
-        return jsonify({"status": "ok"}), 200
+    except HTTPException:
+        raise  # 本文が読めない（400・415）
+    except Exception as e:
+        logger.exception("❌ エラー: %s", e)
+        return jsonify({"error": "Internal server error"}), 500
+    finally:
+        profiler.end()
+
+
+@app.route('/update/batch', methods=['POST'])
+@limiter.limit(RATE_LIMIT_UPDATE)
+def update_batch():
+    """オフライン中に溜まった再生情報をまとめて受け取る"""
+    profiler.begin('batch')
+    try:
+        data = read_body()
+        profiler.mark('read')
+        body, status = process_update_batch(data, request.headers.get('X-Device-Id'))
+        return jsonify(body), status
         
+    except HTTPException:
+        raise  # 本文が読めない（400・415）
     except Exception as e:
-        print(f"❌ エラー: {e}")
+        logger.exception("❌ エラー: %s", e)
         return jsonify({"error": "Internal server error"}), 500
+    finally:
+        profiler.end()
 
 
 @app.route('/pause', methods=['POST'])
 @limiter.limit("30/minute")
 def pause_status():
     """一時停止時にPresenceをクリア"""
-    clear_presence()
-    return jsonify({"status": "cleared"}), 200
+    body, status = process_pause(request.headers.get('X-Device-Id'))
+    return jsonify(body), status
 
 
 @app.route('/health', methods=['GET'])
 @limiter.limit("10/minute")
 def health_check():
     """ヘルスチェック用エンドポイント"""
-    return jsonify({
-        "status": "running",
-        "discord_connected": rpc_connected,
-        "cache_size": len(image_cache),
-        "auth_enabled": bool(AUTH_TOKEN),
-        "ip_restriction": bool(ALLOWED_IP_LIST)
-    }), 200
+    return jsonify(build_health()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """Prometheus形式のメトリクス"""
+    return Response(render_metrics(), mimetype=METRICS_CONTENT_TYPE)
+
+
+@app.route('/debug/profile', methods=['GET'])
+@limiter.limit("2/minute")
+def debug_profile():
+    """全スレッドのサンプリングプロファイルと、/update の処理段階ごとの時間（計測中はこのスレッドを使う）"""
+    body, status = run_profile(request.args.get('seconds', 5), request.args.get('format', 'json'))
+    if isinstance(body, str):
+        return Response(body, mimetype='text/plain')
+    return jsonify(body), status
 
 
 # ========================================
@@ -603,31 +1454,90 @@ def health_check():
 
 def cleanup():
     """終了時のクリーンアップ"""
-    global idle_timer
-    
     print("🛑 サーバー終了処理中...")
     
-    if idle_timer:
-        idle_timer.cancel()
+    scheduler.stop()
     
-    clear_presence()
+    art_executor.shutdown(wait=False, cancel_futures=True)
+    prefetch_executor.shutdown(wait=False, cancel_futures=True)
+    catalogue_executor.shutdown(wait=False, cancel_futures=True)
+    ytmusic_upstream.shutdown()
     
-    with rpc_lock:
-        if RPC:
-            try:
-                RPC.close()
-            except:
-                pass
+    # Presenceのクリアと切断は送信スレッドが行う
+    presence_writer.close()
+    
+    image_cache.close()
+    if event_log is not None:
+        event_log.close()
+    if auth_tracker.dirty:
+        auth_tracker.save()
+    
+    # 溜まったログを書き出してから終了
+    log_listener.stop()
 
 
 atexit.register(cleanup)
 
 
+# ========================================
+#  複数ワーカー（WORKERS > 1）
+# ========================================
+
+def serve_supervisor():
+    """親プロセス: ポートを開いてワーカーを起動し、Discordへの送信だけを受け持つ"""
+    sock = workers.listen_socket(SERVER_HOST, SERVER_PORT)
+    mark_startup('http')
+    
+    # 前回の起動で残った再生状態は捨てる（キャッシュ・レート制限・認証失敗は引き継ぐ）
+    shared_store.reset_playback()
+    shared_store.reset_metrics()
+    share_metrics()  # Discordへの送信の記録は親プロセスにある
+    presence_writer.start()
+    relay = workers.PresenceRelay(shared_store, presence_writer)
+    relay.start()
+    
+    pool = workers.WorkerPool(WORKERS, sock, [os.path.abspath(__file__)])
+    pool.start()
+    print(f"⏱️  起動時間: {format_startup_timings()}")
+    print(f"🚀 サーバー稼働中... ({SERVER_MODE}, {WORKERS} workers) (Press CTRL+C to quit)")
+    
+    # SIGTERMでもワーカーを止めてから終了する
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        pool.supervise()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+        relay.stop()
+        sock.close()
+
+
+def serve_worker():
+    """ワーカープロセス: 親プロセスから受け継いだソケットで受け付ける"""
+    sock = workers.inherited_socket()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    threading.Thread(target=warm_up_ytmusic, name='ytmusic-init', daemon=True).start()
+    logger.info("👷 ワーカー%d 起動 (pid %d)", WORKER_ID, os.getpid())
+    share_metrics()
+    
+    if SERVER_MODE == 'asgi':
+        from asgi_server import serve_asgi
+        serve_asgi(sys.modules[__name__], SERVER_HOST, SERVER_PORT, art_timeout=ART_LOOKUP_TIMEOUT, sock=sock)
+    else:
+        http_server = create_server(app, sockets=[sock])
+        mark_startup('http')
+        http_server.run()
+
+
 # ========================================
 #  メイン
 # ========================================
 
-if __name__ == '__main__':
+if __name__ == '__main__' and MULTI_PROCESS and WORKER_ID:
+    serve_worker()
+
+elif __name__ == '__main__':
     print("=" * 60)
     print("🎵 YouTube Music Discord Presence Server")
     print("   セキュリティ強化版 (外部公開対応)")
@@ -642,22 +1552,44 @@ if __name__ == '__main__':
         print("🔒 認証: 有効")
     
     if ALLOWED_IP_LIST:
-        print(f"🌐 IP制限: 有効 ({len(ALLOWED_IP_LIST)} IPs)")
+        print(f"🌐 IP制限: 有効 ({len(ALLOWED_IP_LIST)} ranges)")
     else:
         print("🌐 IP制限: 無効 (全IP許可)")
     
     print(f"⏱️  レート制限: {RATE_LIMIT_UPDATE} (update)")
+    print(f"📦 キャッシュ: {len(image_cache)} 件読み込み ({CACHE_DB_PATH or 'メモリのみ'})")
     print(f"📡 サーバー: http://{SERVER_HOST}:{SERVER_PORT}")
     print(f"🔑 Client ID: {CLIENT_ID[:8]}...")
+    if MULTI_PROCESS:
+        print(f"👷 ワーカー: {WORKERS} プロセス (共有ストア: {SHARED_STATE_PATH})")
+        if not CACHE_DB_PATH:
+            print("⚠️  CACHE_DB_PATHが空のため、画像キャッシュはワーカー間で共有されません")
+    elif WORKERS > 1:
+        print("⚠️  WORKERS はPOSIX環境でのみ使えます。1プロセスで起動します")
     print("=" * 60)
     
-    # 初回接続
-    connect_rpc()
-    
-    # Waitressサーバー起動
-    print("🚀 サーバー稼働中... (Press CTRL+C to quit)")
+    # サーバー起動（ポートを先に開き、Discord接続とYTMusicの用意は裏で行う）
     try:
-        serve(app, host=SERVER_HOST, port=SERVER_PORT)
+        if MULTI_PROCESS:
+            serve_supervisor()
+        elif SERVER_MODE == 'asgi':
+            from asgi_server import serve_asgi
+            presence_writer.start()
+            threading.Thread(target=warm_up_ytmusic, name='ytmusic-init', daemon=True).start()
+            print(f"🚀 サーバー稼働中... ({SERVER_MODE}) (Press CTRL+C to quit)")
+            serve_asgi(sys.modules[__name__], SERVER_HOST, SERVER_PORT, art_timeout=ART_LOOKUP_TIMEOUT)
+        else:
+            http_server = create_server(app, host=SERVER_HOST, port=SERVER_PORT)
+            mark_startup('http')
+            
+            # 送信スレッド起動（初回接続も送信スレッドで行う）
+            presence_writer.start()
+            threading.Thread(target=warm_up_ytmusic, name='ytmusic-init', daemon=True).start()
+            
+            print(f"⏱️  起動時間: {format_startup_timings()}")
+            print(f"🚀 サーバー稼働中... ({SERVER_MODE}) (Press CTRL+C to quit)")
+            http_server.print_listen("Serving on http://{}:{}")
+            http_server.run()
     except OSError as e:
         print(f"❌ 起動エラー: {e}")
-        print("ポートが既に使用されている可能性があります。")
\ No newline at end of file
+        print("ポートが既に使用されている可能性があります。")
@@ -0,0 +1,221 @@
+"""
+端末ごとの再生セッション
+複数の端末（スマホ・タブレットなど）から届く再生情報を端末ごとに分けて持ち、
+Discordに表示する端末を1台だけ選ぶ
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class PlaybackSession:
+    """1台の端末の再生状態（状態の読み書きは lock の中で行う）"""
+
+    __slots__ = (
+        'device', 'lock', 'title', 'artist', 'is_playing', 'update_time', 'calc_start_time',
+        'generation', 'version', 'stream', 'seq', 'fields', 'playing_since', 'last_seen', 'ended'
+    )
+
+    def __init__(self, device: str):
+        self.device = device
+        self.lock = threading.Lock()
+        self.title = ""
+        self.artist = ""
+        self.is_playing = True
+        self.update_time = 0.0  # 最後に状態を反映した時刻
+        self.calc_start_time = 0.0  # 再生開始時刻（曲の切り替え・シークで更新）
+        self.generation = 0  # 今の曲の世代番号（古い画像検索結果の破棄用）
+        self.version = 0  # 最後に反映した状態の順序
+        self.stream = ""  # /update/batch の送信元ストリーム（アプリの起動ごとに変わる）
+        self.seq = -1  # そのストリームで反映済みの最大シーケンス番号
+        self.fields = None  # 最後に反映した再生情報（表示を引き継ぐときに使う）
+        self.playing_since = 0.0  # 停止中から再生に変わった時刻（「最後に再生を始めた端末」の判定用）
+        self.last_seen = 0.0  # 最後に何か届いた時刻
+        self.ended = False  # /pause・無通信で再生を終えた
+
+    # 共有ストアに保存する項目（WORKERS > 1 の場合）
+    STATE = ('title', 'artist', 'is_playing', 'update_time', 'calc_start_time', 'generation', 'version',
+             'stream', 'seq', 'fields', 'playing_since', 'last_seen', 'ended')
+
+    def to_state(self) -> dict:
+        return {name: getattr(self, name) for name in self.STATE}
+
+    def load_state(self, state: dict):
+        for name in self.STATE:
+            setattr(self, name, state[name])
+
+
+class SessionArbiter:
+    """セッションを端末IDごとに持ち、Presenceを表示する端末（オーナー）を選ぶ
+
+    選び方:
+      1. idle_timeout秒以内に届いていて、終了していない端末だけが候補
+      2. 再生中の端末があれば、その中から priority（先頭ほど優先、載っていない端末は最後）が高いもの、
+         同じなら最後に再生を始めたものを選ぶ
+      3. 再生中の端末がなければ、今のオーナーが候補に残っていればそのまま（一時停止中の表示）、
+         いなければ最後に届いた端末
+
+    storeを指定すると、セッション・オーナー・番号を複数のプロセスで共有する。
+    状態を読み書きする処理は exclusive() の中で行う（プロセスをまたいで1つずつ実行される）。
+    """
+
+    def __init__(self, priority: list | tuple = (), idle_timeout: float = 180, max_sessions: int = 16,
+                 store=None):
+        self.priority = {device: rank for rank, device in enumerate(priority)}
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max(1, max_sessions)
+        self.store = store
+        self.owner = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.stats = {'handovers': 0}
+        # 曲の世代番号・状態の順序は全端末で共通に数える
+        self.counters = {'generation': 0, 'version': 0}
+        self._exclusive = threading.RLock()
+        self._depth = 0
+        self._rev = None  # 読み込み済みの共有ストアの版
+        self._saved = {}  # device -> 最後に読み書きした状態
+        self._saved_meta = None  # 最後に読み書きしたオーナー・番号
+
+    def session(self, device: str, now: float) -> PlaybackSession:
+        """端末のセッション（なければ作る。上限を超えたら最も長く届いていない端末を捨てる）"""
+        session = self._sessions.get(device)
+        if session is not None:
+            return session
+
+        evicted = None
+        with self._lock:
+            session = self._sessions.get(device)
+            if session is None:
+                if len(self._sessions) >= self.max_sessions:
+                    others = [s for s in self._sessions.values() if s is not self.owner]
+                    if others:
+                        evicted = min(others, key=lambda s: s.last_seen).device
+                        del self._sessions[evicted]
+                        self._saved.pop(evicted, None)
+                session = PlaybackSession(device)
+                session.last_seen = now
+                self._sessions[device] = session
+                logger.info("📱 新しい端末: %s", device)
+
+        # 共有ストアのロックは self._lock の外で取る（exclusive() と逆順にならないように）
+        if evicted is not None and self.store is not None:
+            self.store.delete_session(evicted)
+        return session
+
+    def next_generation(self) -> int:
+        with self._lock:
+            self.counters['generation'] += 1
+            return self.counters['generation']
+
+    def next_version(self) -> int:
+        with self._lock:
+            self.counters['version'] += 1
+            return self.counters['version']
+
+    def elect(self, now: float) -> tuple[PlaybackSession | None, bool]:
+        """オーナーを選び直し、(オーナー, オーナーが変わったか) を返す"""
+        with self._lock:
+            candidates = [
+                s for s in self._sessions.values()
+                if s.fields is not None and not s.ended and now - s.last_seen < self.idle_timeout
+            ]
+            playing = [s for s in candidates if s.is_playing]
+
+            if playing:
+                lowest = len(self.priority)
+                owner = min(playing, key=lambda s: (self.priority.get(s.device, lowest), -s.playing_since))
+            elif self.owner in candidates:
+                owner = self.owner
+            else:
+                owner = max(candidates, key=lambda s: s.last_seen, default=None)
+
+            changed = owner is not self.owner
+            if changed:
+                self.owner = owner
+                self.stats['handovers'] += 1
+            return owner, changed
+
+    def end(self, session: PlaybackSession):
+        """端末の再生を終わったものとして候補から外す（次に届いたら戻る）"""
+        with session.lock:
+            session.ended = True
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    # ----------------------------------------
+    #  複数プロセスでの共有
+    # ----------------------------------------
+
+    @contextmanager
+    def exclusive(self):
+        """共有ストアから状態を読み込み、抜ける時に変わった分を書き戻す（storeがなければ何もしない）"""
+        if self.store is None:
+            yield
+            return
+
+        with self._exclusive:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            with self.store.transaction():
+                self._depth = 1
+                try:
+                    self._load()
+                    yield
+                    self._save()
+                finally:
+                    self._depth = 0
+
+    def _load(self):
+        meta = self.store.get_meta('sessions')
+        if meta is None or meta['rev'] == self._rev:
+            return  # 前回書き込んでから他のプロセスは書いていない
+
+        states = self.store.load_sessions()
+        with self._lock:
+            for device, state in states.items():
+                session = self._sessions.get(device)
+                if session is None:
+                    session = self._sessions[device] = PlaybackSession(device)
+                session.load_state(state)
+                self._saved[device] = state
+            self.owner = self._sessions.get(meta['owner'])
+            self.counters.update(meta['counters'])
+            self.stats['handovers'] = meta['handovers']
+            self._rev = meta.pop('rev')
+            self._saved_meta = meta
+
+    def _save(self):
+        changed = False
+        for device, session in list(self._sessions.items()):
+            state = session.to_state()
+            if state['fields'] is not None and state != self._saved.get(device):
+                self.store.save_session(device, state)
+                self._saved[device] = state
+                changed = True
+
+        meta = {
+            'owner': self.owner.device if self.owner else None,
+            'counters': dict(self.counters),
+            'handovers': self.stats['handovers'],
+        }
+        if changed or meta != self._saved_meta:
+            self._rev = (self._rev or 0) + 1
+            self._saved_meta = meta
+            self.store.set_meta('sessions', dict(meta, rev=self._rev))
+
+    def health(self, now: float) -> dict:
+        with self._lock:
+            active = sum(1 for s in self._sessions.values()
+                         if not s.ended and now - s.last_seen < self.idle_timeout)
+            return dict(self.stats, sessions=len(self._sessions), active=active)
@@ -0,0 +1,295 @@
+"""
+複数のワーカープロセスで共有する状態（WORKERS > 1 の場合）
+SQLite（WAL・メモリマップ）のファイル1つに、レート制限のカウンター・認証失敗・端末ごとの再生状態・
+表示したいPresenceを置く。書き込みはトランザクション（BEGIN IMMEDIATE）でプロセスをまたいで1つずつ行う
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from limits.storage import Storage
+
+MMAP_SIZE = 64 * 1024 * 1024  # 読み取りはメモリマップ経由（ページキャッシュを共有する）
+PURGE_EVERY = 1000  # この回数書き込むごとに期限切れの行を削除
+
+
+class SharedStore:
+    """プロセス間で共有する状態（1プロセスにつき1接続。スレッド間はロックで順に使う）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        self._lock = threading.RLock()
+        self._depth = 0  # transaction() の入れ子の深さ
+        self._writes = 0
+
+        with self.transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS counters ('
+                       ' key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires_at REAL NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS auth_failures (ip TEXT NOT NULL, at REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS idx_auth_failures_ip ON auth_failures(ip, at)')
+            db.execute('CREATE TABLE IF NOT EXISTS auth_blocks (ip TEXT PRIMARY KEY, until REAL NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS sessions (device TEXT PRIMARY KEY, state TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS metrics (process INTEGER PRIMARY KEY, snapshot TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS presence ('
+                       ' id INTEGER PRIMARY KEY CHECK (id = 1), seq INTEGER NOT NULL,'
+                       ' generation INTEGER NOT NULL, version INTEGER NOT NULL, desired TEXT)')
+            db.execute('INSERT OR IGNORE INTO presence (id, seq, generation, version, desired) VALUES (1, 0, 0, 0, NULL)')
+
+    @contextmanager
+    def transaction(self):
+        """書き込みのトランザクション（他のプロセスの書き込みは終わるまで待つ。入れ子にできる）"""
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self._db
+                finally:
+                    self._depth -= 1
+                return
+
+            self._db.execute('BEGIN IMMEDIATE')
+            self._depth = 1
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            else:
+                self._db.execute('COMMIT')
+            finally:
+                self._depth = 0
+
+    def _purge(self, db, now: float):
+        """たまに期限切れの行をまとめて削除（トランザクション内で呼ぶ）"""
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            db.execute('DELETE FROM counters WHERE expires_at <= ?', (now,))
+            db.execute('DELETE FROM auth_blocks WHERE until <= ?', (now,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # ----------------------------------------
+    #  期限付きカウンター（レート制限）
+    # ----------------------------------------
+
+    def incr(self, key: str, expiry: float, amount: int = 1, elastic_expiry: bool = False) -> int:
+        """カウンターを増やして新しい値を返す（期限切れ・なしならexpiry秒後に切れる新しいカウンター）
+
+        elastic_expiry なら増やすたびに期限をexpiry秒後に延ばす。
+        """
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute('SELECT value, expires_at FROM counters WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] <= now:
+                value = amount
+                db.execute('INSERT OR REPLACE INTO counters (key, value, expires_at) VALUES (?, ?, ?)',
+                           (key, value, now + expiry))
+            else:
+                value = row[0] + amount
+                if elastic_expiry:
+                    db.execute('UPDATE counters SET value = ?, expires_at = ? WHERE key = ?',
+                               (value, now + expiry, key))
+                else:
+                    db.execute('UPDATE counters SET value = ? WHERE key = ?', (value, key))
+            self._purge(db, now)
+            return value
+
+    def get(self, key: str) -> int:
+        with self._lock:
+            row = self._db.execute('SELECT value FROM counters WHERE key = ? AND expires_at > ?',
+                                   (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        with self._lock:
+            row = self._db.execute('SELECT expires_at FROM counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def clear(self, key: str):
+        with self.transaction() as db:
+            db.execute('DELETE FROM counters WHERE key = ?', (key,))
+
+    def reset(self) -> int:
+        with self.transaction() as db:
+            return db.execute('DELETE FROM counters').rowcount
+
+    # ----------------------------------------
+    #  認証失敗
+    # ----------------------------------------
+
+    def record_auth_failure(self, ip: str, window: float) -> int:
+        """認証失敗を記録し、window秒以内の全ワーカーでの失敗回数を返す"""
+        now = time.time()
+        with self.transaction() as db:
+            db.execute('DELETE FROM auth_failures WHERE ip = ? AND at <= ?', (ip, now - window))
+            db.execute('INSERT INTO auth_failures (ip, at) VALUES (?, ?)', (ip, now))
+            self._purge(db, now)
+            if self._writes % PURGE_EVERY == 0:
+                db.execute('DELETE FROM auth_failures WHERE at <= ?', (now - window,))
+            return db.execute('SELECT COUNT(*) FROM auth_failures WHERE ip = ?', (ip,)).fetchone()[0]
+
+    def block(self, ip: str, until: float):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO auth_blocks (ip, until) VALUES (?, ?)', (ip, until))
+
+    def blocks(self) -> dict:
+        """ブロック中のIP（ip -> 解除時刻）"""
+        with self._lock:
+            rows = self._db.execute('SELECT ip, until FROM auth_blocks WHERE until > ?', (time.time(),)).fetchall()
+        return dict(rows)
+
+    # ----------------------------------------
+    #  端末ごとの再生状態（transaction() の中で使う）
+    # ----------------------------------------
+
+    def load_sessions(self) -> dict:
+        with self._lock:
+            rows = self._db.execute('SELECT device, state FROM sessions').fetchall()
+        return {device: json.loads(state) for device, state in rows}
+
+    def save_session(self, device: str, state: dict):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO sessions (device, state) VALUES (?, ?)', (device, json.dumps(state)))
+
+    def delete_session(self, device: str):
+        with self.transaction() as db:
+            db.execute('DELETE FROM sessions WHERE device = ?', (device,))
+
+    def get_meta(self, key: str, default=None):
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    # ----------------------------------------
+    #  メトリクス（プロセスごとの値。/metrics を受け付けたワーカーが合計する）
+    # ----------------------------------------
+
+    def publish_metrics(self, process: int, snapshot: dict):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO metrics (process, snapshot) VALUES (?, ?)',
+                       (process, json.dumps(snapshot)))
+
+    def read_metrics(self, exclude: int | None = None) -> list:
+        """各プロセスが最後に置いた値（excludeのプロセスを除く）"""
+        with self._lock:
+            rows = self._db.execute('SELECT process, snapshot FROM metrics').fetchall()
+        return [json.loads(snapshot) for process, snapshot in rows if process != exclude]
+
+    def reset_metrics(self):
+        """前回の起動で置かれた値を捨てる（親プロセスの起動時）"""
+        with self.transaction() as db:
+            db.execute('DELETE FROM metrics')
+
+    # ----------------------------------------
+    #  表示したいPresence（ワーカーが置き、親プロセスが送る）
+    # ----------------------------------------
+
+    def post_presence(self, desired: dict, generation: int, version: int | None) -> bool:
+        """表示したい状態を置く（versionより新しい状態が既に置かれていれば破棄）"""
+        with self.transaction() as db:
+            seq, current = db.execute('SELECT seq, version FROM presence WHERE id = 1').fetchone()
+            if version is not None and version < current:
+                return False
+            db.execute('UPDATE presence SET seq = ?, generation = ?, version = ?, desired = ? WHERE id = 1',
+                       (seq + 1, generation, current if version is None else version, json.dumps(desired)))
+            return True
+
+    def clear_presence(self):
+        with self.transaction() as db:
+            db.execute('UPDATE presence SET seq = seq + 1, desired = NULL WHERE id = 1')
+
+    def patch_presence(self, generation: int, fields: dict) -> bool:
+        """同じ曲（世代）のままなら、置かれている状態に項目を追加する"""
+        with self.transaction() as db:
+            current, desired = db.execute('SELECT generation, desired FROM presence WHERE id = 1').fetchone()
+            if generation != current or desired is None:
+                return False
+            desired = dict(json.loads(desired), **fields)
+            db.execute('UPDATE presence SET seq = seq + 1, desired = ? WHERE id = 1', (json.dumps(desired),))
+            return True
+
+    def reset_playback(self):
+        """前回の起動で残った再生状態と表示したいPresenceを捨てる（親プロセスの起動時）"""
+        with self.transaction() as db:
+            db.execute('DELETE FROM sessions')
+            db.execute("DELETE FROM meta WHERE key IN ('sessions', 'discord')")
+            db.execute('UPDATE presence SET seq = seq + 1, generation = 0, version = 0, desired = NULL WHERE id = 1')
+
+    def read_presence(self) -> tuple[int, int, dict | None]:
+        """(変更番号, 世代, 表示したい状態) を返す"""
+        with self._lock:
+            seq, generation, desired = self._db.execute(
+                'SELECT seq, generation, desired FROM presence WHERE id = 1'
+            ).fetchone()
+        return seq, generation, json.loads(desired) if desired is not None else None
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path: str) -> SharedStore:
+    """パスごとに1つのSharedStore（レート制限と他の用途で接続を共有する）"""
+    with _stores_lock:
+        store = _stores.get(os.path.abspath(path))
+        if store is None:
+            store = _stores[os.path.abspath(path)] = SharedStore(path)
+        return store
+
+
+class SharedLimitsStorage(Storage):
+    """limits（Flask-Limiter）のストレージ。SharedStoreのカウンターを使い、全ワーカーで回数を数える
+
+    storage_uri は "shared+sqlite:///絶対パス" または "shared+sqlite://相対パス"。
+    """
+
+    STORAGE_SCHEME = ['shared+sqlite']
+
+    def __init__(self, uri: str | None = None, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.store = open_store(uri.split('://', 1)[1])
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1, **kwargs) -> int:
+        # 新しい limits は incr(key, expiry, amount=...)、古い limits（Flask-Limiter 3系）は elastic_expiry も渡す
+        return self.store.incr(key, expiry, amount, elastic_expiry)
+
+    def get(self, key: str) -> int:
+        return self.store.get(key)
+
+    def get_expiry(self, key: str) -> float:
+        return self.store.get_expiry(key)
+
+    def check(self) -> bool:
+        try:
+            self.store.get('')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> int | None:
+        return self.store.reset()
+
+    def clear(self, key: str) -> None:
+        self.store.clear(key)
@@ -0,0 +1,90 @@
+"""ip_filter.IPAllowList のテスト"""
+
+import ipaddress
+import logging
+
+from ip_filter import IPAllowList
+
+
+def test_ipv4_cidr():
+    allowed = IPAllowList.parse('192.168.1.0/24, 10.0.0.1')
+    assert '192.168.1.1' in allowed
+    assert '192.168.1.255' in allowed
+    assert '10.0.0.1' in allowed
+    assert '192.168.2.1' not in allowed
+    assert '10.0.0.2' not in allowed
+
+
+def test_ipv6_cidr():
+    allowed = IPAllowList.parse('2001:db8::/32, ::1')
+    assert '2001:db8::1' in allowed
+    assert '2001:db8:ffff::1' in allowed
+    assert '::1' in allowed
+    assert '2001:db9::1' not in allowed
+    # IPv4とIPv6の表は別
+    assert '127.0.0.1' not in allowed
+
+
+def test_overlapping_ranges_are_collapsed():
+    allowed = IPAllowList.parse('10.0.0.0/8, 10.1.0.0/16, 10.1.2.3, 10.0.0.0/9, 10.128.0.0/9')
+    assert len(allowed) == 1
+    assert '10.1.2.3' in allowed
+    assert '10.255.255.255' in allowed
+    assert '11.0.0.0' not in allowed
+
+
+def test_adjacent_ranges_are_collapsed():
+    allowed = IPAllowList([ipaddress.ip_network('192.0.2.0/25'), ipaddress.ip_network('192.0.2.128/25')])
+    assert len(allowed) == 1
+    assert '192.0.2.200' in allowed
+
+
+def test_ipv4_mapped_ipv6_is_checked_as_ipv4():
+    allowed = IPAllowList.parse('192.0.2.0/24')
+    assert '::ffff:192.0.2.1' in allowed
+    assert '::ffff:198.51.100.1' not in allowed
+
+
+def test_ipv4_mapped_network_written_as_ipv6():
+    allowed = IPAllowList.parse('::ffff:192.168.0.0/120')
+    assert '::ffff:192.168.0.7' in allowed
+    assert '::ffff:192.168.1.7' not in allowed
+    # 接続元がIPv4で届く場合は、IPv6で書いた射影アドレスの範囲とは別扱い
+    assert '192.168.0.7' not in allowed
+
+
+def test_invalid_entries_are_skipped(caplog):
+    with caplog.at_level(logging.WARNING, logger='ip_filter'):
+        allowed = IPAllowList.parse('not-an-ip, 10.0.0.0/8, 300.1.1.1, , 2001:db8::/200')
+    assert len(allowed) == 1
+    assert '10.1.1.1' in allowed
+    assert 'not-an-ip' in caplog.text
+    assert '300.1.1.1' in caplog.text
+
+
+def test_invalid_client_address_is_denied():
+    allowed = IPAllowList.parse('0.0.0.0/0')
+    assert '1.2.3.4' in allowed
+    assert 'unknown' not in allowed
+    assert '' not in allowed
+
+
+def test_empty_list_allows_everyone():
+    # server.is_ip_allowed は空のリストなら全て許可する（リストは偽になる）
+    for text in ('', ' , ', 'bogus'):
+        allowed = IPAllowList.parse(text)
+        assert not allowed
+        assert len(allowed) == 0
+
+
+def test_recent_memo_is_cleared_at_limit():
+    allowed = IPAllowList.parse('10.0.0.0/8')
+    addresses = [str(ipaddress.IPv4Address(0x0A000000 + n)) for n in range(IPAllowList.RECENT_MAX)]
+    for ip in addresses:
+        assert ip in allowed
+    assert len(allowed._recent) == IPAllowList.RECENT_MAX
+
+    assert '192.0.2.1' not in allowed
+    assert allowed._recent == {'192.0.2.1': False}
+    # 消した後も判定は変わらない
+    assert addresses[0] in allowed
@@ -0,0 +1,240 @@
+"""
+上流API（YouTube Music）の呼び出し制御
+問い合わせ回数の予算（トークンバケット）、障害時に即座に諦めるサーキットブレーカー、
+1回の呼び出しの締め切りをまとめて扱う
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+class UpstreamUnavailable(Exception):
+    """上流を呼ばずに諦めた（ブレーカーが開いている・予算切れ）"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class UpstreamTimeout(Exception):
+    """締め切りまでに応答がなかった"""
+
+
+class TokenBucket:
+    """毎秒rate個たまり、最大burst個まで持てるトークンバケット
+
+    トークンが足りない場合は前借りして待ち時間を返す（待てない場合は返却して断る）。
+    storeを指定すると、残りのトークンをkeyの行に置いて複数のプロセスで共有する
+    （プロセスをまたぐので時刻は time.time() で数える）。
+    """
+
+    def __init__(self, rate: float, burst: float, store=None, key: str = 'bucket'):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.store = store
+        self.key = key
+        self._clock = time.monotonic if store is None else time.time
+        self._tokens = self.burst
+        self._updated = self._clock()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _shared(self, write: bool = True):
+        """共有ストアから残りを読み込み、抜ける時に書き戻す（storeがなければロックだけ）"""
+        with self._lock:
+            if self.store is None:
+                yield
+                return
+            if not write:
+                self._load()
+                yield
+                return
+            with self.store.transaction():
+                self._load()
+                yield
+                self.store.set_meta(self.key, {'tokens': self._tokens, 'updated': self._updated})
+
+    def _load(self):
+        state = self.store.get_meta(self.key)
+        if state is not None:
+            self._tokens, self._updated = state['tokens'], state['updated']
+
+    def reserve(self, max_wait: float) -> float | None:
+        """トークンを1つ取り、使えるまでの秒数を返す（max_waitを超えるならNone）"""
+        if self.rate <= 0:
+            return 0.0
+        with self._shared():
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+    def refund(self):
+        """使わなかったトークンを返す"""
+        if self.rate > 0:
+            with self._shared():
+                self._tokens = min(self.burst, self._tokens + 1)
+
+    @property
+    def tokens(self) -> float:
+        if self.rate <= 0:
+            return self.burst
+        with self._shared(write=False):
+            return min(self.burst, self._tokens + max(0.0, self._clock() - self._updated) * self.rate)
+
+
+class CircuitBreaker:
+    """連続してfailure_threshold回失敗したら開き、reset_timeout秒は呼び出しを断る
+
+    時間が経ったら1回だけ試しに通し（半開）、成功すれば閉じ、失敗すればまた開く。
+    試しの結果がreset_timeout秒たっても届かない場合（試したプロセスが落ちた等）は、もう1回試す。
+    storeを指定すると、状態をkeyの行に置いて複数のプロセスで共有する。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30, store=None,
+                 key: str = 'breaker'):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.store = store
+        self.key = key
+        self._clock = time.monotonic if store is None else time.time
+        self._state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.RLock()
+        self.stats = {'opened': 0}
+
+    @contextmanager
+    def _shared(self, write: bool = True):
+        """共有ストアから状態を読み込み、変わっていれば抜ける時に書き戻す（storeがなければロックだけ）"""
+        with self._lock:
+            if self.store is None:
+                yield
+                return
+            if not write:
+                self._load()
+                yield
+                return
+            with self.store.transaction():
+                before = self._load()
+                yield
+                after = self._dump()
+                if after != before:
+                    self.store.set_meta(self.key, after)
+
+    def _dump(self) -> dict:
+        return {'state': self._state, 'failures': self.failures, 'opened_at': self._opened_at,
+                'opened': self.stats['opened']}
+
+    def _load(self) -> dict | None:
+        state = self.store.get_meta(self.key)
+        if state is not None:
+            self._state, self.failures = state['state'], state['failures']
+            self._opened_at, self.stats['opened'] = state['opened_at'], state['opened']
+        return state
+
+    @property
+    def state(self) -> str:
+        with self._shared(write=False):
+            return self._state
+
+    def allow(self) -> bool:
+        """呼び出してよいか（半開のときは試しの1回だけ許可）"""
+        with self._shared():
+            if self._state == self.CLOSED:
+                return True
+            if self._clock() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._opened_at = self._clock()
+                return True
+            return False
+
+    def record_success(self):
+        with self._shared():
+            self.failures = 0
+            self._state = self.CLOSED
+
+    def record_failure(self):
+        with self._shared():
+            self.failures += 1
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.stats['opened'] += 1
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+
+class GuardedUpstream:
+    """予算・ブレーカー・締め切りを通して上流を呼ぶ
+
+    呼び出しは専用スレッドで行い、timeout秒（予算待ちを含む）を過ぎたら待つのをやめる。
+    締め切りを過ぎた呼び出しはスレッドでそのまま終わらせ、結果は捨てる。
+    """
+
+    def __init__(self, bucket: TokenBucket, breaker: CircuitBreaker, timeout: float = 5,
+                 workers: int = 4, name: str = 'upstream'):
+        self.bucket = bucket
+        self.breaker = breaker
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=name)
+        self.stats = {'ok': 0, 'error': 0, 'timeout': 0, 'circuit_open': 0, 'budget': 0}
+
+    def call(self, fn, *args, **kwargs):
+        """fnを呼んで結果を返す
+
+        呼ばずに諦めた場合は UpstreamUnavailable、締め切りを過ぎた場合は UpstreamTimeout、
+        fnが失敗した場合はその例外を送出する。
+        """
+        deadline = time.monotonic() + self.timeout
+
+        # 予算を先に確保する（ブレーカーが半開の場合、試しの1回を予算切れで無駄にしないため）
+        # 予算待ちは締め切りの半分まで（残りは呼び出し自体に使う）
+        wait = self.bucket.reserve(self.timeout / 2)
+        if wait is None:
+            self.stats['budget'] += 1
+            raise UpstreamUnavailable('budget')
+
+        if not self.breaker.allow():
+            self.bucket.refund()
+            self.stats['circuit_open'] += 1
+            raise UpstreamUnavailable('circuit_open')
+
+        if wait > 0:
+            time.sleep(wait)
+
+        future = self._executor.submit(fn, *args, **kwargs)
+        try:
+            result = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            future.cancel()
+            self.stats['timeout'] += 1
+            self.breaker.record_failure()
+            raise UpstreamTimeout(f"{self.timeout}秒以内に応答がありませんでした") from None
+        except Exception:
+            self.stats['error'] += 1
+            self.breaker.record_failure()
+            raise
+
+        self.stats['ok'] += 1
+        self.breaker.record_success()
+        return result
+
+    def health(self) -> dict:
+        return {
+            'circuit': self.breaker.state,
+            'tokens': round(self.bucket.tokens, 2),
+            'stats': dict(self.stats, circuit_opened=self.breaker.stats['opened']),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,210 @@
+"""
+複数ワーカープロセスでの起動（WORKERS > 1）
+親プロセスがポートを開いてワーカーに渡し（受け付けはOSが振り分ける）、ワーカーが落ちたら起動し直す。
+Discordへの接続は親プロセスだけが持ち、ワーカーが共有ストアに置いたPresenceを送る
+"""
+
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+WORKER_FD_ENV = 'YTM_RPC_WORKER_FD'  # 親プロセスから受け継いだ待ち受けソケット
+WORKER_ID_ENV = 'YTM_RPC_WORKER_ID'  # 1から始まるワーカー番号（親プロセス・単一プロセスでは0）
+RESTART_DELAY = 1.0  # 落ちたワーカーを起動し直すまでの秒数
+
+
+def supported() -> bool:
+    """ソケットを子プロセスに受け継げるか（POSIXのみ）"""
+    return os.name == 'posix'
+
+
+def worker_id() -> int:
+    return int(os.getenv(WORKER_ID_ENV, '0'))
+
+
+def worker_path(path: str, worker: int) -> str:
+    """ワーカーごとのファイル名（server.log → server.w1.log）。空・親プロセスならそのまま"""
+    if not path or not worker:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{worker}{ext}"
+
+
+def listen_socket(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    """待ち受けソケットを開く（ワーカーに受け継ぐ）"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def inherited_socket() -> socket.socket | None:
+    """親プロセスから受け継いだ待ち受けソケット（ワーカーでなければNone）"""
+    fd = os.getenv(WORKER_FD_ENV)
+    if not fd:
+        return None
+    return socket.socket(fileno=int(fd))
+
+
+class WorkerPool:
+    """ワーカープロセスを起動して見張る（落ちたら起動し直す）"""
+
+    def __init__(self, count: int, sock: socket.socket, argv: list):
+        self.count = count
+        self.sock = sock
+        self.argv = argv
+        self._procs = {}  # ワーカー番号 -> Popen
+        self._stopping = threading.Event()
+        self.stats = {'restarts': 0}
+
+    def _spawn(self, worker: int):
+        env = dict(os.environ)
+        env[WORKER_FD_ENV] = str(self.sock.fileno())
+        env[WORKER_ID_ENV] = str(worker)
+        self._procs[worker] = subprocess.Popen([sys.executable] + self.argv, env=env, pass_fds=(self.sock.fileno(),))
+
+    def start(self):
+        for worker in range(1, self.count + 1):
+            self._spawn(worker)
+        logger.info("👷 ワーカー%d個を起動", self.count)
+
+    def supervise(self):
+        """stop() が呼ばれるまでワーカーを見張る（呼び出し元をブロックする）"""
+        while not self._stopping.wait(0.5):
+            for worker, proc in list(self._procs.items()):
+                code = proc.poll()
+                if code is None or self._stopping.is_set():
+                    continue
+                logger.warning("⚠️ ワーカー%dが終了しました（終了コード %s）。起動し直します", worker, code)
+                time.sleep(RESTART_DELAY)
+                self.stats['restarts'] += 1
+                self._spawn(worker)
+
+    def stop(self, timeout: float = 10.0):
+        """ワーカーに終了を伝え、終わるまで待つ（時間内に終わらなければ強制終了）"""
+        self._stopping.set()
+        for proc in self._procs.values():
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        for proc in self._procs.values():
+            try:
+                proc.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    def alive(self) -> int:
+        return sum(1 for proc in self._procs.values() if proc.poll() is None)
+
+
+class SharedPresence:
+    """ワーカー側のPresence（PresenceWriterの代わり）
+
+    表示したい状態を共有ストアに置くだけで、Discordへの送信は親プロセスの PresenceRelay が行う。
+    接続状況・統計は親プロセスが共有ストアに書いたものを読む。
+    """
+
+    STATUS_TTL = 1.0  # 接続状況を読み直す間隔（秒）
+
+    def __init__(self, store):
+        self.store = store
+        self._status = {}
+        self._status_read_at = 0.0
+
+    def post(self, update_args: dict, generation: int = 0, version: int | None = None) -> bool:
+        return self.store.post_presence(update_args, generation, version)
+
+    def post_clear(self):
+        self.store.clear_presence()
+
+    def patch(self, generation: int, fields: dict) -> bool:
+        return self.store.patch_presence(generation, fields)
+
+    def desired(self) -> dict | None:
+        return self.store.read_presence()[2]
+
+    def _leader_status(self) -> dict:
+        now = time.monotonic()
+        if now - self._status_read_at >= self.STATUS_TTL:
+            self._status = self.store.get_meta('discord', {})
+            self._status_read_at = now
+        return self._status
+
+    @property
+    def connected(self) -> bool:
+        return bool(self._leader_status().get('connected'))
+
+    @property
+    def stats(self) -> dict:
+        return self._leader_status().get('stats', {'reconnect_attempts': 0, 'coalesced': 0, 'failed': 0})
+
+    def health(self) -> dict:
+        return dict(self._leader_status().get('health', {}), relayed=True)
+
+    def start(self):
+        pass
+
+    def close(self, timeout: float = 5.0):
+        pass
+
+
+class PresenceRelay:
+    """親プロセスで、ワーカーが共有ストアに置いたPresenceをPresenceWriterに渡す
+
+    置かれた状態の変更番号をinterval秒ごとに見て、変わっていれば渡す（古い状態の破棄は置く時に済んでいる）。
+    接続状況と統計は1秒ごとに共有ストアへ書き、ワーカーの /health・/metrics で使う。
+    """
+
+    def __init__(self, store, writer, interval: float = 0.05):
+        self.store = store
+        self.writer = writer
+        self.interval = interval
+        self._seq = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._seq = self.store.read_presence()[0]
+        self._thread = threading.Thread(target=self._run, name='presence-relay', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _run(self):
+        published_at = 0.0
+        while not self._stop.wait(self.interval):
+            try:
+                self._relay()
+                now = time.monotonic()
+                if now - published_at >= 1.0:
+                    published_at = now
+                    self.store.set_meta('discord', {
+                        'connected': self.writer.connected,
+                        'stats': dict(self.writer.stats),
+                        'health': self.writer.health(),
+                    })
+            except Exception as e:
+                logger.warning("⚠️ Presenceの中継に失敗: %s", e)
+
+    def _relay(self):
+        seq, generation, desired = self.store.read_presence()
+        if seq == self._seq:
+            return
+        self._seq = seq
+        if desired is None:
+            self.writer.post_clear()
+        else:
+            self.writer.post(desired, generation)